@@ -0,0 +1,3 @@
+from async_server import create_async_app
+
+app = create_async_app()
@@ -0,0 +1,428 @@
+"""
+An asynchronous server for the same tile routes as the WSGI app in
+server.py, for an ASGI server such as uvicorn. See asgi_server.py.
+
+Metatiles are fetched from S3 with aiobotocore's client, so one process can
+wait on hundreds of GETs at once over a single connection pool, and share
+one set of in-process caches between them, rather than needing a process
+for each GET in flight. Work which would hold up the event loop, such as
+indexing metatiles, extracting and compressing tiles and talking to the
+shared cache, is done on a thread pool.
+
+The server is set up from the same config as the WSGI app, and uses the
+same code to find metatiles and the tiles in them. Requests for anything
+other than tiles, such as the TileJSON, are passed on to the WSGI app, on
+the thread pool.
+
+Tiles are always compressed here, as there's no Flask-Compress in front of
+them. Stale metatiles are revalidated by the same code as in the WSGI app,
+on its thread pool, with the conditional GET run on the event loop.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+from metatile import raw_member
+from metrics import record_cache_outcome, request_timer, stage
+from server import (
+    TILE_ERRORS,
+    abort_response,
+    best_encoding,
+    cache_delete,
+    cache_get,
+    cache_set,
+    cache_tile,
+    cached_metatile,
+    cached_tile,
+    call_wsgi,
+    create_app,
+    encode_tile,
+    fetches_members,
+    find_member,
+    finish_routed_timer,
+    index_cache_key,
+    match_tile_route,
+    metatile_conditions,
+    negative_caching,
+    parse_routed_tile_request,
+    record_hot,
+    s3_client_options,
+    start_routed_timer,
+    text_response,
+    tile_cache_info,
+    tile_cache_key,
+    tile_error,
+    tile_headers,
+    use_cached,
+    wsgi_environ,
+)
+from singleflight import AsyncSingleFlight
+from storage import (
+    AsyncS3Storage,
+    MetatileChangedException,
+    StorageResponse,
+    UnknownMetatileException,
+    configured_key_format_type,
+)
+
+# How long to wait for the conditional GET when revalidating a metatile,
+# in case the event loop stops before it finishes.
+REVALIDATION_TIMEOUT = 60
+
+
+def run_in_pool(executor, fn, *args):
+    """
+    Run `fn` on the thread pool, in a copy of the current context, so that
+    it has the app context and request timer of the request.
+    """
+
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(context.run, fn, *args))
+
+
+def create_async_app(app=None, s3_client=None):
+    """
+    Make the async server, in front of the WSGI app from create_app. An
+    asyncio S3 client can be passed in, otherwise one is made with
+    aiobotocore when the server starts.
+    """
+
+    return AsyncTileServer(app or create_app(), s3_client)
+
+
+class AsyncTileServer(object):
+    def __init__(self, app, s3_client=None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config.get('ASYNC_THREAD_POOL_SIZE') or 8)
+        self.flights = AsyncSingleFlight()
+        if app.metrics is not None:
+            app.metrics.add_stats('tapalcatl_async_metatile_flights',
+                                  'Coalesced metatile fetches in the async server',
+                                  self.flights.stats)
+        self.exit_stack = contextlib.AsyncExitStack()
+
+        # the shared cache can block on the network, unless it's off.
+        self.shared_cache = app.shared_cache is not None
+
+        self.storage = None
+        self.opening = None
+        if s3_client is not None or (app.config.get('STORAGE_BACKEND') or 's3') != 's3':
+            self.use_storage(self.make_storage(s3_client))
+
+    def make_storage(self, s3_client):
+        config = self.app.config
+        if s3_client is None:
+            # other backends read local files, which is quick enough to do
+            # on the thread pool.
+            return PooledStorage(self.app.storage, self.executor)
+
+        deadline = config.get('S3_DEADLINE_MS')
+        return AsyncS3Storage(
+            s3_client, config.get('S3_BUCKET'), config.get('S3_PREFIX'),
+            config.get('S3_LAYER'), configured_key_format_type(config),
+            requester_pays=config.get('REQUESTER_PAYS'),
+            deadline=deadline / 1000.0 if deadline else None,
+            executor=self.executor,
+        )
+
+    def use_storage(self, storage):
+        self.storage = storage
+        # so that the storage stats on /metrics are this storage's.
+        self.app.storage = storage
+
+    async def open_s3_client(self):
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import get_session
+
+        client = get_session().create_client(
+            's3', config=AioConfig(**s3_client_options(self.app.config)))
+        return await self.exit_stack.enter_async_context(client)
+
+    async def startup(self):
+        if self.storage is not None:
+            return
+        if self.opening is None:
+            self.opening = asyncio.ensure_future(self.open_s3_client())
+        s3_client = await self.opening
+        if self.storage is None:
+            self.use_storage(self.make_storage(s3_client))
+
+    async def shutdown(self):
+        await self.exit_stack.aclose()
+        self.executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        route = match_tile_route(scope['path'])
+
+        if route is not None and scope['method'] in ('GET', 'HEAD'):
+            await self.startup()
+            with self.app.app_context():
+                status, headers, body = await self.handle_tile(*route, scope=scope)
+        elif scope['path'] == '/health_check' and scope['method'] in ('GET', 'HEAD'):
+            await self.startup()
+            with self.app.app_context():
+                await self.handle_tile('vector', dict(
+                    z='0', x='0', y='0', fmt='mvt', tile_pixel_size='256'), scope=scope)
+            status, headers, body = 200, [('Content-Type', 'text/plain; charset=utf-8')], b'OK'
+        else:
+            body = await read_body(receive)
+            server_name, server_port = scope.get('server') or ('localhost', 80)
+            environ = wsgi_environ(
+                scope['method'], scope['path'], scope.get('query_string', b'').decode('latin1'),
+                request_headers(scope), body, server_name, server_port,
+                scheme=scope.get('scheme', 'http'), script_name=scope.get('root_path', ''))
+            status, headers, body = await run_in_pool(self.executor, call_wsgi, self.app, environ)
+
+        headers.append(('Content-Length', str(len(body))))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                        for name, value in headers],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': body if scope['method'] != 'HEAD' else b'',
+        })
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_tile(self, layer, params, scope):
+        """
+        Returns the status, headers and body of the response to a request
+        for a tile, timing it as the WSGI app does.
+        """
+
+        timer = start_routed_timer(layer, params)
+        token = request_timer.set(timer)
+        try:
+            status, headers, body = await self.tile_response(
+                layer, params, request_headers(scope))
+        finally:
+            request_timer.reset(token)
+
+        finish_routed_timer(timer, headers)
+        return status, headers, body
+
+    async def tile_response(self, layer, params, headers):
+        try:
+            meta, member_name, conditions = parse_routed_tile_request(layer, params, headers)
+        except HTTPException as e:
+            return abort_response(e)
+
+        try:
+            storage_result = await self.retrieve_member(
+                meta, member_name, conditions, best_encoding(headers.get('accept-encoding')))
+            with stage('response'):
+                return 200, tile_headers(storage_result, params['fmt']), storage_result.data
+        except TILE_ERRORS as e:
+            return text_response(*tile_error(e))
+
+    async def call_cache(self, fn, *args):
+        """
+        Call one of the cache functions from server.py, on the thread pool
+        if it might block on the shared cache.
+        """
+
+        if self.shared_cache:
+            return await run_in_pool(self.executor, fn, *args)
+        return fn(*args)
+
+    async def retrieve_member(self, meta, member_name, cache_info, content_encoding=None):
+        record_hot(meta)
+        with negative_caching(meta, member_name):
+            return await self.fetch_member(meta, member_name, cache_info, content_encoding)
+
+    async def fetch_member(self, meta, member_name, cache_info, content_encoding=None):
+        """
+        Fetch a member of the metatile, as fetch_member in server.py does,
+        from either the whole metatile or, with range requests, its index.
+        """
+
+        deadline = self.storage.start_deadline()
+        for attempt in range(0, 2):
+            source = await self.metatile_fetch(meta, metatile_conditions(cache_info), deadline)
+            member = find_member(source.index, member_name)
+            tile_info = tile_cache_info(source.cache_info, member, cache_info)
+
+            try:
+                data, encoding = await self.encoded_tile(
+                    meta, source, member_name, member, content_encoding, deadline)
+            except MetatileChangedException:
+                # the cached index is for an older version of the metatile,
+                # so throw it away and try again with a fresh one.
+                self.app.logger.info("%s: Metatile changed, fetching index again", meta)
+                await self.call_cache(cache_delete, index_cache_key(meta))
+                continue
+
+            return StorageResponse(
+                data=data,
+                cache_info=tile_info,
+                content_encoding=encoding,
+            )
+
+        raise UnknownMetatileException(
+            "Metatile %s changed repeatedly while fetching %s" % (meta, member_name))
+
+    async def encoded_tile(self, meta, source, member_name, member, content_encoding, deadline):
+        """
+        The tile's data and content encoding, as from encoded_tile in
+        server.py, with the member read from storage if `source` is only
+        the metatile's index, and encoded on the thread pool.
+        """
+
+        etag = source.cache_info.etag
+        key = tile_cache_key(meta, etag, member_name, content_encoding)
+        encoded = cached_tile(key)
+        if encoded is not None:
+            return encoded
+
+        if source.data is not None:
+            def read_raw():
+                return raw_member(source.data, member)
+        else:
+            raw = await self.storage.read_member(meta, member, member_name, etag, deadline)
+
+            def read_raw():
+                return raw
+
+        encoded = await run_in_pool(self.executor, encode_tile, read_raw, member, content_encoding)
+        cache_tile(key, encoded)
+        return encoded
+
+    def cache_key(self, meta):
+        """
+        What's fetched for the metatile, the key it's cached under and the
+        function to look it up in the cache with.
+        """
+
+        if fetches_members():
+            return 'index', index_cache_key(meta), cache_get
+        return 'metatile', meta, cached_metatile
+
+    async def metatile_fetch(self, meta, cache_info, deadline=None):
+        """
+        Fetch the metatile, or its index with range requests, from the
+        cache or storage, as metatile_fetch and metatile_index_fetch in
+        server.py do.
+        """
+
+        kind, cache_key, lookup = self.cache_key(meta)
+        cached = await self.call_cache(lookup, cache_key)
+        if cached:
+            self.app.logger.info("%s: Using a cached metatile %s", meta, kind)
+            return self.use_cached(meta, cached, cache_info)
+
+        with stage('fetch'):
+            return await self.flights.do(
+                (kind, self.storage.location(meta), cache_info),
+                self.metatile_storage_fetch, meta, cache_info, deadline,
+            )
+
+    async def metatile_storage_fetch(self, meta, cache_info, deadline=None):
+        _, cache_key, lookup = self.cache_key(meta)
+        cached = await self.call_cache(lookup, cache_key)
+        if cached:
+            return self.use_cached(meta, cached, cache_info)
+
+        return await self.metatile_get(meta, cache_info, deadline)
+
+    async def metatile_get(self, meta, cache_info, deadline=None):
+        _, cache_key, _ = self.cache_key(meta)
+        record_cache_outcome('miss')
+        if fetches_members():
+            result = await self.storage.get_index(meta, cache_info, deadline)
+        else:
+            result = await self.storage.get(meta, cache_info)
+        if self.storage.cacheable:
+            await self.call_cache(cache_set, cache_key, result)
+        return result
+
+    def use_cached(self, meta, cached, cache_info):
+        """
+        Answer a request from the cache with use_cached from server.py,
+        which revalidates stale entries on its own thread pool. The
+        conditional fetch for that is run on the event loop and waited for.
+        """
+
+        _, cache_key, _ = self.cache_key(meta)
+        loop = asyncio.get_running_loop()
+
+        def get(meta, conditions):
+            return asyncio.run_coroutine_threadsafe(
+                self.metatile_get(meta, conditions), loop).result(REVALIDATION_TIMEOUT)
+
+        return use_cached(meta, cache_key, cached, cache_info, get)
+
+
+class PooledStorage(object):
+    """
+    A storage backend from storage.py, with its reads run on the thread
+    pool.
+    """
+
+    def __init__(self, storage, executor):
+        self.storage = storage
+        self.executor = executor
+        self.cacheable = storage.cacheable
+        self.reads_members = storage.reads_members
+
+    def location(self, meta):
+        return self.storage.location(meta)
+
+    def start_deadline(self):
+        return self.storage.start_deadline()
+
+    async def get(self, meta, cache_info):
+        return await run_in_pool(self.executor, self.storage.get, meta, cache_info)
+
+    async def get_index(self, meta, cache_info, deadline=None):
+        return await run_in_pool(
+            self.executor, self.storage.get_index, meta, cache_info, deadline)
+
+    async def read_member(self, meta, member, member_name, etag, deadline=None):
+        return await run_in_pool(
+            self.executor, self.storage.read_member, meta, member, member_name, etag, deadline)
+
+
+def request_headers(scope):
+    headers = {}
+    for name, value in scope['headers']:
+        name = name.decode('latin1').lower()
+        value = value.decode('latin1')
+        headers[name] = headers[name] + ', ' + value if name in headers else value
+    return headers
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
@@ -0,0 +1,641 @@
+"""
+Benchmarks for the hot paths of tile serving, and a load test which
+replays requests through the app, reading from a fake S3. Run with:
+
+    python benchmark.py
+
+to run the micro-benchmarks and a synthetic load test, or with:
+
+    python benchmark.py --log requests.jsonl --s3-latency-ms 30 --json results.json
+
+to replay a log of requests, one JSON object with a "path" and optionally
+"headers" per line, or an API Gateway event. With --lambda, the requests
+are also replayed through the Lambda handler and through the flask app as
+Zappa would run it, to compare them. See --help for the other options.
+
+Results are printed as a table, and can also be written as JSON with
+--json, so that before and after numbers can be compared when changing
+the code involved.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from flask_caching.backends import RedisCache
+
+from cache_codec import RedisSharedCache, decode_response, encode_response
+from caches import LRUCache, TinyLFUCache
+from fake_redis import FakeRedisClient
+from fake_s3 import FakeS3Client
+from lambda_handler import api_gateway_response, handle_event, parse_event
+from metatile import build_index
+from server import (
+    CacheInfo,
+    KeyFormatType,
+    StorageResponse,
+    TileRequest,
+    compute_key,
+    extract_tile,
+    meta_and_offset,
+    metatile_flights,
+    t2_extract_tile,
+    wsgi_environ,
+)
+from shm_cache import SharedMemoryCache
+from testing import make_app, make_metatile, put_metatile
+
+VECTOR_TILE_URL = '/tilezen/vector/v1/{size}/all/{z}/{x}/{y}.{fmt}'
+
+
+def result(name, value, unit):
+    return dict(name=name, value=value, unit=unit)
+
+
+def timed(name, fn, number):
+    """
+    The mean time per call of `fn`, in microseconds.
+    """
+
+    return result(name, timeit.timeit(fn, number=number) / number * 1e6, 'us')
+
+
+def print_results(results, out=sys.stdout):
+    for r in results:
+        out.write("%-48s %12.1f %s\n" % (r['name'], r['value'], r['unit']))
+
+
+def bench_meta_and_offset(number=100000):
+    tile = TileRequest(14, 8192, 5461, 2, 'mvt')
+    meta = TileRequest(12, 2048, 1365, 1, 'zip')
+
+    return [
+        timed('meta_and_offset', lambda: meta_and_offset(tile, 8, 14), number),
+        timed('compute_key', lambda: compute_key(
+            '20171221', 'all', meta, KeyFormatType.PREFIX_HASH), number),
+    ]
+
+
+def bench_extract_tile(number=2000):
+    metatile = make_metatile()
+    offset = TileRequest(2, 1, 3, 1, 'mvt')
+    index = build_index(metatile)
+
+    t2_metatile = make_metatile(fmt='png')
+    t2_offset = TileRequest(2, 1, 3, 1, 'png')
+    t2_index = build_index(t2_metatile)
+
+    def zipfile_read():
+        z = zipfile.ZipFile(BytesIO(metatile), 'r')
+        return z.read('2/1/3.mvt')
+
+    return [
+        timed('extract_tile (zipfile)', zipfile_read, number),
+        timed('extract_tile (uncached index)', lambda: extract_tile(metatile, offset), number),
+        timed('extract_tile (cached index)', lambda: extract_tile(metatile, offset, index), number),
+        timed('t2_extract_tile (cached index)', lambda: t2_extract_tile(t2_metatile, t2_offset, t2_index), number),
+    ]
+
+
+def bench_handle_tile(number=1000):
+    headers = {'Accept-Encoding': 'gzip'}
+    variants = (
+        ('gzip passthrough off', dict(GZIP_PASSTHROUGH=False)),
+        ('gzip passthrough on', dict(GZIP_PASSTHROUGH=True)),
+        ('tile cache', dict(TILE_CACHE_MAX_BYTES=16 * 1024 * 1024)),
+    )
+
+    results = []
+    for name, config in variants:
+        app = make_app(
+            METATILE_SIZE=4,
+            METATILE_CACHE_MAX_BYTES=64 * 1024 * 1024,
+            **config
+        )
+        app.logger.disabled = True
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile())
+        client = app.test_client()
+
+        def get():
+            resp = client.get('/tilezen/vector/v1/256/all/12/401/802.mvt', headers=headers)
+            assert resp.status_code == 200
+
+        results.append(timed('handle_tile (%s)' % name, get, number))
+
+    return results
+
+
+def sweep_and_hotspot_workload(length=200000, hot_keys=2000, sweep_fraction=0.5, seed=0):
+    """
+    Keys for a mix of users, who request a Zipf-distributed set of popular
+    metatiles, and crawlers, who request each of a sweep of metatiles once.
+    """
+
+    rng = random.Random(seed)
+    weights = [1.0 / (i + 1) for i in range(0, hot_keys)]
+    hot = rng.choices(range(0, hot_keys), weights=weights, k=length)
+
+    sweep = 0
+    keys = []
+    for k in hot:
+        if rng.random() < sweep_fraction:
+            sweep += 1
+            keys.append(('sweep', sweep))
+        else:
+            keys.append(('hot', k))
+
+    return keys
+
+
+def replay(cache, keys, value):
+    for key in keys:
+        if cache.get(key) is None:
+            cache.set(key, value)
+    return float(cache.hits) / (cache.hits + cache.misses)
+
+
+def bench_cache_policies(entries=200, entry_size=1000):
+    keys = sweep_and_hotspot_workload()
+    value = b'x' * entry_size
+    max_bytes = entries * entry_size
+
+    return [
+        result('hit ratio (%s)' % name, replay(cache, keys, value) * 100, '%')
+        for name, cache in (('lru', LRUCache(max_bytes)),
+                            ('tinylfu', TinyLFUCache(max_bytes, expected_entries=entries)))
+    ]
+
+
+def bench_cache_codec(number=2000, keys=16):
+    """
+    Compare the shared cache's encoding of a cached metatile, with its index,
+    against pickling it as flask-caching would, pipelined reads of several
+    metatiles from Redis against reading them one at a time, and reading
+    one from the shared memory cache.
+    """
+
+    metatile = make_metatile()
+    meta = TileRequest(10, 100, 200, 1, 'zip')
+    response = StorageResponse(
+        data=metatile,
+        cache_info=CacheInfo(datetime.datetime.now(datetime.timezone.utc), 'etag'),
+        index=build_index(metatile),
+        fetched_at=time.time(),
+    )
+    pickled = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+    encoded = encode_response(response)
+
+    shm_dir = tempfile.TemporaryDirectory()
+    shm_cache = SharedMemoryCache(os.path.join(shm_dir.name, 'metatiles'), 16 * 1024 * 1024, 1024)
+    shm_cache.set('key', response)
+
+    client = FakeRedisClient(latency=0.0002)
+    shared_cache = RedisSharedCache(RedisCache(host=client))
+    names = ['s3://bucket/%s' % compute_key('prefix', None, meta._replace(y=meta.y + i))
+             for i in range(0, keys)]
+    for name in names:
+        shared_cache.set(name, response)
+
+    results = [
+        timed('cache encode (pickle)', lambda: pickle.dumps(response, pickle.HIGHEST_PROTOCOL), number),
+        timed('cache encode (codec)', lambda: encode_response(response), number),
+        timed('cache decode (pickle)', lambda: pickle.loads(pickled), number),
+        timed('cache decode (codec)', lambda: decode_response(encoded), number),
+        result('cache overhead (pickle)', len(pickled) - len(metatile), 'bytes'),
+        result('cache overhead (codec)', len(encoded) - len(metatile), 'bytes'),
+        timed('redis get x%d (one at a time)' % keys,
+              lambda: [shared_cache.get(name) for name in names], number // 20),
+        timed('redis get x%d (pipelined)' % keys,
+              lambda: shared_cache.get_many(names), number // 20),
+        timed('shared memory cache get', lambda: shm_cache.get('key'), number),
+    ]
+
+    shm_cache.close()
+    shm_dir.cleanup()
+    return results
+
+
+def zipf_requests(count, zoom=14, extent=64, exponent=1.0, tile_sizes=(256, 512),
+                  fmt='mvt', seed=0):
+    """
+    Synthetic requests for tiles in an `extent` by `extent` square at the
+    given zoom, with the popularity of the tiles following a Zipf
+    distribution. Each request is for a random one of the tile sizes, at
+    the zoom which covers the same area.
+    """
+
+    rng = random.Random(seed)
+    origin = 2 ** (zoom - 1)
+    tiles = [(x, y) for x in range(origin, origin + extent)
+             for y in range(origin, origin + extent)]
+    rng.shuffle(tiles)
+
+    weights = [1.0 / (rank + 1) ** exponent for rank in range(0, len(tiles))]
+    requests = []
+    for x, y in rng.choices(tiles, weights=weights, k=count):
+        size = rng.choice(tile_sizes)
+        dz = int(math.log(size // 256, 2))
+        requests.append(dict(path=VECTOR_TILE_URL.format(
+            size=size, z=zoom - dz, x=x >> dz, y=y >> dz, fmt=fmt)))
+
+    return requests
+
+
+def read_request_log(f):
+    """
+    Read requests from a JSONL log, each one an object with the "path" of
+    the request and optionally its "headers", or an API Gateway event,
+    which is kept to replay through the Lambda handlers.
+    """
+
+    requests = []
+    for line in f:
+        line = line.strip()
+        if line:
+            entry = json.loads(line)
+            if 'httpMethod' in entry or 'rawPath' in entry:
+                _, path, _, headers, _ = parse_event(entry)
+                requests.append(dict(path=path, headers=headers, event=entry))
+            else:
+                requests.append(dict(path=entry['path'], headers=entry.get('headers') or {}))
+    return requests
+
+
+def stock_metatiles(app, requests, tile_bytes=20000, variants=4):
+    """
+    Put a synthetic metatile in the fake S3 for each metatile that the
+    vector tile requests need. Other requests will get 404s. Only a few
+    different metatiles are made, to save time, so many will be the same.
+    """
+
+    metatile_size = app.config['METATILE_SIZE']
+    bodies = [make_metatile(metatile_size, tile_bytes=tile_bytes, seed=seed)
+              for seed in range(0, variants)]
+    adapter = app.url_map.bind('localhost')
+
+    stocked = set()
+    for request in requests:
+        try:
+            endpoint, args = adapter.match(request['path'])
+        except Exception:
+            continue
+        if endpoint != 'tiles.handle_tile':
+            continue
+
+        scale = (args.get('tile_pixel_size') or 256) // 256
+        try:
+            meta, _ = meta_and_offset(
+                TileRequest(args['z'], args['x'], args['y'], scale, args['fmt']),
+                metatile_size,
+                metatile_max_detail_zoom=app.config.get('METATILE_MAX_DETAIL_ZOOM'),
+            )
+        except ValueError:
+            continue
+
+        if meta not in stocked:
+            stocked.add(meta)
+            put_metatile(app, meta, bodies[len(stocked) % variants])
+
+    return len(stocked)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    i = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[min(len(sorted_values) - 1, max(0, i))]
+
+
+def cache_hit_ratio(local_cache):
+    if local_cache is None or not local_cache.hits + local_cache.misses:
+        return 0.0
+    return float(local_cache.hits) / (local_cache.hits + local_cache.misses)
+
+
+def load_test(app, requests, concurrency=1):
+    """
+    Replay the requests through the app, `concurrency` at a time, and
+    measure the throughput and latency, and how much work S3 had to do.
+    """
+
+    boto_s3 = app.boto_s3
+    gets_before, bytes_before = boto_s3.get_count, boto_s3.bytes_sent
+    coalesced_before = metatile_flights.deduplicated
+    local = threading.local()
+    statuses = {}
+    statuses_lock = threading.Lock()
+
+    def send(request):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+
+        a = time.perf_counter()
+        resp = client.get(request['path'], headers=request.get('headers') or {})
+        resp.get_data()
+        duration = time.perf_counter() - a
+
+        with statuses_lock:
+            statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+        return duration
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(send, requests))
+    else:
+        latencies = [send(request) for request in requests]
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    count = max(1, len(requests))
+    results = [
+        result('load requests', len(requests), 'requests'),
+        result('load throughput', len(requests) / elapsed, 'req/s'),
+        result('load latency p50', percentile(latencies, 0.50) * 1000, 'ms'),
+        result('load latency p95', percentile(latencies, 0.95) * 1000, 'ms'),
+        result('load latency p99', percentile(latencies, 0.99) * 1000, 'ms'),
+        result('load S3 GETs per request', float(boto_s3.get_count - gets_before) / count, 'GETs'),
+        result('load S3 bytes per request', float(boto_s3.bytes_sent - bytes_before) / count, 'bytes'),
+        result('load coalesced fetches', metatile_flights.deduplicated - coalesced_before, 'fetches'),
+        result('load metatile cache hit ratio', cache_hit_ratio(app.metatile_cache) * 100, '%'),
+        result('load tile cache hit ratio', cache_hit_ratio(app.tile_cache) * 100, '%'),
+    ]
+    for status in sorted(statuses):
+        results.append(result('load status %d' % status, statuses[status], 'responses'))
+    if hasattr(app.storage, 'stats'):
+        for name, value in sorted(app.storage.stats().items()):
+            results.append(result('load storage %s' % name.replace('_', ' '), value, 'total'))
+
+    return results
+
+
+def api_gateway_event(request, http_api=False):
+    """
+    The API Gateway event for a request, from a REST API, or an HTTP API
+    if `http_api` is set.
+    """
+
+    if 'event' in request:
+        return request['event']
+
+    path, _, query_string = request['path'].partition('?')
+    headers = dict(request.get('headers') or {})
+    headers.setdefault('Host', 'tiles.example.com')
+
+    if http_api:
+        return {
+            'version': '2.0',
+            'rawPath': path,
+            'rawQueryString': query_string,
+            'headers': dict((name.lower(), value) for name, value in headers.items()),
+            'requestContext': {'http': {'method': 'GET', 'path': path}, 'stage': '$default'},
+            'isBase64Encoded': False,
+        }
+
+    return {
+        'httpMethod': 'GET',
+        'path': path,
+        'headers': headers,
+        'multiValueHeaders': dict((name, [value]) for name, value in headers.items()),
+        'queryStringParameters': None,
+        'multiValueQueryStringParameters': None,
+        'requestContext': {'stage': 'prod'},
+        'body': None,
+        'isBase64Encoded': False,
+    }
+
+
+def wsgi_lambda_handler(app):
+    """
+    A Lambda handler which goes through the flask app the way Zappa's does:
+    turning the event into a WSGI request, answering it with flask and
+    Flask-Compress, and base64 encoding the response. Zappa's translation
+    of the event is used if it's installed.
+    """
+
+    from werkzeug.wrappers import Response
+
+    try:
+        from zappa.wsgi import create_wsgi_request
+    except ImportError:
+        create_wsgi_request = None
+
+    def handle(event):
+        if create_wsgi_request is not None:
+            environ = create_wsgi_request(event, trailing_slash=False, binary_support=True)
+        else:
+            method, path, query_string, headers, body = parse_event(event)
+            environ = wsgi_environ(method, path, query_string, headers, body,
+                                   server_name=headers.get('host', 'localhost'),
+                                   server_port=443, scheme='https')
+
+        response = Response.from_app(app, environ)
+        return api_gateway_response(
+            event, response.status_code, list(response.headers.items()), response.get_data())
+
+    return handle
+
+
+def native_lambda_handler(app):
+    return lambda event: handle_event(app, event)
+
+
+def bench_lambda(app, requests, http_api=False):
+    """
+    Replay the requests as API Gateway events through the Lambda handler
+    and through the flask app as Zappa would, after a pass to warm up the
+    caches, and measure the latency of each.
+    """
+
+    events = [api_gateway_event(request, http_api) for request in requests]
+    for event in events:
+        handle_event(app, event)
+
+    results = []
+    for name, make_handler in (('zappa', wsgi_lambda_handler), ('native', native_lambda_handler)):
+        handle = make_handler(app)
+        latencies = []
+        for event in events:
+            a = time.perf_counter()
+            handle(event)
+            latencies.append(time.perf_counter() - a)
+
+        latencies.sort()
+        results += [
+            result('lambda %s warm latency p50' % name, percentile(latencies, 0.50) * 1000, 'ms'),
+            result('lambda %s warm latency p99' % name, percentile(latencies, 0.99) * 1000, 'ms'),
+        ]
+
+    return results
+
+
+def cold_invoke(handler_name):
+    """
+    Set up an app and answer one event with the named Lambda handler, as
+    the first invocation of a fresh Lambda function would.
+    """
+
+    app = make_app(METATILE_SIZE=4)
+    app.logger.disabled = True
+    put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile(tile_bytes=1000))
+
+    make_handler = wsgi_lambda_handler if handler_name == 'zappa' else native_lambda_handler
+    response = make_handler(app)(api_gateway_event(dict(path=VECTOR_TILE_URL.format(
+        size=256, z=12, x=401, y=802, fmt='mvt'))))
+    assert response['statusCode'] == 200
+
+
+COLD_START_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import benchmark
+benchmark.cold_invoke(sys.argv[1])
+print(time.perf_counter() - start)
+"""
+
+
+def bench_lambda_cold_start(runs=5):
+    """
+    The median time, in fresh processes, to import the code, set up the app
+    and answer the first event with each Lambda handler.
+    """
+
+    results = []
+    for name in ('zappa', 'native'):
+        times = []
+        for _ in range(0, runs):
+            out = subprocess.check_output(
+                [sys.executable, '-c', COLD_START_SCRIPT, name],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+            times.append(float(out.decode('ascii').strip().splitlines()[-1]))
+
+        times.sort()
+        results.append(result('lambda %s cold start' % name, times[len(times) // 2] * 1000, 'ms'))
+
+    return results
+
+
+def s3_latency(median_ms, sigma, seed=0):
+    """
+    A log-normal distribution of S3 latencies with the given median, which
+    has the long tail that real S3 latencies have.
+    """
+
+    if not median_ms:
+        return 0
+
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    mu = math.log(median_ms / 1000.0)
+
+    def latency():
+        with lock:
+            return rng.lognormvariate(mu, sigma)
+
+    return latency
+
+
+def parse_config(settings):
+    config = {}
+    for setting in settings:
+        name, _, value = setting.partition('=')
+        try:
+            config[name] = json.loads(value)
+        except ValueError:
+            config[name] = value
+    return config
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and load test the tile server.")
+    parser.add_argument('--log', type=argparse.FileType('r'),
+                        help="JSONL request log to replay, rather than synthetic requests.")
+    parser.add_argument('--requests', type=int, default=5000,
+                        help="Number of synthetic requests.")
+    parser.add_argument('--zipf-exponent', type=float, default=1.0)
+    parser.add_argument('--extent', type=int, default=64,
+                        help="Width, in tiles, of the area synthetic requests are for.")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--metatile-size', type=int, default=4)
+    parser.add_argument('--tile-bytes', type=int, default=20000,
+                        help="Size of each tile in the synthetic metatiles.")
+    parser.add_argument('--s3-latency-ms', type=float, default=0,
+                        help="Median latency of the fake S3.")
+    parser.add_argument('--s3-latency-sigma', type=float, default=0.5,
+                        help="Spread of the log-normal distribution of fake S3 latencies.")
+    parser.add_argument('--s3-error-rate', type=float, default=0,
+                        help="Fraction of fake S3 GETs which fail.")
+    parser.add_argument('--config', action='append', default=[], metavar='NAME=VALUE',
+                        help="App config to set, as a JSON value if it parses as one, "
+                             "e.g. METATILE_CACHE_MAX_BYTES=67108864.")
+    parser.add_argument('--lambda', dest='lambda_handler', action='store_true',
+                        help="Also replay the requests as API Gateway events through the Lambda "
+                             "handler and through the flask app as Zappa would, and time cold "
+                             "starts of each.")
+    parser.add_argument('--http-api', action='store_true',
+                        help="Make HTTP API events for --lambda, rather than REST API ones.")
+    parser.add_argument('--skip-micro', action='store_true',
+                        help="Only run the load test.")
+    parser.add_argument('--json', type=argparse.FileType('w'),
+                        help="Write the results to this file as JSON, or - for stdout.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    results = []
+    if not args.skip_micro:
+        results += bench_meta_and_offset()
+        results += bench_extract_tile()
+        results += bench_handle_tile()
+        results += bench_cache_policies()
+        results += bench_cache_codec()
+
+    config = dict(METATILE_SIZE=args.metatile_size)
+    config.update(parse_config(args.config))
+    app = make_app(
+        boto_s3=FakeS3Client(
+            latency=s3_latency(args.s3_latency_ms, args.s3_latency_sigma),
+            error_rate=args.s3_error_rate,
+        ),
+        **config
+    )
+    # the app logs every request, which would swamp the output.
+    app.logger.disabled = True
+
+    if args.log:
+        requests = read_request_log(args.log)
+    else:
+        requests = zipf_requests(args.requests, extent=args.extent,
+                                 exponent=args.zipf_exponent)
+    stock_metatiles(app, requests, tile_bytes=args.tile_bytes)
+    results += load_test(app, requests, concurrency=args.concurrency)
+    if args.lambda_handler:
+        results += bench_lambda(app, requests, http_api=args.http_api)
+        results += bench_lambda_cold_start()
+
+    if args.json is sys.stdout:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print_results(results)
+        if args.json:
+            json.dump(results, args.json, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""
+The format that metatiles and their indexes are kept in the shared cache
+(the one configured with CACHE_TYPE) in, rather than letting flask-caching
+pickle each StorageResponse.
+
+Each entry is a fixed header, holding the ETag, Last-Modified and when the
+entry was fetched from storage, followed by the member index of the
+metatile, if it has one, and then the metatile's bytes as they are. This
+is smaller and quicker to read and write than a pickle, and doesn't depend
+on the layout of the Python classes involved.
+
+Entries are keyed by the storage location of the metatile, such as its S3
+URL, so servers reading from different buckets or prefixes can share a
+cache. With Redis, the client is used directly, and reads of several
+entries at once, for batches of tiles and warming up, are pipelined.
+"""
+import datetime
+import struct
+
+from metatile import ZipMember
+from storage import CacheInfo, StorageResponse
+
+MAGIC = b'TM'
+VERSION = 1
+
+# magic, version, flags, last modified and fetched at (seconds since the
+# epoch), and the lengths of the ETag and the content encoding which follow.
+HEADER = struct.Struct('<2sBBddHB')
+# the index is the number of members, then the length of each of their
+# names, then their ZipMember fields, then the names, so that it can be
+# unpacked a block at a time.
+INDEX_COUNT = struct.Struct('<L')
+INDEX_MEMBER = struct.Struct('<3LHL')
+
+HAS_LAST_MODIFIED = 0x1
+HAS_FETCHED_AT = 0x2
+HAS_INDEX = 0x4
+HAS_DATA = 0x8
+
+
+class BadCacheEntryException(Exception):
+    pass
+
+
+def encode_response(response):
+    """
+    Encode a StorageResponse for a metatile, or for its index, as bytes.
+    """
+
+    cache_info = response.cache_info
+    etag = cache_info.etag.encode('utf8')
+    content_encoding = (response.content_encoding or '').encode('ascii')
+
+    flags = 0
+    last_modified = 0.0
+    if cache_info.last_modified is not None:
+        flags |= HAS_LAST_MODIFIED
+        last_modified = cache_info.last_modified.timestamp()
+    fetched_at = 0.0
+    if response.fetched_at is not None:
+        flags |= HAS_FETCHED_AT
+        fetched_at = response.fetched_at
+    if response.index is not None:
+        flags |= HAS_INDEX
+    if response.data is not None:
+        flags |= HAS_DATA
+
+    parts = [
+        HEADER.pack(MAGIC, VERSION, flags, last_modified, fetched_at,
+                    len(etag), len(content_encoding)),
+        etag,
+        content_encoding,
+    ]
+
+    if response.index is not None:
+        names = [name.encode('utf8') for name in response.index]
+        parts.append(INDEX_COUNT.pack(len(names)))
+        parts.append(struct.pack('<%dH' % len(names), *map(len, names)))
+        parts.extend(INDEX_MEMBER.pack(*member) for member in response.index.values())
+        parts.extend(names)
+
+    if response.data is not None:
+        parts.append(response.data)
+
+    return b''.join(parts)
+
+
+def decode_response(buf):
+    """
+    Decode a StorageResponse encoded with encode_response. Raises
+    BadCacheEntryException if it isn't one.
+    """
+
+    if len(buf) < HEADER.size:
+        raise BadCacheEntryException("Cache entry is too short")
+
+    (magic, version, flags, last_modified, fetched_at, etag_len, encoding_len) = \
+        HEADER.unpack_from(buf)
+    if magic != MAGIC or version != VERSION:
+        raise BadCacheEntryException("Not a version %d cache entry" % VERSION)
+
+    pos = HEADER.size
+    etag = bytes(buf[pos:pos + etag_len]).decode('utf8')
+    pos += etag_len
+    content_encoding = bytes(buf[pos:pos + encoding_len]).decode('ascii') or None
+    pos += encoding_len
+
+    index = None
+    if flags & HAS_INDEX:
+        index, pos = decode_index(buf, pos)
+
+    return StorageResponse(
+        data=bytes(buf[pos:]) if flags & HAS_DATA else None,
+        cache_info=CacheInfo(
+            last_modified=datetime.datetime.fromtimestamp(
+                last_modified, datetime.timezone.utc) if flags & HAS_LAST_MODIFIED else None,
+            etag=etag,
+        ),
+        index=index,
+        content_encoding=content_encoding,
+        fetched_at=fetched_at if flags & HAS_FETCHED_AT else None,
+    )
+
+
+def decode_index(buf, pos):
+    try:
+        (count,) = INDEX_COUNT.unpack_from(buf, pos)
+        pos += INDEX_COUNT.size
+        name_lengths = struct.unpack_from('<%dH' % count, buf, pos)
+        pos += 2 * count
+        members_end = pos + INDEX_MEMBER.size * count
+        members = INDEX_MEMBER.iter_unpack(buf[pos:members_end])
+    except struct.error as e:
+        raise BadCacheEntryException("Truncated cache entry index: %s" % e)
+
+    names_end = members_end + sum(name_lengths)
+    names = bytes(buf[members_end:names_end])
+    if names.isascii():
+        # then the lengths in bytes are also lengths in characters, and the
+        # names can be decoded all at once.
+        names = split_lengths(names.decode('ascii'), name_lengths)
+    else:
+        names = (name.decode('utf8') for name in split_lengths(names, name_lengths))
+
+    index = {}
+    for name, fields in zip(names, members):
+        # the fields are already in ZipMember's order, so skip its __new__.
+        index[name] = tuple.__new__(ZipMember, fields)
+    return index, names_end
+
+
+def split_lengths(seq, lengths):
+    pos = 0
+    for length in lengths:
+        yield seq[pos:pos + length]
+        pos += length
+
+
+def make_shared_cache(backend):
+    """
+    Wrap a flask-caching backend to hold encoded metatiles, or return None
+    if it's the null backend and there's no point.
+    """
+
+    from flask_caching.backends import NullCache
+
+    if isinstance(backend, NullCache):
+        return None
+    # the redis backends keep their client in _write_client.
+    if getattr(backend, '_write_client', None) is not None:
+        return RedisSharedCache(backend)
+    return SharedCache(backend)
+
+
+class SharedCache(object):
+    """
+    Metatiles kept in a flask-caching backend, which still serializes the
+    encoded bytes in its own way.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def decode(value):
+        if value is None:
+            return None
+        try:
+            return decode_response(value)
+        except BadCacheEntryException:
+            # left by a different version, so treat it as a miss.
+            return None
+
+    def __contains__(self, key):
+        return self.backend.has(key)
+
+    def get(self, key):
+        return self.decode(self.backend.get(key))
+
+    def get_many(self, keys):
+        return [self.decode(value) for value in self.backend.get_many(*keys)]
+
+    def set(self, key, value):
+        self.backend.set(key, encode_response(value))
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+
+class RedisSharedCache(SharedCache):
+    """
+    Metatiles kept in Redis using flask-caching's client, but storing the
+    encoded bytes as they are, and pipelining reads of several at once so
+    they only wait for one round trip.
+    """
+
+    def __init__(self, backend):
+        super(RedisSharedCache, self).__init__(backend)
+        self.read_client = backend._read_client
+        self.write_client = backend._write_client
+
+    def prefixed(self, key):
+        return self.backend._get_prefix() + key
+
+    def expiry(self):
+        # flask-caching's default timeout, where -1 means never expire.
+        timeout = self.backend._normalize_timeout(None)
+        return timeout if timeout != -1 else None
+
+    def __contains__(self, key):
+        return bool(self.read_client.exists(self.prefixed(key)))
+
+    def get(self, key):
+        return self.decode(self.read_client.get(self.prefixed(key)))
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        pipe = self.read_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(self.prefixed(key))
+        return [self.decode(value) for value in pipe.execute()]
+
+    def set(self, key, value):
+        self.write_client.set(self.prefixed(key), encode_response(value), ex=self.expiry())
+
+    def delete(self, key):
+        self.write_client.delete(self.prefixed(key))
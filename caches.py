@@ -0,0 +1,316 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    An in-process cache which is bounded by the total size of the values in
+    it, rather than by the number of entries, and evicts the least recently
+    used entries first.
+
+    The size of each value is given by `sizeof`. Values bigger than the
+    whole cache are never stored.
+    """
+
+    # the stats which are sizes rather than counts.
+    gauges = ('entries', 'bytes', 'max_bytes')
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return False
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self._entries),
+            bytes=self.current_bytes,
+            max_bytes=self.max_bytes,
+        )
+
+
+class FrequencySketch(object):
+    """
+    A count-min sketch of how often keys have been seen, with small
+    saturating counters. All the counters are halved after `sample_size`
+    increments, so that the estimates favour recent popularity.
+    """
+
+    DEPTH = 4
+    MAX_COUNT = 15
+    SEEDS = (0x9e3779b1, 0x85ebca77, 0xc2b2ae3d, 0x27d4eb2f)
+    HALVE = bytes(i >> 1 for i in range(0, 256))
+
+    def __init__(self, width, sample_size=None):
+        # round up to a power of two, so we can mask rather than divide.
+        self.width = 1 << max(4, (width - 1).bit_length())
+        self.mask = self.width - 1
+        self.sample_size = sample_size or 10 * self.width
+        self.additions = 0
+        self.table = [bytearray(self.width) for _ in range(self.DEPTH)]
+
+    def _indexes(self, key):
+        h = hash(key) & 0xffffffff
+        for seed in self.SEEDS:
+            h2 = (h * seed) & 0xffffffff
+            yield (h2 ^ (h2 >> 16)) & self.mask
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.table, self._indexes(key)))
+
+    def increment(self, key):
+        for row, i in zip(self.table, self._indexes(key)):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def reset(self):
+        self.table = [row.translate(self.HALVE) for row in self.table]
+        self.additions //= 2
+
+
+class TinyLFUCache(LRUCache):
+    """
+    A size-bounded cache with a TinyLFU admission policy, which stops scans
+    of rarely used keys from pushing popular ones out.
+
+    New entries go into a small LRU window. Entries evicted from the window
+    are only admitted to the main LRU area if the frequency sketch says
+    they've been used more often than the entries they would displace.
+    """
+
+    def __init__(self, max_bytes, sizeof=len, window_fraction=0.01,
+                 expected_entries=10000):
+        super(TinyLFUCache, self).__init__(max_bytes, sizeof)
+        self.window_bytes = max(1, int(max_bytes * window_fraction))
+        self.main_bytes = max_bytes - self.window_bytes
+        self.current_window_bytes = 0
+        self.rejections = 0
+        self.sketch = FrequencySketch(expected_entries)
+        self._window = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries) + len(self._window)
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._window
+
+    def get(self, key):
+        with self._lock:
+            self.sketch.increment(key)
+
+            for entries in (self._window, self._entries):
+                entry = entries.get(key)
+                if entry is not None:
+                    entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.main_bytes:
+            return False
+
+        with self._lock:
+            self._remove(key)
+
+            self._window[key] = (value, size)
+            self.current_window_bytes += size
+
+            while self.current_window_bytes > self.window_bytes:
+                candidate_key, candidate = self._window.popitem(last=False)
+                self.current_window_bytes -= candidate[1]
+                self._admit(candidate_key, candidate)
+
+        return True
+
+    def _admit(self, key, entry):
+        size = entry[1]
+        needed = self.current_bytes + size - self.main_bytes
+
+        victims = []
+        if needed > 0:
+            frequency = self.sketch.estimate(key)
+            for victim_key, victim in self._entries.items():
+                if self.sketch.estimate(victim_key) >= frequency:
+                    # the candidate isn't more popular than what it would
+                    # replace, so keep what we've got.
+                    self.rejections += 1
+                    return
+                victims.append(victim_key)
+                needed -= victim[1]
+                if needed <= 0:
+                    break
+
+        for victim_key in victims:
+            _, victim_size = self._entries.pop(victim_key)
+            self.current_bytes -= victim_size
+            self.evictions += 1
+
+        self._entries[key] = entry
+        self.current_bytes += size
+
+    def _remove(self, key):
+        old = self._window.pop(key, None)
+        if old is not None:
+            self.current_window_bytes -= old[1]
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old[1]
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._window.clear()
+            self._entries.clear()
+            self.current_window_bytes = 0
+            self.current_bytes = 0
+
+    def stats(self):
+        stats = super(TinyLFUCache, self).stats()
+        stats.update(
+            entries=len(self),
+            bytes=self.current_bytes + self.current_window_bytes,
+            rejections=self.rejections,
+        )
+        return stats
+
+
+class NegativeCache(object):
+    """
+    Remembers keys which are known not to exist, for `ttl` seconds, so that
+    they don't have to be looked up again. Bounded by the number of keys,
+    evicting the oldest first.
+    """
+
+    gauges = ('entries', 'max_entries')
+
+    def __init__(self, max_entries, ttl, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._expiries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def find(self, *keys):
+        """
+        The first of the keys which is known not to exist, or None if none
+        are. Counts as one hit or miss however many keys are given.
+        """
+
+        with self._lock:
+            now = self.clock()
+            for key in keys:
+                expiry = self._expiries.get(key)
+                if expiry is None:
+                    continue
+
+                if expiry <= now:
+                    del self._expiries[key]
+                    continue
+
+                self.hits += 1
+                return key
+
+            self.misses += 1
+            return None
+
+    def add(self, key):
+        with self._lock:
+            self._expiries.pop(key, None)
+            self._expiries[key] = self.clock() + self.ttl
+
+            while len(self._expiries) > self.max_entries:
+                self._expiries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._expiries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._expiries.clear()
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self._expiries),
+            max_entries=self.max_entries,
+        )
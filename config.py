@@ -22,6 +22,57 @@ CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
 CACHE_THRESHOLD = int(os.environ.get('CACHE_THRESHOLD')) if os.environ.get('CACHE_THRESHOLD') else None
 CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX')
 CACHE_DIR = os.environ.get('CACHE_DIR')
+# The size, in bytes, of a metatile cache in a memory-mapped file at SHARED_MEMORY_CACHE_PATH, which all the worker
+# processes on the host share. If set, this is used in place of the cache configured above. Set to 0 to disable it.
+SHARED_MEMORY_CACHE_MAX_BYTES = int(os.environ.get('SHARED_MEMORY_CACHE_MAX_BYTES', '0'))
+SHARED_MEMORY_CACHE_PATH = os.environ.get('SHARED_MEMORY_CACHE_PATH', '/dev/shm/tapalcatl-metatiles')
+# The maximum size, in bytes, of the in-process metatile cache that sits in front of the one configured above. Set to 0 to
+# disable it.
+METATILE_CACHE_MAX_BYTES = int(os.environ.get('METATILE_CACHE_MAX_BYTES', '0'))
+# The maximum size, in bytes, of the in-process cache of tiles, compressed as they're sent to clients. Set to 0 to disable
+# it.
+TILE_CACHE_MAX_BYTES = int(os.environ.get('TILE_CACHE_MAX_BYTES', '0'))
+# How many seconds a cached metatile is fresh for. After this, it's still used, but revalidated with S3 in the background.
+# Set to 0 to never revalidate cached metatiles.
+METATILE_FRESHNESS = int(os.environ.get('METATILE_FRESHNESS', '0'))
+# How many seconds to remember that a metatile, or a tile in a metatile, wasn't found for, so that requests for it can be
+# answered without going to S3. Set to 0 to disable this.
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', '0'))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.environ.get('NEGATIVE_CACHE_MAX_ENTRIES', '100000'))
+# Either 'lru' or 'tinylfu', which only lets new metatiles into the cache if they're likely to be used more often than the
+# ones they would replace. This stops crawlers sweeping through tiles from evicting popular ones.
+METATILE_CACHE_POLICY = os.environ.get('METATILE_CACHE_POLICY', 'lru')
+# After fetching a metatile for a request, prefetch its 8 neighbours and 4 children in the background, for metatiles at
+# zooms from PREFETCH_MIN_ZOOM to PREFETCH_MAX_ZOOM (by default, the zoom of the most detailed metatiles). At most
+# PREFETCH_MAX_PENDING are waiting to be fetched at once, and any more are dropped.
+PREFETCH = os.environ.get('PREFETCH', 'false') == 'true'
+PREFETCH_MAX_PENDING = int(os.environ.get('PREFETCH_MAX_PENDING', '32'))
+PREFETCH_MIN_ZOOM = int(os.environ.get('PREFETCH_MIN_ZOOM', '0'))
+PREFETCH_MAX_ZOOM = int(os.environ.get('PREFETCH_MAX_ZOOM')) if os.environ.get('PREFETCH_MAX_ZOOM') else None
+# Keep a record of the most requested metatiles in HOT_SET_SNAPSHOT, a file, or 'cache' for the cache configured with
+# CACHE_TYPE, saved every HOT_SET_SAVE_INTERVAL seconds. On starting, up to HOT_SET_WARM_COUNT of them are fetched into
+# the caches, stopping after HOT_SET_WARM_MAX_BYTES (by default, the size of the in-process metatile cache) or
+# HOT_SET_WARM_SECONDS. With HOT_SET_WARM_BLOCKING, the app waits for this before taking requests.
+HOT_SET_SNAPSHOT = os.environ.get('HOT_SET_SNAPSHOT')
+HOT_SET_SAVE_INTERVAL = int(os.environ.get('HOT_SET_SAVE_INTERVAL', '300'))
+HOT_SET_WARM_COUNT = int(os.environ.get('HOT_SET_WARM_COUNT', '1000'))
+HOT_SET_WARM_MAX_BYTES = int(os.environ.get('HOT_SET_WARM_MAX_BYTES', str(METATILE_CACHE_MAX_BYTES)))
+HOT_SET_WARM_SECONDS = float(os.environ.get('HOT_SET_WARM_SECONDS', '30'))
+HOT_SET_WARM_BLOCKING = os.environ.get('HOT_SET_WARM_BLOCKING', 'false') == 'true'
+# Send the time taken by each stage of answering a tile request in a Server-Timing header.
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'false') == 'true'
+# Keep histograms of the time taken by each stage of answering tile requests, by layer, zoom and cache outcome, and serve
+# them on /metrics in the Prometheus text format.
+METRICS = os.environ.get('METRICS', 'false') == 'true'
+# Profile requests which have the PROFILE_HEADER header set to PROFILE_TOKEN, and one in every PROFILE_SAMPLE_RATE
+# requests if it's set. Profiles are written to PROFILE_DIR, if it's set, and the ones from the last PROFILE_WINDOW
+# seconds are added up and served on /debug/profile to requests with the token. None of this is set up unless
+# PROFILE_TOKEN or PROFILE_SAMPLE_RATE is set.
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_HEADER = os.environ.get('PROFILE_HEADER', 'X-Tapalcatl-Profile')
+PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_WINDOW = int(os.environ.get('PROFILE_WINDOW', '300'))
 
 TILES_URL_BASE = os.environ.get('TILES_URL_BASE')
 TILES_PREVIEW_API_KEY = os.environ.get('TILES_PREVIEW_API_KEY')
@@ -33,11 +84,42 @@ METATILE_MAX_DETAIL_ZOOM = int(os.environ.get("METATILE_MAX_DETAIL_ZOOM")) if os
 INCLUDE_HASH = os.environ.get("INCLUDE_HASH") == 'true' if os.environ.get("INCLUDE_HASH") else None
 KEY_FORMAT_TYPE = os.environ.get("KEY_FORMAT_TYPE")
 REQUESTER_PAYS = os.environ.get("REQUESTER_PAYS", 'false') == 'true'
+# Use ranged GETs to fetch only the zip index and the requested tile from each metatile, rather than the whole object.
+S3_RANGE_REQUESTS = os.environ.get("S3_RANGE_REQUESTS", 'false') == 'true'
+# If a GET from S3 hasn't responded by this percentile of recent GET latencies, or S3_HEDGE_MIN_DELAY_MS if that's longer,
+# send it again and use whichever responds first. Set to 0 to never send a second GET.
+S3_HEDGE_PERCENTILE = float(os.environ.get("S3_HEDGE_PERCENTILE", '0'))
+S3_HEDGE_MIN_DELAY_MS = float(os.environ.get("S3_HEDGE_MIN_DELAY_MS", '50'))
+# Give up on fetching a metatile from S3, including any retries, after this many milliseconds. Set to 0 for no limit.
+S3_DEADLINE_MS = float(os.environ.get("S3_DEADLINE_MS", '0'))
+# The size of the S3 client's connection pool, and of the pool of threads GETs are sent from when hedging or using a
+# deadline.
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", '50'))
+S3_TCP_KEEPALIVE = os.environ.get("S3_TCP_KEEPALIVE", 'true') == 'true'
+# Timeouts, in seconds, and the total number of attempts for each GET, for the S3 client. These default to botocore's.
+S3_CONNECT_TIMEOUT = float(os.environ.get("S3_CONNECT_TIMEOUT")) if os.environ.get("S3_CONNECT_TIMEOUT") else None
+S3_READ_TIMEOUT = float(os.environ.get("S3_READ_TIMEOUT")) if os.environ.get("S3_READ_TIMEOUT") else None
+S3_MAX_ATTEMPTS = int(os.environ.get("S3_MAX_ATTEMPTS")) if os.environ.get("S3_MAX_ATTEMPTS") else None
+# The number of threads the async server indexes metatiles, extracts and compresses tiles and talks to the shared cache on.
+ASYNC_THREAD_POOL_SIZE = int(os.environ.get("ASYNC_THREAD_POOL_SIZE", '8'))
+# Where to read metatiles from: 's3', for the S3 bucket above, 'local', for a directory with the same layout as the
+# bucket, such as a copy of it synced to local disk, or 'pack', for a pack file built from one with pack.py.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", 's3')
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR")
+PACK_PATH = os.environ.get("PACK_PATH")
 
 COMPRESS_MIMETYPES = [
     'application/x-protobuf',
     'application/json',
 ]
+# Send tiles which are deflated in the metatile to clients that accept gzip without decompressing them, rather than having
+# them decompressed and then compressed again.
+GZIP_PASSTHROUGH = os.environ.get('GZIP_PASSTHROUGH', 'false') == 'true'
+# Give each tile an ETag made from its CRC32 and size, rather than its metatile's ETag, so that rebuilding a metatile only
+# changes the ETags of the tiles which changed.
+TILE_CONTENT_ETAGS = os.environ.get('TILE_CONTENT_ETAGS', 'false') == 'true'
+# The most tiles that can be asked for in one request to the batch endpoints.
+BATCH_MAX_TILES = int(os.environ.get('BATCH_MAX_TILES', '256'))
 
 # Landcover layer is built using Tapalcatl2 archives that require a bit of extra configuration:
 # The maximum zoom level for the landcover data is different than the vector tiles
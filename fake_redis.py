@@ -0,0 +1,62 @@
+"""
+An in-process stand-in for the parts of the redis-py client that the shared
+metatile cache uses, so that it can be tested (and benchmarked) without a
+Redis server.
+"""
+import threading
+import time
+
+
+class FakeRedisClient(object):
+    """
+    Keeps values in memory, ignoring expiry times. Each command, or each
+    pipeline of commands, sleeps for `latency` seconds to simulate the round
+    trip to Redis, and is counted in `round_trips`.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.values = {}
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+    def round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def get(self, name):
+        self.round_trip()
+        return self.values.get(name)
+
+    def exists(self, *names):
+        self.round_trip()
+        return sum(1 for name in names if name in self.values)
+
+    def set(self, name, value, ex=None):
+        self.round_trip()
+        self.values[name] = bytes(value)
+        return True
+
+    def delete(self, *names):
+        self.round_trip()
+        return sum(1 for name in names if self.values.pop(name, None) is not None)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def get(self, name):
+        self.commands.append(lambda: self.client.values.get(name))
+
+    def execute(self):
+        self.client.round_trip()
+        results = [command() for command in self.commands]
+        self.commands = []
+        return results
@@ -0,0 +1,177 @@
+"""
+An in-process stand-in for the parts of the boto3 S3 client that the tile
+server uses, so that storage code can be tested (and benchmarked) without
+talking to S3.
+"""
+import asyncio
+import datetime
+import hashlib
+import random
+import re
+import threading
+import time
+from io import BytesIO
+
+import botocore.exceptions
+
+
+def client_error(code, message=''):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': message}}, 'GetObject')
+
+
+class FakeS3Client(object):
+    """
+    Serves objects from memory with the same responses and error codes as
+    S3's GetObject, including ranges and conditional requests. Counts the
+    number of calls and the number of body bytes returned.
+
+    Each call sleeps for `latency` seconds before responding, to simulate
+    the round trip to S3. This can be a function returning the time to
+    sleep for each call, to simulate a distribution of latencies. Reading
+    the body of each response sleeps for `body_latency` seconds, to
+    simulate a slow transfer, and the bodies are kept in `bodies`. A fraction `error_rate` of calls fail with
+    `error_code`, chosen with `rng`.
+    """
+
+    def __init__(self, latency=0, error_rate=0, error_code='InternalError',
+                 rng=None, body_latency=0):
+        self.latency = latency
+        self.body_latency = body_latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.rng = rng or random.Random(0)
+        self.objects = {}
+        self.get_count = 0
+        self.error_count = 0
+        self.bytes_sent = 0
+        self.calls = []
+        self.bodies = []
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, LastModified=None):
+        if LastModified is None:
+            LastModified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        etag = '"%s"' % hashlib.md5(Body).hexdigest()
+        self.objects[(Bucket, Key)] = (Body, etag, LastModified)
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None,
+                   IfNoneMatch=None, IfModifiedSince=None, RequestPayer=None):
+        latency = self.start_call(Bucket, Key, Range)
+        if latency > 0:
+            time.sleep(latency)
+        return self.respond(Bucket, Key, Range, IfMatch, IfNoneMatch, IfModifiedSince)
+
+    def start_call(self, Bucket, Key, Range):
+        """
+        Count the call, and return how long it should take to respond.
+        """
+
+        with self._lock:
+            self.get_count += 1
+            self.calls.append(dict(Bucket=Bucket, Key=Key, Range=Range))
+
+        return self.latency() if callable(self.latency) else self.latency
+
+    def respond(self, Bucket, Key, Range, IfMatch, IfNoneMatch, IfModifiedSince):
+        if self.error_rate:
+            with self._lock:
+                failed = self.rng.random() < self.error_rate
+                if failed:
+                    self.error_count += 1
+            if failed:
+                raise client_error(self.error_code)
+
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise client_error('NoSuchKey', 'The specified key does not exist.')
+        body, etag, last_modified = obj
+
+        if IfMatch and IfMatch.strip('"') != etag.strip('"'):
+            raise client_error('PreconditionFailed')
+        if IfNoneMatch and IfNoneMatch.strip('"') == etag.strip('"'):
+            raise client_error('304', 'Not Modified')
+        if IfModifiedSince and not IfNoneMatch and last_modified <= IfModifiedSince:
+            raise client_error('304', 'Not Modified')
+
+        response = {
+            'ETag': etag,
+            'LastModified': last_modified,
+        }
+
+        if Range:
+            start, end = self._parse_range(Range, len(body))
+            body = body[start:end + 1]
+            response['ContentRange'] = 'bytes %d-%d/%d' % (
+                start, end, len(self.objects[(Bucket, Key)][0]))
+
+        with self._lock:
+            self.bytes_sent += len(body)
+
+        response['ContentLength'] = len(body)
+        response['Body'] = SlowBody(body, self.body_latency)
+        with self._lock:
+            self.bodies.append(response['Body'])
+        return response
+
+    @staticmethod
+    def _parse_range(header, size):
+        m = re.match(r'^bytes=(\d*)-(\d*)$', header)
+        if not m or (not m.group(1) and not m.group(2)):
+            raise client_error('InvalidRange')
+
+        if not m.group(1):
+            # suffix range: the last N bytes
+            start = max(0, size - int(m.group(2)))
+            end = size - 1
+        else:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+
+        if start >= size:
+            raise client_error('InvalidRange')
+
+        return start, end
+
+
+class SlowBody(BytesIO):
+    def __init__(self, data, latency=0):
+        super(SlowBody, self).__init__(data)
+        self.latency = latency
+
+    def read(self, *args):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return super(SlowBody, self).read(*args)
+
+
+class AsyncStreamingBody(object):
+    def __init__(self, data, latency=0):
+        self.data = data
+        self.latency = latency
+        self.closed = False
+
+    async def read(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return self.data
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncFakeS3Client(FakeS3Client):
+    """
+    The same as FakeS3Client, but with a get_object coroutine, like the
+    client from aiobotocore. The latency is waited for without blocking the
+    event loop.
+    """
+
+    async def get_object(self, Bucket, Key, Range=None, IfMatch=None,
+                         IfNoneMatch=None, IfModifiedSince=None, RequestPayer=None):
+        latency = self.start_call(Bucket, Key, Range)
+        if latency > 0:
+            await asyncio.sleep(latency)
+        response = self.respond(Bucket, Key, Range, IfMatch, IfNoneMatch, IfModifiedSince)
+        response['Body'] = AsyncStreamingBody(response['Body'].getvalue(), self.body_latency)
+        return response
@@ -0,0 +1,251 @@
+"""
+A record of how often each metatile is requested, kept so that the
+in-process caches, which start empty after every restart and in every new
+Lambda container, can be warmed with the most requested metatiles.
+
+The record is saved as a snapshot, either to a file or to the cache
+configured with CACHE_TYPE, every so often and when the process exits.
+When the app starts, the most requested metatiles in the snapshot are
+fetched into the caches, within a budget of bytes and time, and the
+snapshot's counts are carried over, halved, into the new record so that
+it isn't forgotten by processes which haven't seen much traffic yet.
+
+Every worker process saves its own record over the same snapshot, which
+is fine as they see the same traffic.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+# The key the snapshot is kept under when it's kept in the shared cache.
+SNAPSHOT_CACHE_KEY = 'tapalcatl-hot-set'
+# How many metatiles to keep counts for. Once there are more, the less
+# requested half are dropped.
+MAX_ENTRIES = 20000
+# How many requests after starting to count warm-up hits in.
+WARM_UP_WINDOW = 10000
+# How many metatiles to fetch at once while warming up.
+WARM_UP_CONCURRENCY = 8
+# How many metatiles to look up in the shared cache at once while warming up.
+WARM_UP_PRELOAD_BATCH = 64
+
+
+def encode_snapshot(counts):
+    return json.dumps(dict(
+        version=SNAPSHOT_VERSION,
+        metatiles=[list(meta) + [count] for meta, count in counts],
+    ), separators=(',', ':'))
+
+
+def decode_snapshot(data):
+    """
+    The metatiles in a snapshot with their counts, most requested first.
+    A snapshot from a different version is empty.
+    """
+
+    from server import TileRequest
+
+    snapshot = json.loads(data)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return []
+    return [(TileRequest(*entry[:5]), entry[5]) for entry in snapshot['metatiles']]
+
+
+class FileSnapshots(object):
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, data):
+        # written to a temporary file and renamed over the old one, so
+        # readers never see half of it.
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+class CacheSnapshots(object):
+    """
+    Snapshots kept in the flask-caching backend, which needs the app context.
+    """
+
+    def __init__(self, app, cache):
+        self.app = app
+        self.cache = cache
+
+    def load(self):
+        with self.app.app_context():
+            return self.cache.get(SNAPSHOT_CACHE_KEY)
+
+    def save(self, data):
+        with self.app.app_context():
+            self.cache.set(SNAPSHOT_CACHE_KEY, data, timeout=0)
+
+
+class HotSet(object):
+    """
+    Counts of the metatiles requested, saved to `snapshots` every
+    `save_interval` seconds.
+    """
+
+    # the stats which don't count up over the life of the process.
+    gauges = ('warmed', 'warmed_bytes', 'warm_up_seconds')
+
+    def __init__(self, snapshots, save_interval, max_entries=MAX_ENTRIES):
+        self.snapshots = snapshots
+        self.save_interval = save_interval
+        self.max_entries = max_entries
+        self.counts = Counter()
+        self.warmed = set()
+        self.warmed_bytes = 0
+        self.warm_up_seconds = 0.0
+        self.requests_after_start = 0
+        # requests for warmed metatiles, whether or not they were still
+        # cached by then, so this is at most the warm-up's hit ratio.
+        self.requests_for_warmed_after_start = 0
+        self._lock = threading.Lock()
+        self._saver = None
+
+    def record(self, meta):
+        with self._lock:
+            self.counts[meta] += 1
+            if len(self.counts) > self.max_entries:
+                self.counts = Counter(dict(self.counts.most_common(self.max_entries // 2)))
+
+            if self.requests_after_start < WARM_UP_WINDOW:
+                self.requests_after_start += 1
+                if meta in self.warmed:
+                    self.requests_for_warmed_after_start += 1
+
+    def top(self, n):
+        with self._lock:
+            return self.counts.most_common(n)
+
+    def load(self):
+        """
+        Carry the counts over from the snapshot, halved, returning the
+        metatiles in it, most requested first.
+        """
+
+        data = self.snapshots.load()
+        if not data:
+            return []
+        try:
+            entries = decode_snapshot(data)
+        except (ValueError, KeyError, TypeError, IndexError):
+            logger.warning("Ignoring a hot set snapshot which couldn't be read")
+            return []
+
+        with self._lock:
+            for meta, count in entries:
+                if count // 2:
+                    self.counts[meta] += count // 2
+        return [meta for meta, _ in entries]
+
+    def save(self):
+        try:
+            self.snapshots.save(encode_snapshot(self.top(self.max_entries)))
+        except Exception:
+            logger.exception("Error saving the hot set snapshot")
+
+    def start_saving(self):
+        """
+        Save a snapshot every `save_interval` seconds on a thread, and when
+        the process exits.
+        """
+
+        import atexit
+
+        def run():
+            while True:
+                time.sleep(self.save_interval)
+                self.save()
+
+        self._saver = threading.Thread(target=run, name='hot-set-saver', daemon=True)
+        self._saver.start()
+        atexit.register(self.save)
+
+    def warm_up(self, app, metatiles, max_bytes, max_seconds):
+        """
+        Fetch the metatiles into the caches, in order, until they've all
+        been fetched, or `max_bytes` have been fetched, or `max_seconds`
+        have passed. The ones already in the shared cache are copied from
+        there into the in-process cache.
+        """
+
+        from warm import preload_metatiles, warm_metatile
+
+        start = time.time()
+        deadline = start + max_seconds
+
+        def add_warmed(meta, size):
+            with self._lock:
+                self.warmed.add(meta)
+                self.warmed_bytes += size
+
+        def run(meta):
+            try:
+                outcome, size = warm_metatile(app, meta)
+            except Exception:
+                logger.exception("%s: Error warming metatile", meta)
+                return
+            if outcome != 'missing':
+                add_warmed(meta, size)
+
+        def within_budget():
+            return time.time() < deadline and not (max_bytes and self.warmed_bytes >= max_bytes)
+
+        def metatiles_to_fetch():
+            # the ones in the shared cache are copied from it in batches,
+            # rather than being looked up there one at a time.
+            for i in range(0, len(metatiles), WARM_UP_PRELOAD_BATCH):
+                if not within_budget():
+                    return
+                batch = metatiles[i:i + WARM_UP_PRELOAD_BATCH]
+                try:
+                    preloaded = preload_metatiles(app, batch)
+                except Exception:
+                    logger.exception("Error copying metatiles from the shared cache")
+                    preloaded = {}
+                for meta in batch:
+                    if meta in preloaded:
+                        add_warmed(meta, preloaded[meta])
+                    else:
+                        yield meta
+
+        with ThreadPoolExecutor(WARM_UP_CONCURRENCY) as pool:
+            pending = set()
+            for meta in metatiles_to_fetch():
+                if not within_budget():
+                    break
+                if len(pending) >= WARM_UP_CONCURRENCY:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                pending.add(pool.submit(run, meta))
+            wait(pending)
+
+        self.warm_up_seconds = time.time() - start
+        logger.info("Warmed %d metatiles (%.1f MB) from the hot set in %.1fs",
+                    len(self.warmed), self.warmed_bytes / 1e6, self.warm_up_seconds)
+
+    def stats(self):
+        return dict(
+            warmed=len(self.warmed),
+            warmed_bytes=self.warmed_bytes,
+            warm_up_seconds=self.warm_up_seconds,
+            requests_after_start=self.requests_after_start,
+            requests_for_warmed_after_start=self.requests_for_warmed_after_start,
+        )
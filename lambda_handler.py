@@ -0,0 +1,171 @@
+"""
+A Lambda handler for tile requests from API Gateway, from both REST APIs
+and HTTP APIs, which calls the tile serving code directly rather than
+having Zappa turn each event into a WSGI request for the flask app. Set the
+function's handler to `lambda_handler.handler`.
+
+The app, along with its S3 client and in-process caches, is made on the
+first invocation and kept for the warm invocations after it. Requests for
+anything other than tiles are passed on to the flask app.
+
+Response bodies are always base64 encoded, so a REST API needs its binary
+media types set to `*/*` to send them on as they are.
+"""
+import base64
+from urllib.parse import urlencode
+
+from werkzeug.exceptions import HTTPException
+
+from metrics import request_timer, stage
+from server import (
+    TILE_ERRORS,
+    abort_response,
+    best_encoding,
+    call_wsgi,
+    cors_headers,
+    create_app,
+    finish_routed_timer,
+    match_tile_route,
+    parse_routed_tile_request,
+    prefetches_around,
+    retrieve_member,
+    start_routed_timer,
+    text_response,
+    tile_error,
+    tile_headers,
+    wsgi_environ,
+)
+
+app = None
+
+
+def handler(event, context):
+    global app
+    if app is None:
+        app = create_app()
+    return handle_event(app, event)
+
+
+def handle_event(app, event):
+    """
+    Returns the API Gateway response to the event.
+    """
+
+    method, path, query_string, headers, body = parse_event(event)
+
+    route = match_tile_route(path)
+    if route is not None and method in ('GET', 'HEAD'):
+        with app.app_context():
+            status, response_headers, response_body = handle_tile(*route, headers=headers)
+    else:
+        status, response_headers, response_body = call_wsgi(
+            app, wsgi_environ(method, path, query_string, headers, body,
+                              server_name=headers.get('host', 'localhost'),
+                              server_port=443, scheme='https'))
+
+    if method == 'HEAD':
+        response_body = b''
+    return api_gateway_response(event, status, response_headers, response_body)
+
+
+def handle_tile(layer, params, headers):
+    timer = start_routed_timer(layer, params)
+    token = request_timer.set(timer)
+    try:
+        status, response_headers, body = tile_response(layer, params, headers)
+    finally:
+        request_timer.reset(token)
+
+    finish_routed_timer(timer, response_headers)
+    return status, response_headers, body
+
+
+def tile_response(layer, params, headers):
+    try:
+        meta, member_name, conditions = parse_routed_tile_request(layer, params, headers)
+    except HTTPException as e:
+        return with_cors_headers(*abort_response(e))
+
+    try:
+        storage_result = retrieve_member(
+            meta, member_name, conditions, best_encoding(headers.get('accept-encoding')),
+            prefetch=prefetches_around(layer))
+        with stage('response'):
+            return 200, tile_headers(storage_result, params['fmt']), storage_result.data
+    except TILE_ERRORS as e:
+        return with_cors_headers(*text_response(*tile_error(e)))
+
+
+def with_cors_headers(status, headers, body):
+    """
+    The response with the CORS headers flask-cors would add to it, so that
+    browsers see errors as errors rather than as CORS failures.
+    """
+
+    return status, list(headers) + cors_headers(), body
+
+
+def is_http_api_event(event):
+    return event.get('version') == '2.0'
+
+
+def parse_event(event):
+    """
+    Returns the method, path, query string, headers and body of the request
+    in an event from either a REST API (payload format version 1.0) or an
+    HTTP API (version 2.0). The headers have lower case names.
+    """
+
+    if is_http_api_event(event):
+        request_context = event['requestContext']
+        method = request_context['http']['method']
+        path = event['rawPath']
+        # the path includes the stage, unless it's the default one.
+        stage_name = request_context.get('stage')
+        if stage_name and stage_name != '$default' and path.startswith('/%s/' % stage_name):
+            path = path[len(stage_name) + 1:]
+        query_string = event.get('rawQueryString') or ''
+        headers = dict((name.lower(), value) for name, value in (event.get('headers') or {}).items())
+        if event.get('cookies'):
+            headers['cookie'] = '; '.join(event['cookies'])
+
+    else:
+        method = event['httpMethod']
+        path = event['path']
+        if event.get('multiValueHeaders'):
+            headers = dict((name.lower(), ', '.join(values))
+                           for name, values in event['multiValueHeaders'].items())
+        else:
+            headers = dict((name.lower(), value) for name, value in (event.get('headers') or {}).items())
+        params = event.get('multiValueQueryStringParameters') or dict(
+            (name, [value]) for name, value in (event.get('queryStringParameters') or {}).items())
+        query_string = urlencode([(name, value) for name, values in params.items() for value in values])
+
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    else:
+        body = body.encode('utf8')
+
+    return method, path, query_string, headers, body
+
+
+def api_gateway_response(event, status, headers, body):
+    response = {
+        'statusCode': status,
+        'body': base64.b64encode(body).decode('ascii'),
+        'isBase64Encoded': True,
+    }
+
+    if is_http_api_event(event):
+        joined = {}
+        for name, value in headers:
+            joined[name] = joined[name] + ', ' + value if name in joined else value
+        response['headers'] = joined
+    else:
+        multi_value = {}
+        for name, value in headers:
+            multi_value.setdefault(name, []).append(value)
+        response['multiValueHeaders'] = multi_value
+
+    return response
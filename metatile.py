@@ -0,0 +1,208 @@
+import gzip
+import struct
+import zlib
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The content encodings that encode_member can produce, best first.
+CONTENT_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+# Layouts of the zip records we need, see section 4.3 of
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+END_OF_CENTRAL_DIR = struct.Struct('<4s4H2LH')
+END_OF_CENTRAL_DIR_SIGNATURE = b'PK\005\006'
+CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+CENTRAL_DIR_SIGNATURE = b'PK\001\002'
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+
+# A gzip member header with no name, timestamp or flags. Followed by raw
+# deflate data and a trailer, it makes a valid gzip file. See RFC 1952.
+GZIP_HEADER = b'\037\213\010\000\000\000\000\000\000\377'
+GZIP_TRAILER = struct.Struct('<2L')
+
+# The end of central directory record is followed by a comment of at most
+# 64KiB, so this is the furthest from the end of the file it can start.
+MAX_END_OF_CENTRAL_DIR_SEARCH = END_OF_CENTRAL_DIR.size + 0xffff
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Where a member lives in the archive and how to decode it. The offset is
+# that of the member's local file header, not of its data.
+ZipMember = namedtuple('ZipMember', ['offset', 'compressed_size', 'size', 'method', 'crc'])
+
+
+class BadMetatileException(Exception):
+    pass
+
+
+def find_central_directory(tail, tail_offset=0):
+    """
+    Locate the central directory using the end of central directory record
+    found in `tail`, which must be the last bytes of the archive and start
+    at byte `tail_offset` in it. Returns the offset and size of the central
+    directory, and the number of bytes prepended to the archive, which
+    must be added to all the offsets recorded in it.
+    """
+
+    pos = tail.rfind(END_OF_CENTRAL_DIR_SIGNATURE)
+    if pos < 0 or len(tail) - pos < END_OF_CENTRAL_DIR.size:
+        raise BadMetatileException("No end of central directory record found")
+
+    (_, _, _, _, entries, cd_size, cd_offset, _) = \
+        END_OF_CENTRAL_DIR.unpack_from(tail, pos)
+
+    if entries == 0xffff or cd_size == 0xffffffff or cd_offset == 0xffffffff:
+        raise BadMetatileException("Zip64 metatiles are not supported")
+
+    # archives with data prepended to them will have the whole central
+    # directory shifted along.
+    concat = tail_offset + pos - cd_size - cd_offset
+    if concat < 0:
+        raise BadMetatileException("Bad central directory offset")
+
+    return cd_offset + concat, cd_size, concat
+
+
+def parse_central_directory(cd, base_offset=0):
+    """
+    Parse the central directory bytes into an index mapping member name to
+    a ZipMember. `base_offset` is added to each member's offset, for
+    archives which have had data prepended to them.
+    """
+
+    index = {}
+    pos = 0
+    end = len(cd)
+
+    while pos + CENTRAL_DIR.size <= end:
+        (sig, _, _, _, _, flags, method, _, _, crc, compressed_size, size,
+         name_len, extra_len, comment_len, _, _, _, offset) = \
+            CENTRAL_DIR.unpack_from(cd, pos)
+
+        if sig != CENTRAL_DIR_SIGNATURE:
+            raise BadMetatileException("Bad central directory entry at %d" % pos)
+        if flags & 0x1:
+            raise BadMetatileException("Encrypted metatiles are not supported")
+
+        pos += CENTRAL_DIR.size
+        name = cd[pos:pos + name_len]
+        name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+        pos += name_len + extra_len + comment_len
+
+        index[name] = ZipMember(offset + base_offset, compressed_size, size, method, crc)
+
+    return index
+
+
+def build_index(metatile_bytes):
+    """
+    Build the member index for a whole metatile held in memory.
+    """
+
+    tail_offset = max(0, len(metatile_bytes) - MAX_END_OF_CENTRAL_DIR_SEARCH)
+    cd_offset, cd_size, concat = find_central_directory(
+        metatile_bytes[tail_offset:], tail_offset)
+
+    return parse_central_directory(
+        metatile_bytes[cd_offset:cd_offset + cd_size], concat)
+
+
+def member_data_offset(buf, header_offset):
+    """
+    Returns the offset of the member data following the local file header
+    at `header_offset` in `buf`.
+    """
+
+    if buf[header_offset:header_offset + 4] != LOCAL_HEADER_SIGNATURE:
+        raise BadMetatileException("Bad local file header at %d" % header_offset)
+
+    name_len, extra_len = struct.unpack_from('<2H', buf, header_offset + 26)
+    return header_offset + LOCAL_HEADER.size + name_len + extra_len
+
+
+def raw_member(buf, member, header_offset=None):
+    """
+    Returns the raw, possibly still compressed, bytes of the member. The
+    local file header is expected at `header_offset` in `buf`, which
+    defaults to the member's own offset.
+    """
+
+    if header_offset is None:
+        header_offset = member.offset
+
+    start = member_data_offset(buf, header_offset)
+    raw = buf[start:start + member.compressed_size]
+    if len(raw) != member.compressed_size:
+        raise BadMetatileException("Truncated member data at %d" % start)
+    return raw
+
+
+def decode_member(raw, member):
+    """
+    Decompress the raw bytes of a member and check them against its CRC.
+    """
+
+    if member.method == ZIP_STORED:
+        data = bytes(raw)
+    elif member.method == ZIP_DEFLATED:
+        data = zlib.decompress(raw, -zlib.MAX_WBITS)
+    else:
+        raise BadMetatileException("Unsupported compression method %d" % member.method)
+
+    if zlib.crc32(data) & 0xffffffff != member.crc:
+        raise BadMetatileException("Bad CRC-32 for member data")
+
+    return data
+
+
+def read_member(buf, member, header_offset=None):
+    return decode_member(raw_member(buf, member, header_offset), member)
+
+
+def gzip_member(raw, member):
+    """
+    Wrap the raw data of a deflated member as gzip, using the CRC and size
+    from the index rather than inflating the data.
+    """
+
+    if member.method != ZIP_DEFLATED:
+        raise BadMetatileException("Only deflated members can be wrapped as gzip")
+
+    return b''.join((
+        GZIP_HEADER,
+        raw,
+        GZIP_TRAILER.pack(member.crc, member.size & 0xffffffff),
+    ))
+
+
+def encode_member(raw, member, content_encoding=None, compress_level=6,
+                  brotli_quality=4, min_size=0):
+    """
+    Returns the data of a member, in the requested content encoding if
+    possible, along with the content encoding it ended up in: 'gzip', 'br'
+    or None for uncompressed data.
+
+    Deflated members are wrapped as gzip without decompressing them. Other
+    members are only compressed if they're at least `min_size` bytes.
+    """
+
+    if content_encoding == 'gzip' and member.method == ZIP_DEFLATED:
+        return gzip_member(raw, member), 'gzip'
+
+    data = decode_member(raw, member)
+    if len(data) < min_size:
+        return data, None
+
+    if content_encoding == 'gzip':
+        return gzip.compress(data, compresslevel=compress_level), 'gzip'
+    elif content_encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=brotli_quality), 'br'
+
+    return data, None
@@ -0,0 +1,250 @@
+"""
+Timing of the stages of each request, reported in a Server-Timing header,
+and histograms and counters of them in the Prometheus text format, without
+needing the Prometheus client library.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, has_request_context
+
+# Upper bounds, in seconds, of the buckets of the duration histograms.
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0)
+
+# What the cache outcome of a request is, when several things happened
+# during it. Later ones win, so a request that hit the cache for the index
+# but had to fetch the tile from storage is a miss.
+CACHE_OUTCOMES = ('none', 'hit', 'negative', 'miss')
+
+# The timer for requests handled by the async server, which don't have a
+# flask request context to keep it in.
+request_timer = ContextVar('request_timer', default=None)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for name, value in zip(names, values))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.label_names), 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('%s%s %s' % (
+                    self.name, format_labels(self.label_names, key), format_value(value)))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, label_names=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # for each set of label values, the count in each bucket (not
+        # cumulative), and the sum of the observations.
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts[0][i] += 1
+            counts[1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(tuple(labels[name] for name in self.label_names))
+        return sum(counts[0]) if counts else 0
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        names = self.label_names + ('le',)
+        with self._lock:
+            for key, (buckets, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, buckets):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        self.name, format_labels(names, key + (format_value(bound),)), cumulative))
+                labels = format_labels(self.label_names, key)
+                lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+                lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class StatsCounters(object):
+    """
+    Counters read from a function returning a dict of counts, like the
+    stats() methods of the caches and storage backends. The stats named in
+    `gauges` are point-in-time values, such as sizes, and are served as
+    gauges instead.
+    """
+
+    def __init__(self, prefix, description, stats, gauges=()):
+        self.prefix = prefix
+        self.description = description
+        self.stats = stats
+        self.gauges = frozenset(gauges)
+
+    def render(self):
+        lines = []
+        for name, value in sorted(self.stats().items()):
+            if name in self.gauges:
+                metric, metric_type = '%s_%s' % (self.prefix, name), 'gauge'
+            else:
+                metric, metric_type = '%s_%s_total' % (self.prefix, name), 'counter'
+            lines.append('# HELP %s %s %s.' % (metric, self.description, name.replace('_', ' ')))
+            lines.append('# TYPE %s %s' % (metric, metric_type))
+            lines.append('%s %s' % (metric, format_value(value)))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTimer(object):
+    """
+    The time taken by each stage of a request. Stages which happen more
+    than once in a request have their times added up.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.layer = None
+        self.zoom = None
+        self.cache_outcome = 'none'
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def record_cache_outcome(self, outcome):
+        if CACHE_OUTCOMES.index(outcome) > CACHE_OUTCOMES.index(self.cache_outcome):
+            self.cache_outcome = outcome
+
+    def server_timing(self, total):
+        parts = ['%s;dur=%.2f' % (stage, seconds * 1000)
+                 for stage, seconds in self.stages.items()]
+        parts.append('total;dur=%.2f' % (total * 1000))
+        return ', '.join(parts)
+
+
+def current_timer():
+    if has_request_context():
+        return g.get('request_timer')
+    return request_timer.get()
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the code in the block as a stage of the current request, if it's
+    being timed.
+    """
+
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def record_stage(name, seconds):
+    """
+    Record a stage of the current request, if it's being timed, which was
+    timed somewhere else, such as on a thread pool.
+    """
+
+    timer = current_timer()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+def record_cache_outcome(outcome):
+    timer = current_timer()
+    if timer is not None:
+        timer.record_cache_outcome(outcome)
+
+
+class TileMetrics(object):
+    """
+    The metrics kept for tile requests.
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.request_duration = self.registry.add(Histogram(
+            'tapalcatl_tile_request_duration_seconds',
+            'Time taken to answer tile requests.',
+            ('layer', 'zoom', 'cache'),
+        ))
+        self.stage_duration = self.registry.add(Histogram(
+            'tapalcatl_tile_stage_duration_seconds',
+            'Time taken by each stage of answering tile requests.',
+            ('layer', 'zoom', 'cache', 'stage'),
+        ))
+
+    def observe(self, timer, total):
+        labels = dict(layer=timer.layer, zoom=timer.zoom, cache=timer.cache_outcome)
+        self.request_duration.observe(total, **labels)
+        for name, seconds in timer.stages.items():
+            self.stage_duration.observe(seconds, stage=name, **labels)
+
+    def add_stats(self, prefix, description, stats, gauges=()):
+        self.registry.add(StatsCounters(prefix, description, stats, gauges))
+
+    def render(self):
+        return self.registry.render()
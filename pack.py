@@ -0,0 +1,310 @@
+"""
+A single file holding the tiles of many metatiles, so that they can be
+served without the per-object overhead of a tree of zips. Build one from a
+tree of metatiles laid out like the S3 bucket with:
+
+    python pack.py SOURCE_DIR PACK_FILE --prefix PREFIX --layer all
+
+A pack is a header, followed by the index, followed by the raw data of the
+tiles, as they were stored in the metatiles. The index has one fixed size
+entry per tile, sorted by its key, so a tile can be found by a binary
+search of the memory mapped file and read with a single slice of it.
+
+The key is the metatile's z, x and y, and the tile's name in the metatile,
+packed big endian and padded with zeros, so that sorting the keys as bytes
+sorts them by metatile and then by name.
+"""
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+
+from metatile import ZipMember, build_index, raw_member
+from metrics import stage
+from storage import (
+    KeyFormatType,
+    LocalStorage,
+    MetatileChangedException,
+    MetatileNotFoundException,
+    MetatileNotModifiedException,
+    StorageResponse,
+    UnknownMetatileException,
+    compute_key,
+    is_not_modified,
+)
+
+PACK_MAGIC = b'TZPACK\r\n'
+PACK_VERSION = 1
+# magic, version, length of the names in the keys, number of entries.
+PACK_HEADER = struct.Struct('<8sHHQ')
+# The longest tile name in a metatile that fits in a key, such as
+# '2/1/3.mvt' or '15/12345/23456@2x.topojson'.
+NAME_SIZE = 32
+META_KEY = struct.Struct('>B2L')
+KEY_SIZE = META_KEY.size + NAME_SIZE
+# offset and length of the raw data, uncompressed size, CRC-32 and zip
+# compression method.
+ENTRY_VALUE = struct.Struct('<Q3LH')
+ENTRY_SIZE = KEY_SIZE + ENTRY_VALUE.size
+
+
+class BadPackException(Exception):
+    pass
+
+
+def meta_key(meta):
+    return META_KEY.pack(meta.z, meta.x, meta.y)
+
+
+def entry_key(meta, member_name):
+    name = member_name.encode('utf8')
+    if len(name) > NAME_SIZE:
+        raise ValueError("Tile name %r is too long for a pack" % member_name)
+    return meta_key(meta) + name.ljust(NAME_SIZE, b'\0')
+
+
+class PackKeys(object):
+    """
+    The keys of the index of a pack, as a sequence that bisect can search.
+    """
+
+    def __init__(self, buf, count):
+        self.buf = buf
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        pos = PACK_HEADER.size + i * ENTRY_SIZE
+        return self.buf[pos:pos + KEY_SIZE]
+
+
+class PackFile(object):
+    """
+    A memory mapped pack.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.cache_info = LocalStorage.file_cache_info(os.fstat(f.fileno()))
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.buf) < PACK_HEADER.size:
+            raise BadPackException("Pack too short for header")
+        magic, version, name_size, count = PACK_HEADER.unpack_from(self.buf, 0)
+        if magic != PACK_MAGIC:
+            raise BadPackException("Not a pack")
+        if version != PACK_VERSION or name_size != NAME_SIZE:
+            raise BadPackException("Unsupported pack version %d" % version)
+        if len(self.buf) < PACK_HEADER.size + count * ENTRY_SIZE:
+            raise BadPackException("Pack too short for index")
+
+        self.keys = PackKeys(self.buf, count)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def has_metatile(self, meta):
+        prefix = meta_key(meta)
+        i = bisect.bisect_left(self.keys, prefix)
+        return i < len(self.keys) and self.keys[i][:META_KEY.size] == prefix
+
+    def find(self, meta, member_name):
+        """
+        Returns the ZipMember for the tile, with the offset of its raw data
+        rather than of a local header, or None if it isn't in the pack.
+        """
+
+        key = entry_key(meta, member_name)
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+
+        pos = PACK_HEADER.size + i * ENTRY_SIZE + KEY_SIZE
+        offset, compressed_size, size, crc, method = \
+            ENTRY_VALUE.unpack_from(self.buf, pos)
+        return ZipMember(offset, compressed_size, size, method, crc)
+
+    def read(self, member):
+        return self.buf[member.offset:member.offset + member.compressed_size]
+
+
+class PackIndex(object):
+    """
+    The index of a single metatile in a pack, which can be used in place of
+    the dict from build_index.
+    """
+
+    def __init__(self, pack, meta):
+        self.pack = pack
+        self.meta = meta
+
+    def __getitem__(self, member_name):
+        try:
+            member = self.pack.find(self.meta, member_name)
+        except ValueError:
+            member = None
+        if member is None:
+            raise KeyError(member_name)
+        return member
+
+
+class PackStorage(object):
+    """
+    Reads tiles from a pack file. The pack is opened again if it's replaced,
+    which should be done by renaming a new pack over it. The ETag and
+    Last-Modified of every tile are those of the pack file.
+
+    There are no whole metatiles in a pack, so there's no `get`, and tiles
+    are always read with get_index and read_member.
+    """
+
+    cacheable = False
+    reads_members = True
+
+    def __init__(self, path):
+        self.path = path
+        self.pack = None
+
+    def location(self, meta):
+        return "%s#%d/%d/%d" % (self.path, meta.z, meta.x, meta.y)
+
+    def start_deadline(self):
+        return None
+
+    def current_pack(self):
+        try:
+            cache_info = LocalStorage.file_cache_info(os.stat(self.path))
+        except FileNotFoundError:
+            raise UnknownMetatileException("No pack found at %s" % self.path)
+
+        pack = self.pack
+        if pack is None or pack.cache_info.etag != cache_info.etag:
+            try:
+                pack = PackFile(self.path)
+            except (OSError, BadPackException) as e:
+                raise UnknownMetatileException("%s at %s" % (e, self.path))
+            self.pack = pack
+        return pack
+
+    def get_index(self, meta, cache_info, deadline=None):
+        pack = self.current_pack()
+
+        if cache_info and is_not_modified(cache_info, pack.cache_info):
+            raise MetatileNotModifiedException()
+
+        with stage('pack_index'):
+            found = pack.has_metatile(meta)
+        if not found:
+            raise MetatileNotFoundException(
+                "No metatile found at %s" % self.location(meta))
+
+        return StorageResponse(
+            data=None,
+            cache_info=pack.cache_info,
+            index=PackIndex(pack, meta),
+            fetched_at=time.time(),
+        )
+
+    def read_member(self, meta, member, member_name, etag, deadline=None):
+        pack = self.current_pack()
+        if pack.cache_info.etag != etag:
+            raise MetatileChangedException("Pack changed at %s" % self.path)
+        return pack.read(member)
+
+
+def find_metatiles(root, prefix, layer, key_format_type):
+    """
+    Yields the metatile coordinates and path of each metatile under `root`
+    which is where compute_key says it should be.
+    """
+
+    from server import TileRequest
+
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            parts = os.path.relpath(path, root).split(os.sep)
+            if len(parts) < 3 or not filename.endswith('.zip'):
+                continue
+
+            try:
+                meta = TileRequest(int(parts[-3]), int(parts[-2]),
+                                   int(filename[:-len('.zip')]), 1, 'zip')
+            except ValueError:
+                continue
+
+            if compute_key(prefix, layer, meta, key_format_type) == '/'.join(parts):
+                yield meta, path
+
+
+def build_pack(root, out_path, prefix, layer,
+               key_format_type=KeyFormatType.PREFIX_HASH):
+    """
+    Build a pack of all the tiles in the metatiles under `root`, laid out
+    as compute_key says. The raw tile data is copied as it is, so deflated
+    tiles are still deflated in the pack. Returns the number of tiles.
+    """
+
+    metatiles = sorted(find_metatiles(root, prefix, layer, key_format_type))
+
+    # the offsets of the data depend on the size of the index, so find all
+    # the entries before writing any data.
+    entries = []
+    for meta, path in metatiles:
+        with open(path, 'rb') as f:
+            index = build_index(f.read())
+        for name, member in sorted(index.items()):
+            if name.endswith('/'):
+                continue
+            entries.append((entry_key(meta, name), path, member))
+
+    entries.sort(key=lambda entry: entry[0])
+
+    offset = PACK_HEADER.size + len(entries) * ENTRY_SIZE
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, NAME_SIZE, len(entries)))
+        for key, _, member in entries:
+            out.write(key)
+            out.write(ENTRY_VALUE.pack(
+                offset, member.compressed_size, member.size, member.crc, member.method))
+            offset += member.compressed_size
+
+        # entries are sorted by metatile first, so each one is read once.
+        current_path, data = None, None
+        for _, path, member in entries:
+            if path != current_path:
+                with open(path, 'rb') as f:
+                    current_path, data = path, f.read()
+            out.write(raw_member(data, member))
+
+    # replace any existing pack in one go, so that servers reading it see
+    # either the old one or the new one.
+    os.replace(tmp_path, out_path)
+
+    return len(entries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a pack from a tree of metatiles.")
+    parser.add_argument('root', help="Directory laid out like the S3 bucket.")
+    parser.add_argument('out', help="Pack file to write.")
+    parser.add_argument('--prefix', default=None)
+    parser.add_argument('--layer', default='all')
+    parser.add_argument('--key-format-type', default='PREFIX_HASH',
+                        choices=[t.name for t in KeyFormatType])
+    args = parser.parse_args(argv)
+
+    a = time.time()
+    count = build_pack(args.root, args.out, args.prefix, args.layer,
+                       KeyFormatType[args.key_format_type])
+    print("Packed %d tiles into %s in %0.1fs" % (count, args.out, time.time() - a))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Prefetching of the metatiles around one which was just fetched, as clients
+panning and zooming the map are likely to ask for them next.
+
+The prefetches run on a small pool of threads of their own, so they wait
+behind each other rather than taking threads from requests, and are
+dropped rather than queued once a budget of them are pending. A metatile
+is only prefetched once at a time.
+
+Requests for a prefetched metatile count as prefetch hits, so the
+precision of prefetching at each zoom is the number of hits over the
+number of metatiles fetched, both of which are kept as a metric.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Counter
+
+# How many prefetched metatiles to remember, to count hits on them.
+TRACKED_PREFETCHES = 10000
+
+
+class Prefetcher(object):
+    """
+    Prefetches the 8 neighbours and 4 children of metatiles, for metatiles
+    at zooms from `min_zoom` to `max_zoom`, keeping at most `max_pending`
+    queued or running on `threads` threads.
+    """
+
+    def __init__(self, max_pending, min_zoom, max_zoom, threads=2):
+        self.max_pending = max_pending
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.pending = set()
+        self.prefetched = OrderedDict()
+        self.outcomes = Counter(
+            'tapalcatl_prefetch_total',
+            'Metatiles considered for prefetching, by zoom and by whether they were '
+            'fetched, already cached, missing, failed, dropped over budget or later requested (hit).',
+            ('zoom', 'outcome'),
+        )
+        self._lock = threading.Lock()
+
+    def targets(self, meta):
+        """
+        The neighbours and children of the metatile which are in range.
+        """
+
+        targets = []
+        if self.min_zoom <= meta.z <= self.max_zoom:
+            n = 1 << meta.z
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    x, y = meta.x + dx, meta.y + dy
+                    if (dx or dy) and 0 <= x < n and 0 <= y < n:
+                        targets.append(meta._replace(x=x, y=y))
+        if self.min_zoom <= meta.z + 1 <= self.max_zoom:
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    targets.append(meta._replace(z=meta.z + 1, x=meta.x * 2 + dx, y=meta.y * 2 + dy))
+        return targets
+
+    def prefetch_around(self, meta, fetch):
+        """
+        Queue prefetches of the metatiles around `meta`. `fetch` is called
+        with each one on the prefetch threads, and returns whether it was
+        'fetched', already 'cached' or 'missing'.
+        """
+
+        for target in self.targets(meta):
+            with self._lock:
+                if target in self.pending:
+                    continue
+                if len(self.pending) >= self.max_pending:
+                    self.outcomes.inc(zoom=target.z, outcome='dropped')
+                    continue
+                self.pending.add(target)
+            self.pool.submit(self.run, target, fetch)
+
+    def run(self, meta, fetch):
+        try:
+            outcome = fetch(meta)
+        except Exception:
+            outcome = 'error'
+        finally:
+            with self._lock:
+                self.pending.discard(meta)
+
+        if outcome == 'fetched':
+            with self._lock:
+                self.prefetched[meta] = True
+                if len(self.prefetched) > TRACKED_PREFETCHES:
+                    self.prefetched.popitem(last=False)
+        self.outcomes.inc(zoom=meta.z, outcome=outcome)
+
+    def requested(self, meta):
+        """
+        Count a hit if the metatile requested was prefetched.
+        """
+
+        with self._lock:
+            hit = self.prefetched.pop(meta, None) is not None
+        if hit:
+            self.outcomes.inc(zoom=meta.z, outcome='hit')
+
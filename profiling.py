@@ -0,0 +1,137 @@
+"""
+Profiling of individual requests in production. Requests are profiled when
+they have the PROFILE_HEADER header set to PROFILE_TOKEN, or one in every
+PROFILE_SAMPLE_RATE of them is. The profiles are written to PROFILE_DIR as
+pstats files, and those from the last PROFILE_WINDOW seconds are added up
+and served on /debug/profile to requests with the token.
+
+Nothing is hooked into the app unless one of these is configured.
+"""
+import cProfile
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import threading
+import time
+from collections import deque
+
+# the orders the report on /debug/profile can be sorted in.
+SORT_KEYS = sorted(key.value for key in pstats.SortKey)
+
+
+class RequestProfiler(object):
+    """
+    Decides which requests to profile, and keeps their profiles.
+    """
+
+    def __init__(self, token=None, sample_rate=0, directory=None, window=60,
+                 max_profiles=1000, clock=time.time):
+        self.token = token
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.window = window
+        self.clock = clock
+        self._counter = itertools.count()
+        self._profiles = deque(maxlen=max_profiles)
+        self._profiles_lock = threading.Lock()
+        # only one profiler can be running at a time in newer versions of
+        # python, so requests that would overlap with one aren't profiled.
+        self._running = threading.Lock()
+
+    def authorized(self, header_value):
+        if not self.token:
+            return False
+        # compared in constant time, so that the token can't be guessed from
+        # how long it takes to be turned down.
+        return hmac.compare_digest((header_value or '').encode('utf8'), self.token.encode('utf8'))
+
+    def wanted(self, header_value):
+        if self.authorized(header_value):
+            return True
+        return bool(self.sample_rate) and next(self._counter) % self.sample_rate == 0
+
+    def start(self):
+        """
+        Start a profile, returning it, or None if another one is running.
+        """
+
+        if not self._running.acquire(False):
+            return None
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # some other profiling tool is active.
+            self._running.release()
+            return None
+        return profile
+
+    def finish(self, profile, name):
+        """
+        Stop the profile and keep it, returning the path it was written to,
+        if any.
+        """
+
+        try:
+            profile.disable()
+        finally:
+            self._running.release()
+
+        profile.create_stats()
+        now = self.clock()
+        with self._profiles_lock:
+            self._profiles.append((now, profile))
+
+        if not self.directory:
+            return None
+
+        path = os.path.join(self.directory, '%d-%s.pstats' % (
+            now * 1000, name.replace('/', '_').strip('_') or 'request'))
+        profile.dump_stats(path)
+        return path
+
+    def recent(self):
+        cutoff = self.clock() - self.window
+        with self._profiles_lock:
+            while self._profiles and self._profiles[0][0] < cutoff:
+                self._profiles.popleft()
+            return [profile for _, profile in self._profiles]
+
+    def aggregate(self):
+        """
+        The profiles from the last `window` seconds added together, or None
+        if there aren't any.
+        """
+
+        profiles = self.recent()
+        if not profiles:
+            return None
+
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def report(self, sort='cumulative', limit=50):
+        stats = self.aggregate()
+        if stats is None:
+            return "No profiles in the last %d seconds.\n" % self.window
+
+        out = io.StringIO()
+        out.write("%d profiles in the last %d seconds.\n" % (len(self.recent()), self.window))
+        stats.stream = out
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump(self):
+        """
+        The aggregate profile in the binary pstats format, for tools like
+        snakeviz.
+        """
+
+        stats = self.aggregate()
+        return marshal.dumps(stats.stats if stats is not None else {})
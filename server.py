@@ -1,44 +1,81 @@
-import boto3
-import botocore
-import dateutil.parser
-import hashlib
+import datetime
+import email.utils
 import logging
 import math
+import os
+import re
+import sys
+import threading
 import time
-import zipfile
 from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from flask import Blueprint, Flask, current_app, make_response, render_template, request, abort
+from flask import (
+    Blueprint, Flask, current_app, g, make_response, render_template, request, abort,
+    stream_with_context,
+)
 from flask_caching import Cache
 from flask_compress import Compress
 from flask_cors import CORS
-
-# make compatible with both 3.4+, which has enum built in, and <=3.3 which
-# doesn't.
-try:
-    from enum import Enum
-except ImportError:
-    from enum34 import Enum
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import http_date, parse_accept_header, quote_etag
+from cache_codec import make_shared_cache
+from caches import LRUCache, NegativeCache, TinyLFUCache
+from metatile import CONTENT_ENCODINGS, build_index, encode_member, raw_member, read_member
+from metrics import RequestTimer, TileMetrics, current_timer, record_cache_outcome, stage
+from singleflight import SingleFlight
+from storage import (
+    CacheInfo,
+    KeyFormatType,
+    LocalStorage,
+    MetatileChangedException,
+    MetatileNotFoundException,
+    MetatileNotModifiedException,
+    S3Storage,
+    StorageResponse,
+    UnknownMetatileException,
+    compute_key,
+    configured_key_format_type,
+    is_not_modified,
+)
 
 
 tile_bp = Blueprint('tiles', __name__)
 cache = Cache()
+# concurrent requests for tiles in the same metatile share a single fetch of it
+# from storage. the counters on this say how many fetches were saved.
+metatile_flights = SingleFlight()
+# stale cached metatiles are revalidated with storage in the background, at most
+# once at a time for each one.
+revalidation_pool = ThreadPoolExecutor(max_workers=4)
+revalidations = set()
+revalidations_lock = threading.Lock()
+
 
+def create_app(**config):
+    """
+    Make the app, configured from config.py, with any settings in `config`
+    overriding those.
+    """
 
-def create_app():
     app = Flask(__name__)
     app.config.from_object('config')
+    app.config.update(config)
     CORS(app)
     Compress(app)
-    cache.init_app(app)
-    app.boto_s3 = boto3.client('s3')
-
-    @app.before_first_request
-    def setup_logging():
-        if not app.debug:
-            # In production mode, add log handler to sys.stderr.
-            app.logger.addHandler(logging.StreamHandler())
-            app.logger.setLevel(logging.INFO)
+    init_cache(app)
+    init_caches(app)
+    init_storage(app)
+    init_prefetch(app)
+    init_hot_set(app)
+    init_metrics(app)
+    init_profiling(app)
+
+    if not app.debug:
+        # In production mode, add log handler to sys.stderr.
+        app.logger.addHandler(logging.StreamHandler())
+        app.logger.setLevel(logging.INFO)
 
     app.register_blueprint(tile_bp)
 
@@ -52,23 +89,33 @@ MIME_TYPES = {
     "topojson": "application/json",
 }
 TileRequest = namedtuple('TileRequest', ['z', 'x', 'y', 'scale', 'format'])
-CacheInfo = namedtuple('CacheInfo', ['last_modified', 'etag'])
-StorageResponse = namedtuple('StorageResponse', ['data', 'cache_info'])
+# The most detailed zoom of vector tiles.
+MAX_ZOOM = 17
+# The conditions of a request without any conditional headers.
+NO_CONDITIONS = CacheInfo(last_modified=None, etag=None)
+# The encoding added to the end of an ETag in If-None-Match, inside any quotes.
+ETAG_ENCODING = re.compile(r':[a-z0-9-]+(?="?$)')
 
 
-class MetatileNotModifiedException(Exception):
-    pass
+# Rough number of bytes of memory used by each entry of a metatile index.
+INDEX_ENTRY_SIZE = 200
+# Typical size of a metatile, used to estimate how many entries the metatile
+# cache will hold.
+TYPICAL_METATILE_SIZE = 64 * 1024
+# Rough number of bytes of memory used by each entry of the tile cache, on top
+# of the tile data.
+TILE_ENTRY_SIZE = 300
 
 
-class MetatileNotFoundException(Exception):
+class TileNotFoundInMetatile(Exception):
     pass
 
 
-class UnknownMetatileException(Exception):
+class CachedMetatileNotFoundException(MetatileNotFoundException):
     pass
 
 
-class TileNotFoundInMetatile(Exception):
+class CachedTileNotFoundInMetatile(TileNotFoundInMetatile):
     pass
 
 
@@ -136,224 +183,1309 @@ def meta_and_offset(requested_tile, meta_size,
     return meta, offset
 
 
-class KeyFormatType(Enum):
+def storage_response_size(response):
+    """
+    Approximate number of bytes of memory used by a StorageResponse.
     """
-    S3 key format options; either no hash, the hash followed by the prefix, or
-    the prefix followed by the hash. For example, for metatile 10/511/430 in
-    the 'all' layer:
 
-     * no_hash:     /180723/all/10/511/430.zip
-     * hash_prefix: /0035e/180723/all/10/511/430.zip
-     * prefix_hash: /180723/0035e/all/10/511/430.zip
+    size = len(response.data) if response.data is not None else 0
+    if response.index:
+        size += len(response.index) * INDEX_ENTRY_SIZE
+    return size
+
+
+def encoded_tile_size(encoded):
+    return len(encoded[0]) + TILE_ENTRY_SIZE
+
+
+# The flask-caching backends by the names older versions of it knew them by,
+# which are the ones that CACHE_TYPE is documented with.
+CACHE_BACKENDS = {
+    'null': 'NullCache',
+    'simple': 'SimpleCache',
+    'filesystem': 'FileSystemCache',
+    'redis': 'RedisCache',
+    'redissentinel': 'RedisSentinelCache',
+    'rediscluster': 'RedisClusterCache',
+    'memcached': 'MemcachedCache',
+    'saslmemcached': 'SASLMemcachedCache',
+    'spreadsaslmemcached': 'SpreadSASLMemcachedCache',
+    'uwsgi': 'UWSGICache',
+}
+
+
+def init_cache(app):
+    """
+    Set up the flask-caching cache, which newer versions of flask-caching
+    only know the backends of by their class names, and the shared metatile
+    cache, which is kept in it unless SHARED_MEMORY_CACHE_MAX_BYTES is set.
+    See cache_codec.py and shm_cache.py.
     """
 
-    NO_HASH = "{prefix}{suffix}"
-    HASH_PREFIX = "{hash}{prefix}{suffix}"
-    PREFIX_HASH = "{prefix}{hash}{suffix}"
+    import flask_caching.backends
 
+    cache_type = app.config.get('CACHE_TYPE')
+    if cache_type in CACHE_BACKENDS and not hasattr(flask_caching.backends, cache_type):
+        app.config['CACHE_TYPE'] = CACHE_BACKENDS[cache_type]
+    cache.init_app(app)
 
-def compute_key(prefix, layer, meta_tile,
-                key_format_type=KeyFormatType.NO_HASH):
-    k = "{z}/{x}/{y}.{fmt}".format(
-        z=meta_tile.z,
-        x=meta_tile.x,
-        y=meta_tile.y,
-        fmt=meta_tile.format,
-    )
+    shared_memory_max_bytes = app.config.get('SHARED_MEMORY_CACHE_MAX_BYTES')
+    if shared_memory_max_bytes:
+        from shm_cache import SharedMemoryCache
+        app.shared_cache = SharedMemoryCache(
+            app.config.get('SHARED_MEMORY_CACHE_PATH'), shared_memory_max_bytes,
+            buckets=max(1024, shared_memory_max_bytes // TYPICAL_METATILE_SIZE),
+        )
+    else:
+        app.shared_cache = make_shared_cache(app.extensions['cache'][cache])
+
+
+def init_caches(app):
+    """
+    Set up the in-process caches: the metatile cache, which sits in front of
+    the flask-caching one and is bounded by METATILE_CACHE_MAX_BYTES, the
+    cache of encoded tiles, bounded by TILE_CACHE_MAX_BYTES, and the cache
+    of missing metatiles and tiles, which keeps them for NEGATIVE_CACHE_TTL.
+    """
+
+    negative_cache_ttl = app.config.get('NEGATIVE_CACHE_TTL')
+    app.negative_cache = NegativeCache(
+        app.config.get('NEGATIVE_CACHE_MAX_ENTRIES'), negative_cache_ttl) \
+        if negative_cache_ttl else None
+
+    tile_cache_max_bytes = app.config.get('TILE_CACHE_MAX_BYTES')
+    app.tile_cache = LRUCache(tile_cache_max_bytes, encoded_tile_size) \
+        if tile_cache_max_bytes else None
+
+    max_bytes = app.config.get('METATILE_CACHE_MAX_BYTES')
+    policy = app.config.get('METATILE_CACHE_POLICY') or 'lru'
+
+    if not max_bytes:
+        app.metatile_cache = None
+    elif policy == 'lru':
+        app.metatile_cache = LRUCache(max_bytes, storage_response_size)
+    elif policy == 'tinylfu':
+        app.metatile_cache = TinyLFUCache(
+            max_bytes, storage_response_size,
+            expected_entries=max(1024, max_bytes // TYPICAL_METATILE_SIZE),
+        )
+    else:
+        raise ValueError("Unknown METATILE_CACHE_POLICY %r" % policy)
+
+
+def cache_get(key):
+    with stage('cache'):
+        value = cache_lookup(key)
+    if value is not None:
+        record_cache_outcome('hit')
+    return value
+
+
+def cache_lookup(key):
+    local_cache = current_app.metatile_cache
+    if local_cache is not None:
+        value = local_cache.get(key)
+        if value is not None:
+            return value
+
+    shared_cache = current_app.shared_cache
+    if shared_cache is None:
+        return None
+
+    value = g.get('preloaded_metatiles', {}).get(key)
+    if value is None:
+        value = shared_cache.get(shared_cache_key(key))
+    if value is not None and local_cache is not None:
+        # promote hits in the shared cache so the next one is local.
+        local_cache.set(key, value)
+    return value
+
+
+def cache_contains(key):
+    """
+    Whether the metatile is cached, without counting as a lookup.
+    """
+
+    local_cache = current_app.metatile_cache
+    if local_cache is not None and key in local_cache:
+        return True
+    shared_cache = current_app.shared_cache
+    return shared_cache is not None and shared_cache_key(key) in shared_cache
+
+
+def shared_cache_get_many(keys):
+    """
+    Look the keys up in the shared cache all at once, which is a single
+    round trip for Redis. Returns the values found, by key.
+    """
+
+    values = current_app.shared_cache.get_many([shared_cache_key(key) for key in keys])
+    return dict((key, value) for key, value in zip(keys, values) if value is not None)
+
+
+def cache_preload(keys):
+    """
+    Look up the keys which aren't in the in-process cache in the shared one
+    all at once, rather than one at a time as they're needed, and keep what's
+    found for cache_lookup for the rest of the request.
+    """
+
+    if current_app.shared_cache is None:
+        return
+
+    local_cache = current_app.metatile_cache
+    keys = [key for key in keys if local_cache is None or key not in local_cache]
+    if len(keys) > 1:
+        g.setdefault('preloaded_metatiles', {}).update(shared_cache_get_many(keys))
+
+
+def cache_set(key, value):
+    if current_app.metatile_cache is not None:
+        current_app.metatile_cache.set(key, value)
+    if current_app.shared_cache is not None:
+        current_app.shared_cache.set(shared_cache_key(key), value)
+
+
+def cache_delete(key):
+    g.get('preloaded_metatiles', {}).pop(key, None)
+    if current_app.metatile_cache is not None:
+        current_app.metatile_cache.delete(key)
+    if current_app.shared_cache is not None:
+        current_app.shared_cache.delete(shared_cache_key(key))
 
-    # in versions of code before https://github.com/tilezen/tilequeue/pull/344,
-    # we included the layer and leading slash in the hashed string. after that
-    # PR, we no longer support having a layer in the path and _also_ drop the
-    # leading slash from the hashed string.
-    if layer:
-        k = "/{layer}/{suffix}".format(
-            layer=layer,
-            suffix=k
+
+def shared_cache_key(key):
+    # the in-process caches are keyed by the metatile's coordinates, but the
+    # shared one by where it's stored, so it can be shared between servers.
+    return current_app.storage.location(key)
+
+
+def init_storage(app, boto_s3=None):
+    """
+    Set up the backend that metatiles are read from: either the S3 bucket,
+    read with `boto_s3` or a new boto3 client, a local directory or a pack
+    file, as picked by STORAGE_BACKEND.
+    """
+
+    backend = app.config.get('STORAGE_BACKEND') or 's3'
+    prefix = app.config.get('S3_PREFIX')
+    layer = app.config.get('S3_LAYER')
+    key_format_type = configured_key_format_type(app.config)
+
+    if backend == 's3':
+        app.boto_s3 = boto_s3 or LazyS3Client(app.config)
+        hedge_min_delay = app.config.get('S3_HEDGE_MIN_DELAY_MS')
+        deadline = app.config.get('S3_DEADLINE_MS')
+        app.storage = S3Storage(
+            app.boto_s3, app.config.get('S3_BUCKET'), prefix, layer,
+            key_format_type, requester_pays=app.config.get('REQUESTER_PAYS'),
+            hedge_percentile=app.config.get('S3_HEDGE_PERCENTILE'),
+            hedge_min_delay=hedge_min_delay / 1000.0 if hedge_min_delay else 0,
+            deadline=deadline / 1000.0 if deadline else None,
+            max_workers=app.config.get('S3_MAX_POOL_CONNECTIONS') or 10,
         )
+    elif backend == 'local':
+        app.storage = LocalStorage(
+            app.config.get('LOCAL_STORAGE_DIR'), prefix, layer, key_format_type)
+    elif backend == 'pack':
+        from pack import PackStorage
+        app.storage = PackStorage(app.config.get('PACK_PATH'))
+    else:
+        raise ValueError("Unknown STORAGE_BACKEND %r" % backend)
+
+
+class LazyS3Client(object):
+    """
+    Stands in for the boto3 S3 client, which is only made when it's first
+    used, so that importing boto3 and setting up the client don't slow down
+    starting the server.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    self._client = boto3.client('s3', config=s3_client_config(self.config))
+        return self._client
 
-    # make sure each part is either empty or starts with a /, that means that
-    # they will combine to make a valid path.
-    h = "/" + hashlib.md5(k.encode('utf8')).hexdigest()[:5]
-    prefix = "/" + prefix if prefix else ""
-
-    if not layer:
-        # in the case where layer wasn't provided and we didn't hash the
-        # leading slash, we still need to add a leading slash so that it makes
-        # valid path.
-        k = "/" + k
-
-    k = key_format_type.value.format(
-        hash=h,
-        prefix=prefix,
-        suffix=k,
+    def __getattr__(self, name):
+        return getattr(self.client(), name)
+
+
+def s3_client_config(config):
+    import botocore.config
+    return botocore.config.Config(**s3_client_options(config))
+
+
+def s3_client_options(config):
+    """
+    The botocore config options for the S3 client: the size of its
+    connection pool, whether to keep connections alive, and its timeouts and
+    retries, where they're set.
+    """
+
+    client_config = dict(tcp_keepalive=config.get('S3_TCP_KEEPALIVE'))
+    if config.get('S3_MAX_POOL_CONNECTIONS'):
+        client_config['max_pool_connections'] = config.get('S3_MAX_POOL_CONNECTIONS')
+    if config.get('S3_CONNECT_TIMEOUT'):
+        client_config['connect_timeout'] = config.get('S3_CONNECT_TIMEOUT')
+    if config.get('S3_READ_TIMEOUT'):
+        client_config['read_timeout'] = config.get('S3_READ_TIMEOUT')
+    if config.get('S3_MAX_ATTEMPTS'):
+        client_config['retries'] = {'max_attempts': config.get('S3_MAX_ATTEMPTS'), 'mode': 'standard'}
+    return client_config
+
+
+def init_prefetch(app):
+    """
+    Set up prefetching of the metatiles around ones fetched for requests, if
+    PREFETCH is set. See prefetch.py.
+    """
+
+    app.prefetcher = None
+    if not app.config.get('PREFETCH') or not app.storage.cacheable:
+        return
+    if app.metatile_cache is None and app.shared_cache is None:
+        # there'd be nowhere to keep the prefetched metatiles.
+        return
+
+    max_zoom = app.config.get('PREFETCH_MAX_ZOOM')
+    if max_zoom is None:
+        # the zoom of the metatiles holding the most detailed tiles.
+        max_zoom = app.config.get('METATILE_MAX_DETAIL_ZOOM') or \
+            MAX_ZOOM - int(size_to_zoom(app.config.get('METATILE_SIZE')))
+
+    from prefetch import Prefetcher
+    app.prefetcher = Prefetcher(
+        app.config.get('PREFETCH_MAX_PENDING'),
+        app.config.get('PREFETCH_MIN_ZOOM') or 0,
+        max_zoom,
     )
 
-    # Strip off the leading slash
-    return k[1:]
 
+def init_hot_set(app):
+    """
+    Set up the record of the most requested metatiles, if HOT_SET_SNAPSHOT
+    is set, and warm the caches with the ones in its last snapshot, in the
+    background unless HOT_SET_WARM_BLOCKING is set. See hotset.py.
+    """
+
+    app.hot_set = None
+    snapshot = app.config.get('HOT_SET_SNAPSHOT')
+    if not snapshot or not app.storage.cacheable:
+        return
 
-def metatile_fetch(meta, cache_info):
-    cached = cache.get(meta)
-    if cached:
-        current_app.logger.info("%s: Using a cached metatile", meta)
-        return cached
-
-    s3_key_prefix = current_app.config.get('S3_PREFIX')
-    include_hash = current_app.config.get('INCLUDE_HASH')
-    key_format_type = current_app.config.get('KEY_FORMAT_TYPE')
-    s3_key_layer = current_app.config.get('S3_LAYER')
-    requester_pays = current_app.config.get('REQUESTER_PAYS')
-
-    if key_format_type:
-        key_format_type = KeyFormatType[key_format_type]
-    elif include_hash == False:
-        # map include_hash onto key format types for backwards compatibility
-        key_format_type = KeyFormatType.NO_HASH
+    from hotset import CacheSnapshots, FileSnapshots, HotSet
+    if snapshot == 'cache':
+        snapshots = CacheSnapshots(app, cache)
     else:
-        # note that prefix-hash is the default if neither config parameter is
-        # provided!
-        key_format_type = KeyFormatType.PREFIX_HASH
+        snapshots = FileSnapshots(snapshot)
+    app.hot_set = HotSet(snapshots, app.config.get('HOT_SET_SAVE_INTERVAL'))
+
+    metatiles = app.hot_set.load()[:app.config.get('HOT_SET_WARM_COUNT')]
+    if app.metatile_cache is None and app.shared_cache is None:
+        # there'd be nowhere to keep the warmed metatiles.
+        metatiles = []
+    warm_up_args = (app, metatiles, app.config.get('HOT_SET_WARM_MAX_BYTES'),
+                    app.config.get('HOT_SET_WARM_SECONDS'))
+    if app.config.get('HOT_SET_WARM_BLOCKING'):
+        app.hot_set.warm_up(*warm_up_args)
+    elif metatiles:
+        threading.Thread(target=app.hot_set.warm_up, args=warm_up_args,
+                         name='hot-set-warm-up', daemon=True).start()
+    app.hot_set.start_saving()
+
+
+def record_hot(meta):
+    hot_set = current_app.hot_set
+    if hot_set is not None:
+        hot_set.record(meta)
+
+
+def init_metrics(app):
+    """
+    Set up timing of the stages of tile requests, which are sent in a
+    Server-Timing header if SERVER_TIMING is set, and kept in histograms
+    served on /metrics if METRICS is set.
+    """
 
-    s3_bucket = current_app.config.get('S3_BUCKET')
-    s3_key = compute_key(s3_key_prefix, s3_key_layer, meta, key_format_type)
+    app.metrics = TileMetrics() if app.config.get('METRICS') else None
+    if app.metrics is not None and hasattr(app.storage, 'stats'):
+        # the async server replaces the storage, so look it up each time.
+        app.metrics.add_stats('tapalcatl_storage', 'Storage', lambda: app.storage.stats())
+    if app.metrics is not None:
+        app.metrics.add_stats('tapalcatl_metatile_flights', 'Coalesced metatile fetches',
+                              metatile_flights.stats)
+    if app.metrics is not None and app.metatile_cache is not None:
+        app.metrics.add_stats('tapalcatl_metatile_cache', 'Metatile cache',
+                              app.metatile_cache.stats, app.metatile_cache.gauges)
+    if app.metrics is not None and app.tile_cache is not None:
+        app.metrics.add_stats('tapalcatl_tile_cache', 'Tile cache',
+                              app.tile_cache.stats, app.tile_cache.gauges)
+    if app.metrics is not None and app.negative_cache is not None:
+        app.metrics.add_stats('tapalcatl_negative_cache', 'Negative cache',
+                              app.negative_cache.stats, app.negative_cache.gauges)
+    if app.metrics is not None and hasattr(app.shared_cache, 'stats'):
+        app.metrics.add_stats('tapalcatl_shared_cache', 'Shared metatile cache', app.shared_cache.stats)
+    if app.metrics is not None and app.prefetcher is not None:
+        app.metrics.registry.add(app.prefetcher.outcomes)
+    if app.metrics is not None and app.hot_set is not None:
+        app.metrics.add_stats('tapalcatl_hot_set', 'Hot set',
+                              app.hot_set.stats, app.hot_set.gauges)
+
+
+@tile_bp.before_app_request
+def start_request_timer():
+    if current_app.metrics is not None or current_app.config.get('SERVER_TIMING'):
+        g.request_timer = RequestTimer()
+
+
+@tile_bp.after_app_request
+def finish_request_timer(response):
+    timer = current_timer()
+    if timer is None or timer.layer is None:
+        return response
 
-    get_params = {
-        "Bucket": s3_bucket,
-        "Key": s3_key,
-    }
+    total = timer.elapsed()
+    if current_app.config.get('SERVER_TIMING'):
+        response.headers['Server-Timing'] = timer.server_timing(total)
+    if current_app.metrics is not None:
+        current_app.metrics.observe(timer, total)
+    return response
+
+
+def init_profiling(app):
+    """
+    Set up profiling of requests, if PROFILE_TOKEN or PROFILE_SAMPLE_RATE
+    are set. Otherwise, nothing is added to the app, so it costs nothing.
+    """
+
+    token = app.config.get('PROFILE_TOKEN')
+    sample_rate = app.config.get('PROFILE_SAMPLE_RATE')
+    if not token and not sample_rate:
+        app.profiler = None
+        return
+
+    from profiling import RequestProfiler
+    app.profiler = RequestProfiler(
+        token=token,
+        sample_rate=sample_rate,
+        directory=app.config.get('PROFILE_DIR'),
+        window=app.config.get('PROFILE_WINDOW'),
+    )
+    app.before_request(start_profile)
+    app.teardown_request(finish_profile)
+    app.add_url_rule('/debug/profile', 'debug_profile', debug_profile)
+
+
+def profile_header():
+    return request.headers.get(current_app.config.get('PROFILE_HEADER'))
+
+
+def start_profile():
+    if request.endpoint == 'debug_profile':
+        return
+    if current_app.profiler.wanted(profile_header()):
+        g.request_profile = current_app.profiler.start()
+
+
+def finish_profile(exc):
+    profile = g.pop('request_profile', None)
+    if profile is not None:
+        path = current_app.profiler.finish(profile, request.path)
+        current_app.logger.info("Profiled %s%s", request.path, " to %s" % path if path else "")
+
+
+def debug_profile():
+    profiler = current_app.profiler
+    if not profiler.authorized(profile_header()):
+        return abort(403)
+
+    if request.args.get('format') == 'pstats':
+        resp = make_response(profiler.dump())
+        resp.headers['Content-Type'] = 'application/octet-stream'
+        resp.headers['Content-Disposition'] = 'attachment; filename=profile.pstats'
+    else:
+        from profiling import SORT_KEYS
+
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in SORT_KEYS:
+            return abort(400, "Invalid sort. Pick one of %s." % ', '.join(SORT_KEYS))
+        resp = make_response(profiler.report(sort=sort))
+        resp.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    return resp
 
-    if cache_info.last_modified:
-        get_params['IfModifiedSince'] = cache_info.last_modified
 
-    if cache_info.etag:
-        get_params['IfNoneMatch'] = cache_info.etag
+def label_request(layer, zoom):
+    timer = current_timer()
+    if timer is not None:
+        timer.layer = layer
+        timer.zoom = zoom
 
-    if requester_pays:
-        get_params['RequestPayer'] = 'requester'
+
+def cached_metatile(meta):
+    cached = cache_get(meta)
+    if cached and cached.index is None:
+        # entries cached before the index was stored alongside the data.
+        cached = cached._replace(index=build_index(cached.data))
+    return cached
+
+
+def is_stale(cached):
+    freshness = current_app.config.get('METATILE_FRESHNESS')
+    if not freshness:
+        return False
+    return cached.fetched_at is None or time.time() - cached.fetched_at > freshness
+
+
+def use_cached(meta, cache_key, cached, cache_info, get):
+    """
+    Answer a request from something cached for the metatile. If it's stale,
+    it's still used, but revalidated with storage in the background by
+    calling `get` with conditions to only fetch it if it changed.
+
+    Raises MetatileNotModifiedException if the request's conditions are
+    met by what's cached.
+    """
+
+    if is_stale(cached):
+        revalidate_in_background(meta, cache_key, cached, get)
+
+    if is_not_modified(cache_info, cached.cache_info):
+        raise MetatileNotModifiedException()
+
+    return cached
+
+
+def revalidate_in_background(meta, cache_key, cached, get):
+    revalidation_key = (current_app.storage.location(meta), cache_key)
+
+    with revalidations_lock:
+        if revalidation_key in revalidations:
+            return
+        revalidations.add(revalidation_key)
+
+    app = current_app._get_current_object()
+
+    def run():
+        try:
+            with app.app_context():
+                revalidate(meta, cache_key, cached, get)
+        except Exception:
+            app.logger.exception("%s: Error revalidating metatile", meta)
+        finally:
+            with revalidations_lock:
+                revalidations.discard(revalidation_key)
+
+    revalidation_pool.submit(run)
+
+
+def revalidate(meta, cache_key, cached, get):
+    conditions = CacheInfo(last_modified=None, etag='"%s"' % cached.cache_info.etag)
 
     try:
-        a = time.time()
-        response = current_app.boto_s3.get_object(**get_params)
-
-        # Strip the quotes that boto includes
-        quoteless_etag = response['ETag'][1:-1]
-        result = StorageResponse(
-            data=response['Body'].read(),
-            cache_info=CacheInfo(
-                last_modified=response['LastModified'],
-                etag=quoteless_etag,
-            )
+        get(meta, conditions)
+        current_app.logger.info("%s: Revalidated metatile, it changed", meta)
+    except MetatileNotModifiedException:
+        current_app.logger.info("%s: Revalidated metatile, it didn't change", meta)
+        cache_set(cache_key, cached._replace(fetched_at=time.time()))
+    except MetatileNotFoundException:
+        current_app.logger.info("%s: Revalidated metatile, it was removed", meta)
+        cache_delete(cache_key)
+
+
+def metatile_fetch(meta, cache_info, prefetch=True):
+    prefetcher = current_app.prefetcher
+    cached = cached_metatile(meta)
+    if cached:
+        current_app.logger.info("%s: Using a cached metatile", meta)
+        if prefetcher is not None:
+            prefetcher.requested(meta)
+        return use_cached(meta, meta, cached, cache_info, metatile_get)
+
+    # requests with different conditions can get different responses from
+    # storage, so only share the fetch between requests with the same ones.
+    with stage('fetch'):
+        result = metatile_flights.do(
+            ('metatile', current_app.storage.location(meta), cache_info),
+            metatile_storage_fetch, meta, cache_info,
         )
-        duration = (time.time() - a) * 1000
-
-        current_app.logger.info("%s: Took %0.1fms to get %s byte metatile from s3://%s/%s", meta, duration, response['ContentLength'], s3_bucket, s3_key)
-        cache.set(meta, result)
-
-        return result
-    except botocore.exceptions.ClientError as e:
-        error_code = str(e.response.get('Error', {}).get('Code'))
-        if error_code == '304':
-            raise MetatileNotModifiedException()
-        elif error_code == 'NoSuchKey':
-            raise MetatileNotFoundException(
-                "No metatile found at s3://%s/%s" % (s3_bucket, s3_key)
+
+    if prefetcher is not None and prefetch:
+        app = current_app._get_current_object()
+        prefetcher.prefetch_around(meta, lambda target: prefetch_metatile(app, target))
+    return result
+
+
+def prefetch_metatile(app, meta):
+    """
+    Fetch a metatile into the cache, unless it's already there or known to
+    be missing, sharing the fetch with any requests for it. Returns which
+    of those happened, for the Prefetcher.
+    """
+
+    with app.app_context():
+        if cache_contains(meta):
+            return 'cached'
+        negative_cache = app.negative_cache
+        if negative_cache is not None and meta in negative_cache:
+            return 'missing'
+
+        try:
+            # straight to storage, as looking in the cache again would count
+            # as a use of a metatile nobody has asked for.
+            metatile_flights.do(
+                ('metatile', app.storage.location(meta), NO_CONDITIONS),
+                metatile_get, meta, NO_CONDITIONS,
             )
-        else:
-            raise UnknownMetatileException(
-                "%s at s3://%s/%s" % (error_code,  s3_bucket, s3_key)
+        except MetatileNotFoundException:
+            if negative_cache is not None:
+                negative_cache.add(meta)
+            return 'missing'
+        except Exception:
+            app.logger.exception("%s: Error prefetching metatile", meta)
+            return 'error'
+
+    return 'fetched'
+
+
+def metatile_storage_fetch(meta, cache_info):
+    # another request might have finished fetching the metatile between our
+    # cache miss and starting this fetch.
+    cached = cached_metatile(meta)
+    if cached:
+        return use_cached(meta, meta, cached, cache_info, metatile_get)
+
+    return metatile_get(meta, cache_info)
+
+
+def metatile_get(meta, cache_info):
+    storage = current_app.storage
+    record_cache_outcome('miss')
+    result = storage.get(meta, cache_info)
+    if storage.cacheable:
+        cache_set(meta, result)
+    return result
+
+
+def index_cache_key(meta):
+    # the index is cached under the same coordinates as the metatile, but with
+    # a different format so that the two don't collide.
+    return meta._replace(format='zipindex')
+
+
+def metatile_index_fetch(meta, cache_info, deadline=None):
+    """
+    Fetch the member index of the metatile using ranged GETs of the end of
+    the zip, rather than GETting the whole object. The data is None unless
+    the metatile was small enough to be returned in full by the first GET.
+    """
+
+    cache_key = index_cache_key(meta)
+    cached = cache_get(cache_key)
+    if cached:
+        current_app.logger.info("%s: Using a cached metatile index", meta)
+        return use_cached(meta, cache_key, cached, cache_info, metatile_index_get)
+
+    with stage('fetch'):
+        return metatile_flights.do(
+            ('index', current_app.storage.location(meta), cache_info),
+            metatile_index_storage_fetch, meta, cache_info, deadline,
+        )
+
+
+def metatile_index_storage_fetch(meta, cache_info, deadline=None):
+    cache_key = index_cache_key(meta)
+    cached = cache_get(cache_key)
+    if cached:
+        return use_cached(meta, cache_key, cached, cache_info, metatile_index_get)
+
+    return metatile_index_get(meta, cache_info, deadline)
+
+
+def metatile_index_get(meta, cache_info, deadline=None):
+    storage = current_app.storage
+    record_cache_outcome('miss')
+    result = storage.get_index(meta, cache_info, deadline)
+    if storage.cacheable:
+        cache_set(index_cache_key(meta), result)
+    return result
+
+
+def metatile_member_fetch(meta, member_name, cache_info, content_encoding=None):
+    """
+    Fetch a single member of the metatile without GETting the whole object,
+    using a cached index of the metatile to find the range to request. The
+    index and the member are fetched within the same deadline.
+    """
+
+    deadline = current_app.storage.start_deadline()
+    for attempt in range(0, 2):
+        metatile_index = metatile_index_fetch(meta, metatile_conditions(cache_info), deadline)
+        member = find_member(metatile_index.index, member_name)
+        tile_info = tile_cache_info(metatile_index.cache_info, member, cache_info)
+        etag = metatile_index.cache_info.etag
+
+        def read_raw():
+            if metatile_index.data is not None:
+                return raw_member(metatile_index.data, member)
+            return current_app.storage.read_member(
+                meta, member, member_name, etag, deadline)
+
+        try:
+            data, encoding = encoded_tile(
+                meta, etag, member_name, member, content_encoding, read_raw)
+        except MetatileChangedException:
+            # the cached index is for an older version of the metatile, so
+            # throw it away and try again with a fresh one.
+            current_app.logger.info("%s: Metatile changed, fetching index again", meta)
+            cache_delete(index_cache_key(meta))
+            continue
+
+        return StorageResponse(
+            data=data,
+            cache_info=tile_info,
+            content_encoding=encoding,
+        )
+
+    raise UnknownMetatileException(
+        "Metatile %s changed repeatedly while fetching %s" % (meta, member_name))
+
+
+HTTP_DATE_MONTHS = dict(
+    (month, i + 1) for i, month in enumerate(
+        ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+
+
+def parse_http_date(value):
+    """
+    Parse an HTTP-date, as in RFC 7231 section 7.1.1.1, returning a UTC
+    datetime, or None if it isn't one. The usual IMF-fixdate format, like
+    "Sun, 06 Nov 1994 08:49:37 GMT", is picked apart directly, and the
+    obsolete RFC 850 and asctime formats are left to the email module.
+    """
+
+    if len(value) == 29 and value[3:5] == ', ' and value[25:] == ' GMT':
+        try:
+            return datetime.datetime(
+                int(value[12:16]), HTTP_DATE_MONTHS[value[8:11]], int(value[5:7]),
+                int(value[17:19]), int(value[20:22]), int(value[23:25]),
+                tzinfo=datetime.timezone.utc,
             )
+        except (KeyError, ValueError):
+            return None
+
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if parsed is None:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
 
 
 def parse_header_time(tstamp):
+    # an invalid date is ignored, as RFC 7232 says to for If-Modified-Since.
     if tstamp:
-        return dateutil.parser.parse(tstamp)
+        return parse_http_date(tstamp)
     else:
         return None
 
 
-def extract_tile(metatile_bytes, offset):
-    data = BytesIO(metatile_bytes)
-    z = zipfile.ZipFile(data, 'r')
-
-    offset_key = '{zoom}/{x}/{y}.{fmt}'.format(
+def tile_member_name(offset):
+    return '{zoom}/{x}/{y}.{fmt}'.format(
         zoom=offset.z,
         x=offset.x,
         y=offset.y,
         fmt=offset.format,
     )
 
+
+def find_member(index, member_name):
+    try:
+        return index[member_name]
+    except KeyError:
+        raise TileNotFoundInMetatile("Couldn't find tile %s in metatile" % member_name)
+
+
+def metatile_conditions(cache_info):
+    """
+    The conditions to fetch a metatile with, for a request for one of its
+    tiles with `cache_info`. With TILE_CONTENT_ETAGS, the request's ETag is
+    a tile's rather than the metatile's, so the metatile is fetched without
+    it, and tile_cache_info checks it against the tile instead.
+    """
+
+    if cache_info.etag and current_app.config.get('TILE_CONTENT_ETAGS'):
+        return NO_CONDITIONS
+    return cache_info
+
+
+def tile_cache_info(metatile_cache_info, member, cache_info=NO_CONDITIONS):
+    """
+    The cache info of a tile in a metatile. With TILE_CONTENT_ETAGS, its
+    ETag is made from the tile's CRC32 and size in the metatile's index,
+    so it only changes when the tile does, rather than whenever the
+    metatile is rebuilt.
+
+    Raises MetatileNotModifiedException if the conditions of the request,
+    in `cache_info`, are met by the tile's ETag.
+    """
+
+    if not current_app.config.get('TILE_CONTENT_ETAGS'):
+        return metatile_cache_info
+
+    tile_info = metatile_cache_info._replace(etag='%08x-%x' % (member.crc, member.size))
+    if cache_info.etag and is_not_modified(cache_info, tile_info):
+        raise MetatileNotModifiedException()
+    return tile_info
+
+
+def extract_member(metatile_bytes, member_name, index=None):
+    if index is None:
+        index = build_index(metatile_bytes)
+
+    return read_member(metatile_bytes, find_member(index, member_name))
+
+
+def extract_tile(metatile_bytes, offset, index=None):
+    return extract_member(metatile_bytes, tile_member_name(offset), index)
+
+
+def encode_tile(read_raw, member, content_encoding):
+    with stage('extract'):
+        raw = read_raw()
+    with stage('encode'):
+        return encode_member(
+            raw, member, content_encoding,
+            compress_level=current_app.config.get('COMPRESS_LEVEL', 6),
+            brotli_quality=current_app.config.get('COMPRESS_BR_LEVEL', 4),
+            min_size=current_app.config.get('COMPRESS_MIN_SIZE', 500),
+        )
+
+
+def encoded_tile(meta, etag, member_name, member, content_encoding, read_raw):
+    """
+    Returns the tile's data and the content encoding it's in, from the tile
+    cache if it's there. Otherwise, `read_raw` is called to get the raw data
+    of the member, which is encoded and cached.
+
+    Entries are keyed on the metatile's ETag, so that once the metatile
+    changes, the old entries aren't used again and age out of the cache.
+    """
+
+    key = tile_cache_key(meta, etag, member_name, content_encoding)
+    encoded = cached_tile(key)
+    if encoded is None:
+        encoded = encode_tile(read_raw, member, content_encoding)
+        cache_tile(key, encoded)
+    return encoded
+
+
+def tile_cache_key(meta, etag, member_name, content_encoding):
+    return (meta, etag, member_name, content_encoding)
+
+
+def cached_tile(key):
+    tile_cache = current_app.tile_cache
+    if tile_cache is None:
+        return None
+
+    with stage('cache'):
+        encoded = tile_cache.get(key)
+    if encoded is not None:
+        record_cache_outcome('hit')
+    return encoded
+
+
+def cache_tile(key, encoded):
+    tile_cache = current_app.tile_cache
+    if tile_cache is not None:
+        tile_cache.set(key, encoded)
+
+
+@contextmanager
+def negative_caching(meta, member_name=None):
+    """
+    Fail without fetching anything if the metatile, or the member of it if
+    one is given, have recently been found to be missing, and remember it
+    if they're found to be missing in the block.
+    """
+
+    negative_cache = current_app.negative_cache
+    if negative_cache is None:
+        yield
+        return
+
+    if member_name is None:
+        missing = negative_cache.find(meta)
+    else:
+        missing = negative_cache.find(meta, (meta, member_name))
+    if missing is not None:
+        record_cache_outcome('negative')
+        if missing == meta:
+            raise CachedMetatileNotFoundException("Metatile %s recently not found" % (meta,))
+        raise CachedTileNotFoundInMetatile("Tile %s recently not found in metatile" % member_name)
+
     try:
-        return z.read(offset_key)
-    except KeyError as e:
-        raise TileNotFoundInMetatile(e)
+        yield
+    except MetatileNotFoundException:
+        negative_cache.add(meta)
+        raise
+    except TileNotFoundInMetatile:
+        if member_name is not None:
+            negative_cache.add((meta, member_name))
+        raise
+
+
+def retrieve_member(meta, member_name, cache_info, content_encoding=None, prefetch=True):
+    """
+    Fetch a member of the metatile, compressed with the given content
+    encoding if possible. The response's content encoding says what it was
+    actually compressed with, if anything.
+
+    If the metatile or member have recently been found to be missing, this
+    fails without fetching anything. With `prefetch` false, the metatiles
+    around it aren't prefetched, even if PREFETCH is set.
+    """
+
+    record_hot(meta)
+    with negative_caching(meta, member_name):
+        return fetch_member(meta, member_name, cache_info, content_encoding, prefetch)
+
+
+def prefetches_around(layer):
+    """
+    Whether to prefetch around the metatiles of the layer's tiles. Landcover
+    metatiles are only at the materialized zooms, and a different size, so
+    most of the neighbours and children that Prefetcher.targets picks don't
+    exist.
+    """
+
+    return layer != 'landcover'
+
+
+def fetches_members():
+    """
+    Whether tiles are read from just their member of the metatile, found
+    with its index, rather than from the whole metatile.
+    """
+
+    return bool(current_app.config.get('S3_RANGE_REQUESTS') or
+                current_app.storage.reads_members)
+
+
+def source_cache_key(meta):
+    """
+    The cache key of what tiles are read from: the metatile's index when
+    fetching members, otherwise the metatile.
+    """
+
+    return index_cache_key(meta) if fetches_members() else meta
 
 
-def retrieve_tile(meta, offset, cache_info):
-    metatile_data = metatile_fetch(meta, cache_info)
-    tile_data = extract_tile(metatile_data.data, offset)
+def fetch_member(meta, member_name, cache_info, content_encoding=None, prefetch=True):
+    if fetches_members():
+        return metatile_member_fetch(meta, member_name, cache_info, content_encoding)
+
+    metatile_data = metatile_fetch(meta, metatile_conditions(cache_info), prefetch)
+    member = find_member(metatile_data.index, member_name)
+    tile_info = tile_cache_info(metatile_data.cache_info, member, cache_info)
+    tile_data, content_encoding = encoded_tile(
+        meta, metatile_data.cache_info.etag, member_name, member,
+        content_encoding, lambda: raw_member(metatile_data.data, member))
 
     return StorageResponse(
         data=tile_data,
         cache_info=CacheInfo(
-            last_modified=metatile_data.cache_info.last_modified,
-            etag=metatile_data.cache_info.etag,
-        )
+            last_modified=tile_info.last_modified,
+            etag=tile_info.etag,
+        ),
+        content_encoding=content_encoding,
     )
 
 
-def is_valid_tile_request(z, x, y, max_zoom=17):
+def retrieve_tile(meta, offset, cache_info, content_encoding=None):
+    return retrieve_member(meta, tile_member_name(offset), cache_info, content_encoding)
+
+
+def negotiate_encoding():
+    """
+    Pick the content encoding to send the tile with, or None to send it
+    decompressed and leave it to Flask-Compress.
+    """
+
+    accept_encodings = request.accept_encodings
+
+    if current_app.tile_cache is not None:
+        # tiles are only compressed once before going in the tile cache, so
+        # it's worth using the best compression the client accepts.
+        for encoding in CONTENT_ENCODINGS:
+            if accept_encodings[encoding] > 0:
+                return encoding
+
+    elif current_app.config.get('GZIP_PASSTHROUGH') and accept_encodings['gzip'] > 0:
+        # tiles can be sent as they're stored in the metatile, rather than
+        # being decompressed and then compressed again by Flask-Compress.
+        return 'gzip'
+
+    return None
+
+
+def make_tile_response(storage_result, fmt):
+    response = make_response(storage_result.data)
+    response.content_type = MIME_TYPES.get(fmt)
+    if storage_result.content_encoding:
+        # Flask-Compress leaves responses that are already encoded alone.
+        response.content_encoding = storage_result.content_encoding
+    response.vary.add('Accept-Encoding')
+    response.last_modified = storage_result.cache_info.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get("CACHE_MAX_AGE")
+    if current_app.config.get("SHARED_CACHE_MAX_AGE"):
+        response.cache_control.s_maxage = current_app.config.get("SHARED_CACHE_MAX_AGE")
+    response.set_etag(tile_etag(storage_result))
+    return response
+
+
+def tile_etag(storage_result):
+    """
+    The ETag of a tile response. Encoded responses have the encoding added,
+    as Flask-Compress does to the responses it compresses, so that each
+    encoding has its own strong ETag.
+    """
+
+    if storage_result.content_encoding:
+        return '%s:%s' % (storage_result.cache_info.etag, storage_result.content_encoding)
+    return storage_result.cache_info.etag
+
+
+def request_etags(if_none_match):
+    """
+    The If-None-Match header without the encodings added to the ETags of
+    encoded responses, so that it can be compared with, or sent to S3 as,
+    the ETag of the tile or metatile.
+    """
+
+    if not if_none_match:
+        return if_none_match
+    return ', '.join(ETAG_ENCODING.sub('', etag.strip()) for etag in if_none_match.split(','))
+
+
+def is_valid_tile_request(z, x, y, max_zoom=MAX_ZOOM):
     return (0 <= z < max_zoom) and (0 <= x < 2**z) and (0 <= y < 2**z)
 
 
-@tile_bp.route('/tilezen/vector/v1/<int:tile_pixel_size>/all/<int:z>/<int:x>/<int:y>.<fmt>')
-@tile_bp.route('/tilezen/vector/v1/all/<int:z>/<int:x>/<int:y>.<fmt>')
-def handle_tile(z, x, y, fmt, tile_pixel_size=None):
-    if not is_valid_tile_request(z, x, y):
-        return abort(400, "Requested tile out of range.")
+def parse_tile_request(z, x, y, fmt, tile_pixel_size, max_zoom=MAX_ZOOM):
+    """
+    Returns the TileRequest for the URL's parameters, aborting with a 400 if
+    they're invalid.
+    """
+
+    if not is_valid_tile_request(z, x, y, max_zoom=max_zoom):
+        abort(400, "Requested tile out of range.")
 
     tile_pixel_size = tile_pixel_size or 256
     tile_size = tile_pixel_size / 256
     if tile_size != int(tile_size):
-        return abort(400, "Invalid tile size. %s is not a multiple of 256." % tile_pixel_size)
-    tile_size = int(tile_size)
+        abort(400, "Invalid tile size. %s is not a multiple of 256." % tile_pixel_size)
 
-    requested_tile = TileRequest(z, x, y, tile_size, fmt)
+    return TileRequest(z, x, y, int(tile_size), fmt)
 
-    meta, offset = meta_and_offset(
-        requested_tile,
-        current_app.config.get('METATILE_SIZE'),
-        metatile_max_detail_zoom=current_app.config.get('METATILE_MAX_DETAIL_ZOOM'),
-    )
 
-    request_cache_info = CacheInfo(
+def request_conditions():
+    return CacheInfo(
         last_modified=parse_header_time(request.headers.get('If-Modified-Since')),
-        etag=request.headers.get('If-None-Match'),
+        etag=request_etags(request.headers.get('If-None-Match')),
     )
 
+
+# The tile routes, for the servers which don't go through flask's routing
+# and responses: the async server and the Lambda handler.
+TILE_ROUTES = (
+    ('vector', re.compile(
+        r'^/tilezen/vector/v1/(?:(?P<tile_pixel_size>\d+)/)?all/'
+        r'(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<fmt>[^/]+)$')),
+    ('landcover', re.compile(
+        r'^/tilezen/landcover/v1/(?:(?P<tile_pixel_size>\d+)/)?all/'
+        r'(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<fmt>[^/]+)$')),
+)
+# The exceptions from retrieving a tile which tile_error has a response for.
+TILE_ERRORS = (
+    MetatileNotFoundException,
+    TileNotFoundInMetatile,
+    MetatileNotModifiedException,
+    UnknownMetatileException,
+)
+
+
+def match_tile_route(path):
+    """
+    Returns the layer and the parameters of the tile route matching the
+    path, or None.
+    """
+
+    for layer, route in TILE_ROUTES:
+        match = route.match(path)
+        if match:
+            return layer, match.groupdict()
+    return None
+
+
+def parse_routed_tile_request(layer, params, headers):
+    """
+    Returns the metatile, the name of the tile in it and the conditions for
+    a request matching one of TILE_ROUTES, with the given headers, which
+    have lower case names. Aborts with a 400 if the request is invalid.
+    """
+
+    z, x, y = int(params['z']), int(params['x']), int(params['y'])
+    tile_pixel_size = int(params['tile_pixel_size']) if params.get('tile_pixel_size') else None
+    fmt = params['fmt']
+
+    with stage('parse'):
+        if layer == 'landcover':
+            requested_tile = parse_tile_request(
+                z, x, y, fmt, tile_pixel_size,
+                max_zoom=current_app.config.get('LANDCOVER_MAX_ZOOM'))
+            if requested_tile.scale != 2:
+                abort(400, "Landcover only supports 512 tile size.")
+        else:
+            requested_tile = parse_tile_request(z, x, y, fmt, tile_pixel_size)
+        conditions = CacheInfo(
+            last_modified=parse_header_time(headers.get('if-modified-since')),
+            etag=request_etags(headers.get('if-none-match')),
+        )
+
+    with stage('meta'):
+        if layer == 'landcover':
+            meta, offset = t2_meta_and_offset(
+                requested_tile,
+                current_app.config.get('LANDCOVER_MATERIALIZED_ZOOMS'),
+                current_app.config.get('LANDCOVER_METATILE_SIZE'),
+            )
+            return meta, t2_tile_member_name(offset), conditions
+
+        meta, offset = meta_and_offset(
+            requested_tile,
+            current_app.config.get('METATILE_SIZE'),
+            metatile_max_detail_zoom=current_app.config.get('METATILE_MAX_DETAIL_ZOOM'),
+        )
+        return meta, tile_member_name(offset), conditions
+
+
+def best_encoding(accept_encoding):
+    """
+    The best content encoding accepted by an Accept-Encoding header, for
+    servers without Flask-Compress to compress responses.
+    """
+
+    accept_encodings = parse_accept_header(accept_encoding)
+    for encoding in CONTENT_ENCODINGS:
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def tile_headers(storage_result, fmt):
+    """
+    The headers of a tile response, as make_tile_response and flask-cors
+    would set them.
+    """
+
+    config = current_app.config
+    headers = []
+    if MIME_TYPES.get(fmt):
+        headers.append(('Content-Type', MIME_TYPES[fmt]))
+    if storage_result.content_encoding:
+        headers.append(('Content-Encoding', storage_result.content_encoding))
+    headers.append(('Vary', 'Accept-Encoding'))
+    if storage_result.cache_info.last_modified:
+        headers.append(('Last-Modified', http_date(storage_result.cache_info.last_modified)))
+
+    cache_control = ResponseCacheControl()
+    cache_control.public = True
+    cache_control.max_age = config.get('CACHE_MAX_AGE')
+    if config.get('SHARED_CACHE_MAX_AGE'):
+        cache_control.s_maxage = config.get('SHARED_CACHE_MAX_AGE')
+    headers.append(('Cache-Control', cache_control.to_header()))
+    headers.append(('ETag', quote_etag(tile_etag(storage_result))))
+    headers.extend(cors_headers())
+    return headers
+
+
+def cors_headers():
+    """
+    The CORS headers flask-cors would add to any response.
+    """
+
+    if current_app.config.get('CORS_SEND_WILDCARD'):
+        return [('Access-Control-Allow-Origin', '*')]
+    return []
+
+
+def tile_error(e):
+    """
+    The status and text of the response for one of TILE_ERRORS, logging it
+    as the flask routes do. Call this while handling the exception.
+    """
+
+    logger = current_app.logger
+    if isinstance(e, CachedMetatileNotFoundException):
+        logger.info("Could not find metatile: %s", e)
+        return 404, "Metatile not found"
+    elif isinstance(e, MetatileNotFoundException):
+        logger.exception("Could not find metatile")
+        return 404, "Metatile not found"
+    elif isinstance(e, CachedTileNotFoundInMetatile):
+        logger.info("Could not find tile in metatile: %s", e)
+        return 404, "Tile not found"
+    elif isinstance(e, TileNotFoundInMetatile):
+        logger.exception("Could not find tile in metatile")
+        return 404, "Tile not found"
+    elif isinstance(e, MetatileNotModifiedException):
+        return 304, ""
+    else:
+        logger.exception("Error fetching metatile")
+        return 500, "Metatile fetch problem"
+
+
+def abort_response(e):
+    """
+    The status, headers and body of the response for an HTTPException from
+    abort, the same as flask's.
+    """
+
+    return e.code, e.get_headers(), e.get_body().encode('utf8')
+
+
+def text_response(status, text):
+    """
+    The status, headers and body of a plain text response.
+    """
+
+    if status == 304:
+        return status, [], b''
+    return status, [('Content-Type', 'text/plain; charset=utf-8')], text.encode('utf8')
+
+
+def start_routed_timer(layer, params):
+    """
+    Start timing a request matching one of TILE_ROUTES, if it's wanted,
+    returning the timer.
+    """
+
+    if current_app.metrics is None and not current_app.config.get('SERVER_TIMING'):
+        return None
+
+    timer = RequestTimer()
+    timer.layer = layer
+    timer.zoom = int(params['z'])
+    return timer
+
+
+def finish_routed_timer(timer, headers):
+    """
+    Add the Server-Timing header to the headers of the response, and record
+    the metrics for it, as finish_request_timer does for flask's responses.
+    """
+
+    if timer is None:
+        return
+
+    total = timer.elapsed()
+    if current_app.config.get('SERVER_TIMING'):
+        headers.append(('Server-Timing', timer.server_timing(total)))
+    if current_app.metrics is not None:
+        current_app.metrics.observe(timer, total)
+
+
+def wsgi_environ(method, path, query_string, headers, body,
+                 server_name='localhost', server_port=80, scheme='http',
+                 script_name=''):
+    """
+    The WSGI environ for a request, to pass requests that aren't for tiles
+    on to the flask app. The headers have lower case names.
+    """
+
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': script_name.encode('utf8').decode('latin1'),
+        'PATH_INFO': path.encode('utf8').decode('latin1'),
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scheme,
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers.items():
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = value
+    return environ
+
+
+def call_wsgi(app, environ):
+    """
+    Returns the status, headers and body of the WSGI app's response.
+    """
+
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), list(headers)]
+
+    body_iter = app(environ, start_response)
     try:
-        storage_result = retrieve_tile(meta, offset, request_cache_info)
-
-        response = make_response(storage_result.data)
-        response.content_type = MIME_TYPES.get(fmt)
-        response.last_modified = storage_result.cache_info.last_modified
-        response.cache_control.public = True
-        response.cache_control.max_age = current_app.config.get("CACHE_MAX_AGE")
-        if current_app.config.get("SHARED_CACHE_MAX_AGE"):
-            response.cache_control.s_maxage = current_app.config.get("SHARED_CACHE_MAX_AGE")
-        response.set_etag(storage_result.cache_info.etag)
-        return response
+        body = b''.join(body_iter)
+    finally:
+        if hasattr(body_iter, 'close'):
+            body_iter.close()
 
-    except MetatileNotFoundException:
-        current_app.logger.exception("Could not find metatile")
-        return "Metatile not found", 404
-    except TileNotFoundInMetatile:
-        current_app.logger.exception("Could not find tile in metatile")
-        return "Tile not found", 404
-    except MetatileNotModifiedException:
-        return "", 304
-    except UnknownMetatileException:
-        current_app.logger.exception("Error fetching metatile")
-        return "Metatile fetch problem", 500
+    status, headers = started
+    # the length is set again once the body is known.
+    headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+    return status, headers, body
+
+
+@tile_bp.route('/tilezen/vector/v1/<int:tile_pixel_size>/all/<int:z>/<int:x>/<int:y>.<fmt>')
+@tile_bp.route('/tilezen/vector/v1/all/<int:z>/<int:x>/<int:y>.<fmt>')
+def handle_tile(z, x, y, fmt, tile_pixel_size=None):
+    label_request('vector', z)
+    with stage('parse'):
+        requested_tile = parse_tile_request(z, x, y, fmt, tile_pixel_size)
+        request_cache_info = request_conditions()
+
+    with stage('meta'):
+        meta, offset = meta_and_offset(
+            requested_tile,
+            current_app.config.get('METATILE_SIZE'),
+            metatile_max_detail_zoom=current_app.config.get('METATILE_MAX_DETAIL_ZOOM'),
+        )
+
+    try:
+        storage_result = retrieve_tile(meta, offset, request_cache_info, negotiate_encoding())
+        with stage('response'):
+            return make_tile_response(storage_result, fmt)
+    except TILE_ERRORS as e:
+        status, text = tile_error(e)
+        return text, status
 
 
 @tile_bp.route('/tilezen/vector/v1/<int:tile_pixel_size>/all/tilejson.<fmt>.json')
@@ -403,11 +1535,8 @@ def t2_meta_and_offset(requested_tile, materialized_zooms, metatile_size):
     return meta, offset
 
 
-def t2_extract_tile(metatile_bytes, offset):
-    data = BytesIO(metatile_bytes)
-    z = zipfile.ZipFile(data, 'r')
-
-    offset_key = '{zoom}/{x}/{y}{scale}.{format}'.format(
+def t2_tile_member_name(offset):
+    return '{zoom}/{x}/{y}{scale}.{format}'.format(
         zoom=offset.z,
         x=offset.x,
         y=offset.y,
@@ -415,76 +1544,237 @@ def t2_extract_tile(metatile_bytes, offset):
         format=offset.format,
     )
 
-    try:
-        return z.read(offset_key)
-    except KeyError as e:
-        raise TileNotFoundInMetatile("Couldn't find tile %s in metatile" % offset_key)
 
+def t2_extract_tile(metatile_bytes, offset, index=None):
+    return extract_member(metatile_bytes, t2_tile_member_name(offset), index)
 
-def t2_retrieve_tile(meta, offset, cache_info):
-    metatile_data = metatile_fetch(meta, cache_info)
-    tile_data = t2_extract_tile(metatile_data.data, offset)
 
-    return StorageResponse(
-        data=tile_data,
-        cache_info=CacheInfo(
-            last_modified=metatile_data.cache_info.last_modified,
-            etag=metatile_data.cache_info.etag,
-        )
-    )
+def t2_retrieve_tile(meta, offset, cache_info, content_encoding=None):
+    return retrieve_member(meta, t2_tile_member_name(offset), cache_info, content_encoding,
+                           prefetch=prefetches_around('landcover'))
 
 
 @tile_bp.route('/tilezen/landcover/v1/<int:tile_pixel_size>/all/<int:z>/<int:x>/<int:y>.<fmt>')
 @tile_bp.route('/tilezen/landcover/v1/all/<int:z>/<int:x>/<int:y>.<fmt>')
 def handle_landcover_tile(z, x, y, fmt, tile_pixel_size=None):
-    if not is_valid_tile_request(z, x, y, max_zoom=current_app.config.get('LANDCOVER_MAX_ZOOM')):
-        return abort(400, "Requested tile out of range.")
+    label_request('landcover', z)
+    with stage('parse'):
+        requested_tile = parse_tile_request(
+            z, x, y, fmt, tile_pixel_size,
+            max_zoom=current_app.config.get('LANDCOVER_MAX_ZOOM'))
+        if requested_tile.scale != 2:
+            abort(400, "Landcover only supports 512 tile size.")
+        request_cache_info = request_conditions()
+
+    with stage('meta'):
+        (meta, offset) = t2_meta_and_offset(
+            requested_tile,
+            current_app.config.get('LANDCOVER_MATERIALIZED_ZOOMS'),
+            current_app.config.get('LANDCOVER_METATILE_SIZE'),
+        )
 
-    tile_pixel_size = tile_pixel_size or 256
-    tile_size = tile_pixel_size / 256
-    if tile_size != int(tile_size):
-        return abort(400, "Invalid tile size. %s is not a multiple of 256." % tile_pixel_size)
-    if tile_size != 2:
-        return abort(400, "Landcover only supports 512 tile size.")
-    tile_size = int(tile_size)
+    try:
+        storage_result = t2_retrieve_tile(meta, offset, request_cache_info, negotiate_encoding())
+        with stage('response'):
+            return make_tile_response(storage_result, fmt)
+    except TILE_ERRORS as e:
+        status, text = tile_error(e)
+        return text, status
 
-    requested_tile = TileRequest(z, x, y, tile_size, fmt)
 
-    (meta, offset) = t2_meta_and_offset(
-        requested_tile,
-        current_app.config.get('LANDCOVER_MATERIALIZED_ZOOMS'),
-        current_app.config.get('LANDCOVER_METATILE_SIZE'),
-    )
+def parse_batch_range(value):
+    start, _, end = value.partition('-')
+    return range(int(start), int(end or start) + 1)
 
-    request_cache_info = CacheInfo(
-        last_modified=parse_header_time(request.headers.get('If-Modified-Since')),
-        etag=request.headers.get('If-None-Match'),
-    )
 
+def parse_batch_tiles(args):
+    """
+    The z, x and y of the tiles asked for by a batch request, either as a
+    list, `tiles=z/x/y,z/x/y,...`, or as a range at one zoom,
+    `z=14&x=2618-2621&y=6330-6333`, without repeats. Aborts with a 400 if
+    they're missing or invalid, or there are more than BATCH_MAX_TILES.
+    """
+
+    max_tiles = current_app.config.get('BATCH_MAX_TILES')
     try:
-        storage_result = t2_retrieve_tile(meta, offset, request_cache_info)
-
-        response = make_response(storage_result.data)
-        response.content_type = MIME_TYPES.get(fmt)
-        response.last_modified = storage_result.cache_info.last_modified
-        response.cache_control.public = True
-        response.cache_control.max_age = current_app.config.get("CACHE_MAX_AGE")
-        if current_app.config.get("SHARED_CACHE_MAX_AGE"):
-            response.cache_control.s_maxage = current_app.config.get("SHARED_CACHE_MAX_AGE")
-        response.set_etag(storage_result.cache_info.etag)
-        return response
+        if 'tiles' in args:
+            tiles = [tuple(int(part) for part in tile.split('/'))
+                     for tile in args['tiles'].split(',') if tile]
+            if any(len(tile) != 3 for tile in tiles):
+                abort(400, "Invalid tile list. Expected tiles=z/x/y,z/x/y,...")
+        elif 'z' in args and 'x' in args and 'y' in args:
+            z = int(args['z'])
+            xs = parse_batch_range(args['x'])
+            ys = parse_batch_range(args['y'])
+            if len(xs) * len(ys) > max_tiles:
+                abort(400, "Too many tiles. At most %d can be asked for at once." % max_tiles)
+            tiles = [(z, x, y) for x in xs for y in ys]
+        else:
+            abort(400, "Give the tiles as tiles=z/x/y,... or as a range with z, x and y.")
+    except ValueError:
+        abort(400, "Invalid tiles.")
 
-    except MetatileNotFoundException:
-        current_app.logger.exception("Could not find metatile")
-        return "Metatile not found", 404
-    except TileNotFoundInMetatile:
-        current_app.logger.exception("Could not find tile in metatile")
-        return "Tile not found", 404
-    except MetatileNotModifiedException:
-        return "", 304
-    except UnknownMetatileException:
-        current_app.logger.exception("Error fetching metatile")
-        return "Metatile fetch problem", 500
+    tiles = list(dict.fromkeys(tiles))
+    if not tiles:
+        abort(400, "No tiles asked for.")
+    if len(tiles) > max_tiles:
+        abort(400, "Too many tiles. At most %d can be asked for at once." % max_tiles)
+    return tiles
+
+
+def member_fetcher(meta, content_encoding=None, prefetch=True):
+    """
+    Fetch the metatile, or its index when using range requests, and return
+    a function which fetches a member of it by name, so that several
+    members can be fetched with one GET. The negative cache is used as it is
+    by retrieve_member. With range requests, the index and all the members
+    are fetched within the same deadline, so that one slow metatile can't
+    hold up the batch for long.
+    """
+
+    record_hot(meta)
+    deadline = current_app.storage.start_deadline()
+    with negative_caching(meta):
+        if fetches_members():
+            source = metatile_index_fetch(meta, NO_CONDITIONS, deadline)
+        else:
+            source = metatile_fetch(meta, NO_CONDITIONS, prefetch)
+
+    def fetch(member_name):
+        with negative_caching(meta, member_name):
+            member = find_member(source.index, member_name)
+
+        etag = source.cache_info.etag
+
+        def read_raw():
+            if source.data is not None:
+                return raw_member(source.data, member)
+            return current_app.storage.read_member(meta, member, member_name, etag, deadline)
+
+        try:
+            data, encoding = encoded_tile(
+                meta, etag, member_name, member, content_encoding, read_raw)
+        except MetatileChangedException:
+            # the index was for an older version of the metatile, which
+            # metatile_member_fetch fetches again.
+            return metatile_member_fetch(meta, member_name, NO_CONDITIONS, content_encoding)
+
+        return StorageResponse(
+            data=data,
+            cache_info=tile_cache_info(source.cache_info, member),
+            content_encoding=encoding,
+        )
+
+    return fetch
+
+
+def batch_part(boundary, location, status, headers, body):
+    head = ['--' + boundary, 'Content-Location: ' + location, 'Status: %d' % status]
+    head.extend('%s: %s' % header for header in headers)
+    head.append('Content-Length: %d' % len(body))
+    return ('\r\n'.join(head) + '\r\n\r\n').encode('utf8') + body + b'\r\n'
+
+
+def batch_error_part(boundary, location, status, text):
+    return batch_part(boundary, location, status,
+                      [('Content-Type', 'text/plain; charset=utf-8')], text.encode('utf8'))
+
+
+def batch_parts(groups, fmt, content_encoding, boundary, prefetch=True):
+    """
+    Yields the parts of a batch response, a metatile at a time, for the
+    tiles grouped by the metatile they're in.
+    """
+
+    # the tiles are at the same path as the batch, but with z/x/y in place
+    # of batch.
+    base_path = request.path[:-len('batch.' + fmt)]
+
+    cache_preload([source_cache_key(meta) for meta in groups])
+
+    for meta, tiles in groups.items():
+        try:
+            fetch = member_fetcher(meta, content_encoding, prefetch)
+        except TILE_ERRORS as e:
+            fetch = None
+            error = tile_error(e)
+
+        for (z, x, y), member_name in tiles:
+            location = '%s%d/%d/%d.%s' % (base_path, z, x, y, fmt)
+            if fetch is None:
+                yield batch_error_part(boundary, location, *error)
+                continue
+
+            try:
+                result = fetch(member_name)
+            except TILE_ERRORS as e:
+                yield batch_error_part(boundary, location, *tile_error(e))
+                continue
+
+            headers = []
+            if MIME_TYPES.get(fmt):
+                headers.append(('Content-Type', MIME_TYPES[fmt]))
+            if result.content_encoding:
+                headers.append(('Content-Encoding', result.content_encoding))
+            if result.cache_info.last_modified:
+                headers.append(('Last-Modified', http_date(result.cache_info.last_modified)))
+            headers.append(('ETag', quote_etag(tile_etag(result))))
+            yield batch_part(boundary, location, 200, headers, result.data)
+
+    yield ('--%s--\r\n' % boundary).encode('ascii')
+
+
+def batch_response(layer, fmt, tile_pixel_size):
+    """
+    The response to a request for a batch of tiles from the layer. Each
+    metatile holding some of the tiles is fetched once, and the tiles are
+    streamed back, grouped by metatile, as the parts of a multipart/mixed
+    body, each with the tile's URL in Content-Location and its own status.
+    """
+
+    tiles = parse_batch_tiles(request.args)
+    groups = {}
+    for z, x, y in tiles:
+        params = dict(z=z, x=x, y=y, fmt=fmt, tile_pixel_size=tile_pixel_size)
+        meta, member_name, _ = parse_routed_tile_request(layer, params, headers={})
+        groups.setdefault(meta, []).append(((z, x, y), member_name))
+
+    # Flask-Compress leaves multipart responses alone, so each tile is
+    # compressed instead.
+    content_encoding = best_encoding(request.headers.get('Accept-Encoding', ''))
+    boundary = os.urandom(16).hex()
+
+    response = current_app.response_class(stream_with_context(
+        batch_parts(groups, fmt, content_encoding, boundary, prefetches_around(layer))))
+    response.content_type = 'multipart/mixed; boundary=' + boundary
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get("CACHE_MAX_AGE")
+    if current_app.config.get("SHARED_CACHE_MAX_AGE"):
+        response.cache_control.s_maxage = current_app.config.get("SHARED_CACHE_MAX_AGE")
+    return response
+
+
+@tile_bp.route('/tilezen/vector/v1/<int:tile_pixel_size>/all/batch.<fmt>')
+@tile_bp.route('/tilezen/vector/v1/all/batch.<fmt>')
+def handle_tile_batch(fmt, tile_pixel_size=None):
+    return batch_response('vector', fmt, tile_pixel_size)
+
+
+@tile_bp.route('/tilezen/landcover/v1/<int:tile_pixel_size>/all/batch.<fmt>')
+@tile_bp.route('/tilezen/landcover/v1/all/batch.<fmt>')
+def handle_landcover_tile_batch(fmt, tile_pixel_size=None):
+    return batch_response('landcover', fmt, tile_pixel_size)
+
+
+@tile_bp.route('/metrics')
+def prometheus_metrics():
+    if current_app.metrics is None:
+        return abort(404)
+
+    resp = make_response(current_app.metrics.render())
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
 
 
 @tile_bp.route('/health_check')
@@ -0,0 +1,323 @@
+"""
+A metatile cache in a memory-mapped file, shared by all the worker
+processes on a host, so that a metatile fetched by one of them is a hit for
+all the others, without a network hop to Redis.
+
+The file holds a header, a hash index and a ring buffer of entries. Each
+entry is the metatile's key followed by the metatile, encoded as in
+cache_codec.py. New entries are written at the head of the ring, over the
+oldest ones, so entries are evicted in the order they were written, except
+that hits on entries which are about to be overwritten write them again at
+the head, which keeps popular metatiles in the cache.
+
+Writes are serialized between processes by a lock on the file, and between
+threads by a lock in each process. Reads take no locks: they look up the
+entry, decode it straight out of the mapping, and then check that the ring
+hasn't been written over it in the meantime. The header records how far
+into the ring has been reserved for writing, counting from when the file
+was made, so an entry written at position p is intact as long as less than
+a ring's length has been reserved since.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+from cache_codec import BadCacheEntryException, decode_response, encode_response
+
+MAGIC = b'TSMC'
+VERSION = 1
+
+# magic, version, number of buckets, size of the ring, and how far into
+# the ring has been reserved for writing.
+HEADER = struct.Struct('<4sLL4xQQ')
+HEADER_SIZE = 64
+RESERVED = struct.Struct('<Q')
+RESERVED_OFFSET = 24
+
+# each bucket of the index has WAYS slots of the hash of the key, where
+# the entry starts in the ring and its length.
+WAYS = 4
+SLOT = struct.Struct('<QQL4x')
+
+# each entry in the ring is the length of the key and of the value, then
+# the key, then the value.
+ENTRY = struct.Struct('<HL')
+
+# entries within this fraction of the ring's length of being overwritten
+# are written again when they're hit.
+REINSERT_FRACTION = 0.25
+
+
+class SharedMemoryCache(object):
+    """
+    Metatiles kept in the memory-mapped file at `path`, with a ring of
+    `max_bytes`, and an index of `buckets` * 4 slots. This has the same
+    methods as the shared caches in cache_codec.py, and is used in place
+    of them.
+
+    The file is made the first time it's opened, and replaced with a new
+    one if it doesn't have the layout asked for. Processes which already
+    had the old one open carry on using it.
+    """
+
+    def __init__(self, path, max_bytes, buckets):
+        self.path = path
+        self.ring_size = max_bytes
+        self.buckets = buckets
+        self.ring_start = HEADER_SIZE + buckets * WAYS * SLOT.size
+        self.size = self.ring_start + max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.reinsertions = 0
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        self.fd = self.lock_file = self.open_file()
+        self.pid = os.getpid()
+        try:
+            self.mm = mmap.mmap(self.fd, self.size)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def open_file(self):
+        """
+        Open the file, making it if it doesn't have the layout asked for,
+        and return its descriptor.
+        """
+
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # another process may have replaced the file while we
+                # waited for the lock, in which case start again with it.
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    continue
+                if self.has_layout(fd):
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    return os.dup(fd)
+                return self.make_file()
+            finally:
+                os.close(fd)
+
+    def has_layout(self, fd):
+        if os.fstat(fd).st_size != self.size:
+            return False
+        header = os.pread(fd, HEADER.size, 0)
+        (magic, version, buckets, ring_size, _) = HEADER.unpack(header)
+        return (magic, version, buckets, ring_size) == \
+            (MAGIC, VERSION, self.buckets, self.ring_size)
+
+    def make_file(self):
+        """
+        Make a new file with the layout asked for, returning its descriptor.
+        Other processes may still have the old one mapped, and would crash
+        with SIGBUS if it shrank under them, so rather than resizing it, the
+        new one is made beside it and renamed over it.
+        """
+
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            # a new file is all zeroes, so its index is empty.
+            os.ftruncate(fd, self.size)
+            os.pwrite(fd, HEADER.pack(MAGIC, VERSION, self.buckets, self.ring_size, 0), 0)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def close(self):
+        self.mm.close()
+        if self.lock_file != self.fd:
+            os.close(self.lock_file)
+        os.close(self.fd)
+
+    @staticmethod
+    def key_hash(key):
+        h = int.from_bytes(hashlib.blake2b(key.encode('utf8'), digest_size=8).digest(), 'little')
+        # zero marks an empty slot.
+        return h or 1
+
+    def slot_offsets(self, h):
+        bucket = HEADER_SIZE + (h % self.buckets) * WAYS * SLOT.size
+        return range(bucket, bucket + WAYS * SLOT.size, SLOT.size)
+
+    def reserved(self):
+        return RESERVED.unpack_from(self.mm, RESERVED_OFFSET)[0]
+
+    def intact(self, start, reserved=None):
+        if reserved is None:
+            reserved = self.reserved()
+        return reserved - start <= self.ring_size
+
+    def lookup(self, h):
+        """
+        Returns where the entry for the key with hash `h` starts in the ring
+        and its length, or None if it isn't there.
+        """
+
+        for offset in self.slot_offsets(h):
+            slot_hash, start, length = SLOT.unpack_from(self.mm, offset)
+            if slot_hash == h and length and self.intact(start):
+                return start, length
+        return None
+
+    def __contains__(self, key):
+        # the entry might still be overwritten before it's read.
+        return self.lookup(self.key_hash(key)) is not None
+
+    def get(self, key):
+        h = self.key_hash(key)
+        found = self.lookup(h)
+        if found is None:
+            self.count('misses')
+            return None
+
+        start, length = found
+        pos = self.ring_start + start % self.ring_size
+        key_bytes = key.encode('utf8')
+        value = None
+        with memoryview(self.mm) as view:
+            try:
+                key_length, value_length = ENTRY.unpack_from(view, pos)
+                if key_length == len(key_bytes) and \
+                        ENTRY.size + key_length + value_length == length and \
+                        view[pos + ENTRY.size:pos + ENTRY.size + key_length] == key_bytes:
+                    value_start = pos + ENTRY.size + key_length
+                    value = decode_response(view[value_start:value_start + value_length])
+            except (BadCacheEntryException, UnicodeDecodeError, struct.error, ValueError,
+                    OverflowError, OSError):
+                # it might have been overwritten while we were reading it,
+                # leaving anything in its fields, such as a timestamp which
+                # is out of range.
+                value = None
+
+        reserved = self.reserved()
+        if value is None or not self.intact(start, reserved):
+            self.count('misses')
+            return None
+
+        self.count('hits')
+        if reserved - start > self.ring_size * (1 - REINSERT_FRACTION):
+            self.reinsert(h, start, length)
+        return value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        key_bytes = key.encode('utf8')
+        value = encode_response(value)
+        entry = ENTRY.pack(len(key_bytes), len(value)) + key_bytes + value
+        # anything bigger would push too much else out.
+        if len(entry) > self.ring_size // 4:
+            return
+
+        with self.write_lock():
+            self.write(self.key_hash(key), entry)
+            self.sets += 1
+
+    def delete(self, key):
+        h = self.key_hash(key)
+        with self.write_lock():
+            for offset in self.slot_offsets(h):
+                if SLOT.unpack_from(self.mm, offset)[0] == h:
+                    SLOT.pack_into(self.mm, offset, 0, 0, 0)
+
+    def reinsert(self, h, start, length):
+        # only if nobody else is writing, as it's not worth waiting for.
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            fd = self.lock_fd()
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                pos = self.ring_start + start % self.ring_size
+                entry = self.mm[pos:pos + length]
+                # check it wasn't overwritten or moved by another process
+                # before we took the lock.
+                if self.lookup(h) == (start, length):
+                    self.write(h, entry)
+                    self.reinsertions += 1
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def count(self, name):
+        # gets aren't locked otherwise, so the counts need a lock of their
+        # own.
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @contextmanager
+    def write_lock(self):
+        with self._lock:
+            fd = self.lock_fd()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def lock_fd(self):
+        # a process forked after the file was opened shares the lock on it
+        # with its parent, so it needs to open the file again to lock it.
+        if self.pid != os.getpid():
+            self.lock_file = os.open(self.path, os.O_RDWR)
+            self.pid = os.getpid()
+        return self.lock_file
+
+    def write(self, h, entry):
+        """
+        Write the entry at the head of the ring and point the index at it.
+        Must be called with the write lock held.
+        """
+
+        length = len(entry)
+        start = self.reserved()
+        # entries don't wrap around the end of the ring, so skip to the
+        # start of it if this one won't fit.
+        if start % self.ring_size + length > self.ring_size:
+            start += self.ring_size - start % self.ring_size
+
+        # reserve the space before writing to it, so that readers of the
+        # entries being overwritten know they have been.
+        RESERVED.pack_into(self.mm, RESERVED_OFFSET, start + length)
+        pos = self.ring_start + start % self.ring_size
+        self.mm[pos:pos + length] = entry
+
+        # use the slot already holding the key, or an empty one, or else
+        # the one holding the oldest entry.
+        slot = None
+        oldest = None
+        for offset in self.slot_offsets(h):
+            slot_hash, slot_start, slot_length = SLOT.unpack_from(self.mm, offset)
+            if slot_hash == h or not slot_length or not self.intact(slot_start, start + length):
+                slot = offset
+                break
+            if oldest is None or slot_start < oldest[1]:
+                oldest = (offset, slot_start)
+        if slot is None:
+            slot = oldest[0]
+        SLOT.pack_into(self.mm, slot, h, start, length)
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            sets=self.sets,
+            reinsertions=self.reinsertions,
+        )
+
@@ -0,0 +1,98 @@
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key, so that only the first
+    caller actually makes the call and the others wait for and share its
+    result, or its exception.
+
+    The counters record how many calls were made (leaders) and how many
+    were satisfied by waiting on another caller's call (deduplicated).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.deduplicated = 0
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def stats(self):
+        return dict(leaders=self.leaders, deduplicated=self.deduplicated)
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+            else:
+                self.deduplicated += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight(object):
+    """
+    The same as SingleFlight, for coroutines running on one event loop.
+
+    The call runs as its own task, so it carries on for the other callers
+    if the one that started it is cancelled, for example because its client
+    went away.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.deduplicated = 0
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    def stats(self):
+        return dict(leaders=self.leaders, deduplicated=self.deduplicated)
+
+    async def do(self, key, fn, *args, **kwargs):
+        # asyncio is imported here rather than with the module, so that the
+        # WSGI server doesn't pay for importing it when it starts.
+        import asyncio
+
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+            self.leaders += 1
+        else:
+            self.deduplicated += 1
+
+        return await asyncio.shield(call)
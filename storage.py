@@ -0,0 +1,896 @@
+"""
+Backends that metatiles are read from. Each one finds metatiles using the
+same key layout, from compute_key, and has the same interface:
+
+ * `location(meta)` is a string saying where the metatile is, for logs and
+   for telling fetches of different metatiles apart.
+ * `get(meta, cache_info)` returns a StorageResponse with the whole metatile
+   and its index. Backends which set `reads_members` don't have it.
+ * `get_index(meta, cache_info, deadline=None)` returns a StorageResponse
+   with the index of the metatile, and its data only if that came for free.
+ * `read_member(meta, member, member_name, etag, deadline=None)` returns the
+   raw data of a single member of the version of the metatile with the given
+   ETag.
+ * `start_deadline()` returns the deadline for a fetch starting now, or None,
+   so that a tile read with get_index and read_member has one deadline for
+   both rather than one each.
+ * `cacheable` says whether responses should be put in the metatile caches.
+ * `reads_members` says whether tiles must always be read with get_index and
+   read_member, for backends which don't hold whole metatiles.
+
+Both `get` and `get_index` raise MetatileNotModifiedException if the
+conditions in cache_info are met.
+"""
+import datetime
+import hashlib
+import mmap
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from flask import current_app
+
+from caches import LRUCache
+from metrics import record_stage, stage
+from metatile import (
+    LOCAL_HEADER,
+    BadMetatileException,
+    build_index,
+    find_central_directory,
+    member_data_offset,
+    parse_central_directory,
+    raw_member,
+)
+
+# make compatible with both 3.4+, which has enum built in, and <=3.3 which
+# doesn't.
+try:
+    from enum import Enum
+except ImportError:
+    from enum34 import Enum
+
+
+# How much of the end of a metatile to GET when fetching its index with range
+# requests. This is enough for the central directory of the usual metatile
+# sizes, and metatiles smaller than this are returned in one GET.
+METATILE_TAIL_SIZE = 16 * 1024
+# How much space to allow for the extra field of a member's local header when
+# GETting its range.
+MEMBER_EXTRA_ALLOWANCE = 64
+
+CacheInfo = namedtuple('CacheInfo', ['last_modified', 'etag'])
+# for metatiles, the index holds the parsed zip central directory so that it
+# can be cached alongside the data rather than being re-parsed on every hit.
+# for tiles, the content encoding is set if the data is still compressed.
+# fetched_at is the time.time() that a cached response was last fetched from,
+# or revalidated with, storage.
+StorageResponse = namedtuple('StorageResponse', ['data', 'cache_info', 'index', 'content_encoding', 'fetched_at'])
+StorageResponse.__new__.__defaults__ = (None, None, None)
+
+
+class MetatileNotModifiedException(Exception):
+    pass
+
+
+class MetatileNotFoundException(Exception):
+    pass
+
+
+class UnknownMetatileException(Exception):
+    pass
+
+
+class MetatileChangedException(Exception):
+    pass
+
+
+class MetatileDeadlineExceededException(UnknownMetatileException):
+    pass
+
+
+def client_error():
+    """
+    botocore's ClientError. An except clause's class is only looked up once
+    something is raised, so this keeps botocore from being imported with the
+    server, as it's slow to import and only needed for S3.
+    """
+
+    import botocore.exceptions
+    return botocore.exceptions.ClientError
+
+
+def close_response(future):
+    """
+    Close the body of a GET's response which won't be read, such as one which
+    lost a hedge, once it arrives.
+    """
+
+    if not future.cancelled() and future.exception() is None:
+        response, _ = future.result()
+        response['Body'].close()
+
+
+class KeyFormatType(Enum):
+    """
+    S3 key format options; either no hash, the hash followed by the prefix, or
+    the prefix followed by the hash. For example, for metatile 10/511/430 in
+    the 'all' layer:
+
+     * no_hash:     /180723/all/10/511/430.zip
+     * hash_prefix: /0035e/180723/all/10/511/430.zip
+     * prefix_hash: /180723/0035e/all/10/511/430.zip
+    """
+
+    NO_HASH = "{prefix}{suffix}"
+    HASH_PREFIX = "{hash}{prefix}{suffix}"
+    PREFIX_HASH = "{prefix}{hash}{suffix}"
+
+
+def compute_key(prefix, layer, meta_tile,
+                key_format_type=KeyFormatType.NO_HASH):
+    k = "{z}/{x}/{y}.{fmt}".format(
+        z=meta_tile.z,
+        x=meta_tile.x,
+        y=meta_tile.y,
+        fmt=meta_tile.format,
+    )
+
+    # in versions of code before https://github.com/tilezen/tilequeue/pull/344,
+    # we included the layer and leading slash in the hashed string. after that
+    # PR, we no longer support having a layer in the path and _also_ drop the
+    # leading slash from the hashed string.
+    if layer:
+        k = "/{layer}/{suffix}".format(
+            layer=layer,
+            suffix=k
+        )
+
+    # make sure each part is either empty or starts with a /, that means that
+    # they will combine to make a valid path.
+    h = "/" + hashlib.md5(k.encode('utf8')).hexdigest()[:5]
+    prefix = "/" + prefix if prefix else ""
+
+    if not layer:
+        # in the case where layer wasn't provided and we didn't hash the
+        # leading slash, we still need to add a leading slash so that it makes
+        # valid path.
+        k = "/" + k
+
+    k = key_format_type.value.format(
+        hash=h,
+        prefix=prefix,
+        suffix=k,
+    )
+
+    # Strip off the leading slash
+    return k[1:]
+
+
+def configured_key_format_type(config):
+    key_format_type = config.get('KEY_FORMAT_TYPE')
+    include_hash = config.get('INCLUDE_HASH')
+
+    if key_format_type:
+        return KeyFormatType[key_format_type]
+    elif include_hash == False:
+        # map include_hash onto key format types for backwards compatibility
+        return KeyFormatType.NO_HASH
+    else:
+        # note that prefix-hash is the default if neither config parameter is
+        # provided!
+        return KeyFormatType.PREFIX_HASH
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Whether an If-None-Match header value matches the (unquoted) ETag.
+    """
+
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
+
+
+def is_not_modified(cache_info, cached_info):
+    """
+    Whether the conditions of a request, in cache_info, mean that a 304 can
+    be sent for something with cached_info.
+    """
+
+    # If-None-Match takes precedence over If-Modified-Since when both are
+    # given, see RFC 7232 section 3.3.
+    if cache_info.etag:
+        return cached_info.etag is not None and etag_matches(cache_info.etag, cached_info.etag)
+
+    if cache_info.last_modified and cached_info.last_modified:
+        # HTTP dates only have a resolution of a second.
+        return cached_info.last_modified.replace(microsecond=0) <= cache_info.last_modified
+
+    return False
+
+
+class LatencyTracker(object):
+    """
+    Keeps the last `size` latencies, to estimate their percentiles. The
+    estimates are only updated every `refresh` samples, since sorting the
+    samples each time would cost more than the GETs being timed.
+    """
+
+    def __init__(self, size=1000, min_samples=100, refresh=100):
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self._samples = deque(maxlen=size)
+        self._added = 0
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._added += 1
+            if self._added % self.refresh == 0:
+                self._sorted = None
+
+    def percentile(self, p):
+        """
+        The p-th percentile of the latencies, or None if there aren't
+        enough of them yet.
+        """
+
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._samples)
+            samples = self._sorted
+
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+class S3Storage(object):
+    """
+    Reads metatiles from an S3 bucket with the boto3 `client`.
+
+    If `hedge_percentile` is set, a GET which hasn't responded by that
+    percentile of recent GET latencies, or `hedge_min_delay` seconds if
+    that's longer, is sent again, and whichever responds first is used.
+    If `deadline` is set, fetches which take longer than that many seconds,
+    including any retries, fail with MetatileDeadlineExceededException.
+    Either of these runs GETs on a pool of `max_workers` threads.
+    """
+
+    cacheable = True
+    reads_members = False
+
+    def __init__(self, client, bucket, prefix, layer,
+                 key_format_type=KeyFormatType.PREFIX_HASH,
+                 requester_pays=False, hedge_percentile=None,
+                 hedge_min_delay=0.05, deadline=None, max_workers=50):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.layer = layer
+        self.key_format_type = key_format_type
+        self.requester_pays = requester_pays
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.deadline = deadline
+        self.latencies = LatencyTracker()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) \
+            if hedge_percentile or deadline else None
+        self.gets = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_expirations = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return dict(
+            gets=self.gets,
+            hedges=self.hedges,
+            hedge_wins=self.hedge_wins,
+            deadline_expirations=self.deadline_expirations,
+        )
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def start_deadline(self):
+        if not self.deadline:
+            return None
+        return time.perf_counter() + self.deadline
+
+    def key(self, meta):
+        return compute_key(self.prefix, self.layer, meta, self.key_format_type)
+
+    def location(self, meta):
+        return "s3://%s/%s" % (self.bucket, self.key(meta))
+
+    def get_params(self, meta, cache_info=None):
+        get_params = {
+            "Bucket": self.bucket,
+            "Key": self.key(meta),
+        }
+
+        if cache_info and cache_info.last_modified:
+            get_params['IfModifiedSince'] = cache_info.last_modified
+
+        if cache_info and cache_info.etag:
+            get_params['IfNoneMatch'] = cache_info.etag
+
+        if self.requester_pays:
+            get_params['RequestPayer'] = 'requester'
+
+        return get_params
+
+    def fetch_error(self, e, meta):
+        """
+        Returns the exception to raise for a botocore ClientError from a GET
+        of the metatile.
+        """
+
+        error_code = str(e.response.get('Error', {}).get('Code'))
+        if error_code == '304':
+            return MetatileNotModifiedException()
+        elif error_code == 'NoSuchKey':
+            return MetatileNotFoundException(
+                "No metatile found at %s" % self.location(meta)
+            )
+        elif error_code in ('412', 'PreconditionFailed'):
+            return MetatileChangedException(
+                "Metatile changed at %s" % self.location(meta)
+            )
+        else:
+            return UnknownMetatileException(
+                "%s at %s" % (error_code, self.location(meta))
+            )
+
+    def range_get(self, get_params, byte_range, deadline=None):
+        """
+        GET a range of bytes from S3, returning the response, the offset that
+        the returned data starts at and the data itself.
+        """
+
+        get_params = dict(get_params, Range='bytes=%s' % byte_range)
+        response, data = self.get_object(get_params, deadline)
+        return response, range_start(response), data
+
+    def get_object(self, get_params, deadline=None):
+        """
+        GET an object, returning the response and the body, timing the wait
+        for the response separately from reading the body. With hedging or a
+        deadline both happen on the thread pool, so that the deadline covers
+        reading the body too.
+        """
+
+        if self.executor is None:
+            response, ttfb = self.timed_get_response(get_params)
+            data, body_seconds = self.timed_read_body(response)
+        else:
+            response, ttfb = self.hedged_get_response(get_params, deadline)
+            data, body_seconds = self.pooled_read_body(get_params, response, deadline)
+        record_stage('s3_ttfb', ttfb)
+        record_stage('s3_body', body_seconds)
+        return response, data
+
+    def timed_get_response(self, get_params):
+        """
+        GET an object without reading its body, returning the response and
+        how long it took. The stages are returned rather than recorded, as
+        this can run on the thread pool, away from the request's timer.
+        """
+
+        self.count('gets')
+        a = time.perf_counter()
+        response = self.client.get_object(**get_params)
+        ttfb = time.perf_counter() - a
+        self.latencies.add(ttfb)
+        return response, ttfb
+
+    @staticmethod
+    def timed_read_body(response):
+        body = response['Body']
+        a = time.perf_counter()
+        try:
+            data = body.read()
+        finally:
+            body.close()
+        return data, time.perf_counter() - a
+
+    def deadline_exceeded(self, get_params):
+        self.count('deadline_expirations')
+        return MetatileDeadlineExceededException(
+            "Deadline exceeded getting s3://%s/%s" % (get_params['Bucket'], get_params['Key']))
+
+    def hedge_delay(self):
+        if not self.hedge_percentile:
+            return None
+        delay = self.latencies.percentile(self.hedge_percentile)
+        return max(self.hedge_min_delay, delay or 0)
+
+    def hedged_get_response(self, get_params, deadline):
+        """
+        GET an object on the thread pool, sending the GET again if it's slow
+        to respond and giving up at the deadline. Only the first response's
+        body is read, and the bodies of any others are closed as they come in.
+        """
+
+        futures = [self.executor.submit(self.timed_get_response, get_params)]
+        pending = set(futures)
+        hedge_delay = self.hedge_delay()
+        error = None
+        winner = None
+
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0, deadline - time.perf_counter())
+                can_hedge = hedge_delay is not None and len(futures) == 1
+                if can_hedge:
+                    timeout = hedge_delay if timeout is None else min(hedge_delay, timeout)
+
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if future.exception() is None:
+                        if future is not futures[0]:
+                            self.count('hedge_wins')
+                        winner = future
+                        return future.result()
+                    error = error or future.exception()
+
+                if done:
+                    continue
+
+                if can_hedge and (deadline is None or time.perf_counter() < deadline):
+                    self.count('hedges')
+                    hedge = self.executor.submit(self.timed_get_response, get_params)
+                    futures.append(hedge)
+                    pending.add(hedge)
+                    continue
+
+                raise self.deadline_exceeded(get_params)
+
+            raise error
+        finally:
+            for future in futures:
+                if future is not winner:
+                    future.add_done_callback(close_response)
+
+    def pooled_read_body(self, get_params, response, deadline):
+        """
+        Read the response's body on the thread pool, closing it and giving up
+        at the deadline.
+        """
+
+        future = self.executor.submit(self.timed_read_body, response)
+        timeout = None if deadline is None else max(0, deadline - time.perf_counter())
+        done, _ = wait([future], timeout=timeout)
+        if not done:
+            response['Body'].close()
+            raise self.deadline_exceeded(get_params)
+        return future.result()
+
+    def get(self, meta, cache_info):
+        get_params = self.get_params(meta, cache_info)
+
+        try:
+            a = time.time()
+            response, data = self.get_object(get_params, self.start_deadline())
+
+            # Strip the quotes that boto includes
+            quoteless_etag = response['ETag'][1:-1]
+            with stage('zip_index'):
+                index = build_index(data)
+            result = StorageResponse(
+                data=data,
+                cache_info=CacheInfo(
+                    last_modified=response['LastModified'],
+                    etag=quoteless_etag,
+                ),
+                index=index,
+                fetched_at=time.time(),
+            )
+            duration = (time.time() - a) * 1000
+
+            current_app.logger.info("%s: Took %0.1fms to get %s byte metatile from %s", meta, duration, response['ContentLength'], self.location(meta))
+
+            return result
+        except client_error() as e:
+            raise self.fetch_error(e, meta)
+
+    def get_index(self, meta, cache_info, deadline=None):
+        get_params = self.get_params(meta, cache_info)
+        if deadline is None:
+            deadline = self.start_deadline()
+
+        try:
+            a = time.time()
+            response, tail_offset, tail = self.range_get(
+                get_params, '-%d' % METATILE_TAIL_SIZE, deadline)
+
+            head_range = index_head_range(tail, tail_offset)
+            if head_range:
+                _, _, head = self.range_get(
+                    self.index_head_params(meta, response), head_range, deadline)
+                tail = head + tail
+                tail_offset -= len(head)
+        except client_error() as e:
+            raise self.fetch_error(e, meta)
+
+        return self.index_response(meta, response, tail, tail_offset, a)
+
+    def index_head_params(self, meta, response):
+        # the rest of the central directory must come from the same version
+        # of the object as the tail.
+        head_params = self.get_params(meta)
+        head_params['IfMatch'] = response['ETag']
+        return head_params
+
+    def index_response(self, meta, response, data, offset, started):
+        """
+        The StorageResponse for the index of the metatile, from the end of
+        it in `data`, starting at `offset`, which has all of the central
+        directory.
+        """
+
+        cd_offset, cd_size, concat = find_central_directory(data, offset)
+        cd_start = cd_offset - offset
+        with stage('zip_index'):
+            index = parse_central_directory(data[cd_start:cd_start + cd_size], concat)
+        duration = (time.time() - started) * 1000
+
+        current_app.logger.info("%s: Took %0.1fms to get %s byte metatile index from %s", meta, duration, len(data), self.location(meta))
+
+        return StorageResponse(
+            data=data if offset == 0 else None,
+            cache_info=CacheInfo(
+                last_modified=response['LastModified'],
+                etag=response['ETag'][1:-1],
+            ),
+            index=index,
+            fetched_at=time.time(),
+        )
+
+    def read_member(self, meta, member, member_name, etag, deadline=None):
+        """
+        Read the raw data of a single member of the metatile with a ranged
+        GET, failing with MetatileChangedException if the metatile no longer
+        has the given ETag.
+        """
+
+        get_params = self.member_params(meta, etag)
+        if deadline is None:
+            deadline = self.start_deadline()
+
+        try:
+            a = time.time()
+            _, _, buf = self.range_get(
+                get_params, member_range(member, member_name), deadline)
+
+            rest_range = member_rest_range(member, buf)
+            if rest_range:
+                _, _, rest = self.range_get(get_params, rest_range, deadline)
+                buf += rest
+        except client_error() as e:
+            raise self.fetch_error(e, meta)
+
+        return self.member_response(meta, member, member_name, buf, a)
+
+    def member_params(self, meta, etag):
+        get_params = self.get_params(meta)
+        get_params['IfMatch'] = '"%s"' % etag
+        return get_params
+
+    def member_response(self, meta, member, member_name, buf, started):
+        duration = (time.time() - started) * 1000
+        current_app.logger.info("%s: Took %0.1fms to get %s byte member %s from %s", meta, duration, len(buf), member_name, self.location(meta))
+
+        return raw_member(buf, member, header_offset=0)
+
+
+def range_start(response):
+    # the content range looks like "bytes 1234-5677/5678"
+    content_range = response.get('ContentRange')
+    if content_range:
+        return int(content_range.split(' ')[1].split('-')[0])
+    return 0
+
+
+def index_head_range(tail, tail_offset):
+    """
+    The range to GET for the rest of the central directory of a metatile
+    if it didn't all fit in the tail, otherwise None.
+    """
+
+    cd_offset, _, _ = find_central_directory(tail, tail_offset)
+    if cd_offset < tail_offset:
+        return '%d-%d' % (cd_offset, tail_offset - 1)
+    return None
+
+
+def member_range(member, member_name):
+    # the local header before the data repeats the name and has an extra
+    # field, the length of which isn't in the index. guess at it, and
+    # member_rest_range says what else to fetch if the guess was too small.
+    length = LOCAL_HEADER.size + len(member_name.encode('utf8')) + \
+        MEMBER_EXTRA_ALLOWANCE + member.compressed_size
+    return '%d-%d' % (member.offset, member.offset + length - 1)
+
+
+def member_rest_range(member, buf):
+    """
+    The range to GET for the rest of a member when `buf`, from the start of
+    its local header, is too short, otherwise None.
+    """
+
+    needed = member_data_offset(buf, 0) + member.compressed_size
+    if len(buf) < needed:
+        return '%d-%d' % (member.offset + len(buf), member.offset + needed - 1)
+    return None
+
+
+class AsyncS3Storage(S3Storage):
+    """
+    Reads metatiles from an S3 bucket with an asyncio client, such as
+    aiobotocore's, for the async server. `get`, `get_index` and
+    `read_member` are coroutines, and whole metatiles are indexed on
+    `executor` rather than on the event loop.
+
+    GETs aren't hedged, but the deadline applies in the same way.
+    """
+
+    def __init__(self, client, bucket, prefix, layer,
+                 key_format_type=KeyFormatType.PREFIX_HASH,
+                 requester_pays=False, deadline=None, executor=None):
+        super(AsyncS3Storage, self).__init__(
+            client, bucket, prefix, layer, key_format_type,
+            requester_pays=requester_pays)
+        self.deadline = deadline
+        self.executor = executor
+
+    async def range_get(self, get_params, byte_range, deadline=None):
+        get_params = dict(get_params, Range='bytes=%s' % byte_range)
+        response, data = await self.get_object(get_params, deadline)
+        return response, range_start(response), data
+
+    async def get_object(self, get_params, deadline=None):
+        import asyncio
+
+        if deadline is None:
+            return await self.timed_get_object(get_params)
+
+        try:
+            return await asyncio.wait_for(
+                self.timed_get_object(get_params),
+                max(0, deadline - time.perf_counter()))
+        except asyncio.TimeoutError:
+            self.count('deadline_expirations')
+            raise MetatileDeadlineExceededException(
+                "Deadline exceeded getting s3://%s/%s" % (get_params['Bucket'], get_params['Key']))
+
+    async def timed_get_object(self, get_params):
+        with stage('s3_ttfb'):
+            self.count('gets')
+            a = time.perf_counter()
+            response = await self.client.get_object(**get_params)
+            self.latencies.add(time.perf_counter() - a)
+        with stage('s3_body'):
+            body = response['Body']
+            try:
+                data = await body.read()
+            finally:
+                body.close()
+        return response, data
+
+    async def get(self, meta, cache_info):
+        import asyncio
+
+        get_params = self.get_params(meta, cache_info)
+
+        try:
+            a = time.time()
+            response, data = await self.get_object(get_params, self.start_deadline())
+        except client_error() as e:
+            raise self.fetch_error(e, meta)
+
+        with stage('zip_index'):
+            index = await asyncio.get_running_loop().run_in_executor(
+                self.executor, build_index, data)
+        duration = (time.time() - a) * 1000
+
+        current_app.logger.info("%s: Took %0.1fms to get %s byte metatile from %s", meta, duration, response['ContentLength'], self.location(meta))
+
+        return StorageResponse(
+            data=data,
+            cache_info=CacheInfo(
+                last_modified=response['LastModified'],
+                etag=response['ETag'][1:-1],
+            ),
+            index=index,
+            fetched_at=time.time(),
+        )
+
+    async def get_index(self, meta, cache_info, deadline=None):
+        get_params = self.get_params(meta, cache_info)
+        if deadline is None:
+            deadline = self.start_deadline()
+
+        try:
+            a = time.time()
+            response, tail_offset, tail = await self.range_get(
+                get_params, '-%d' % METATILE_TAIL_SIZE, deadline)
+
+            head_range = index_head_range(tail, tail_offset)
+            if head_range:
+                _, _, head = await self.range_get(
+                    self.index_head_params(meta, response), head_range, deadline)
+                tail = head + tail
+                tail_offset -= len(head)
+        except client_error() as e:
+            raise self.fetch_error(e, meta)
+
+        return self.index_response(meta, response, tail, tail_offset, a)
+
+    async def read_member(self, meta, member, member_name, etag, deadline=None):
+        get_params = self.member_params(meta, etag)
+        if deadline is None:
+            deadline = self.start_deadline()
+
+        try:
+            a = time.time()
+            _, _, buf = await self.range_get(
+                get_params, member_range(member, member_name), deadline)
+
+            rest_range = member_rest_range(member, buf)
+            if rest_range:
+                _, _, rest = await self.range_get(get_params, rest_range, deadline)
+                buf += rest
+        except client_error() as e:
+            raise self.fetch_error(e, meta)
+
+        return self.member_response(meta, member, member_name, buf, a)
+
+
+class LocalStorage(object):
+    """
+    Reads metatiles from a directory laid out the same way as the S3 bucket,
+    for example one synced from it.
+
+    Metatiles are memory mapped rather than read, so only the pages of the
+    members that are used are read from disk, and only those members are
+    copied. The ETag comes from the file's inode, size and modification
+    time, and the Last-Modified from its modification time.
+
+    Files should be replaced by renaming new ones over them, as rsync does,
+    rather than being rewritten in place, so that a metatile which is still
+    mapped doesn't change underneath the requests using it.
+
+    The indexes of up to `max_index_entries` members are kept in memory, so
+    that metatiles don't need to be re-indexed on each request. Metatiles
+    themselves are already in the page cache, so shouldn't be cached again,
+    but the mappings of up to `max_mappings` of them are kept open, so that
+    each file is mapped once rather than on every request. A mapping is
+    replaced once its file changes, and closed when it's been evicted and
+    the last request using it has finished with it.
+    """
+
+    cacheable = False
+    reads_members = False
+
+    def __init__(self, root, prefix, layer,
+                 key_format_type=KeyFormatType.PREFIX_HASH,
+                 max_index_entries=1000000, max_mappings=256):
+        self.root = root
+        self.prefix = prefix
+        self.layer = layer
+        self.key_format_type = key_format_type
+        self.indexes = LRUCache(max_index_entries)
+        # each mapping holds a file descriptor, so they're counted rather
+        # than sized.
+        self.mappings = LRUCache(max_mappings, sizeof=lambda mapping: 1)
+
+    def path(self, meta):
+        return os.path.join(
+            self.root,
+            compute_key(self.prefix, self.layer, meta, self.key_format_type),
+        )
+
+    def location(self, meta):
+        return self.path(meta)
+
+    def start_deadline(self):
+        return None
+
+    @staticmethod
+    def file_cache_info(st):
+        return CacheInfo(
+            last_modified=datetime.datetime.fromtimestamp(
+                int(st.st_mtime), datetime.timezone.utc),
+            etag='%x-%x-%x' % (st.st_ino, st.st_size, st.st_mtime_ns),
+        )
+
+    def open(self, meta):
+        """
+        Returns the memory mapped metatile and its cache info, reusing the
+        mapping from an earlier request if the file hasn't changed since.
+        """
+
+        path = self.path(meta)
+
+        mapped = self.mappings.get(path)
+        if mapped is not None:
+            data, file_cache_info = mapped
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and self.file_cache_info(st).etag == file_cache_info.etag:
+                return data, file_cache_info
+            # the file has been replaced or removed. the old mapping is
+            # closed once the requests still using it have finished.
+            self.mappings.delete(path)
+
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_size == 0:
+                    raise UnknownMetatileException("Empty metatile at %s" % path)
+                # the mapping stays valid after the file is closed.
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            raise MetatileNotFoundException("No metatile found at %s" % path)
+        except OSError as e:
+            raise UnknownMetatileException("%s at %s" % (e, path))
+
+        file_cache_info = self.file_cache_info(st)
+        self.mappings.set(path, (data, file_cache_info))
+        return data, file_cache_info
+
+    def get(self, meta, cache_info):
+        a = time.time()
+        with stage('open'):
+            data, file_cache_info = self.open(meta)
+
+        if cache_info and is_not_modified(cache_info, file_cache_info):
+            raise MetatileNotModifiedException()
+
+        index_key = (self.path(meta), file_cache_info.etag)
+        index = self.indexes.get(index_key)
+        if index is None:
+            try:
+                with stage('zip_index'):
+                    index = build_index(data)
+            except BadMetatileException as e:
+                # don't keep a file which can't be read mapped.
+                self.mappings.delete(self.path(meta))
+                raise UnknownMetatileException("%s at %s" % (e, self.path(meta)))
+            self.indexes.set(index_key, index)
+
+        duration = (time.time() - a) * 1000
+        current_app.logger.info("%s: Took %0.1fms to map %s byte metatile from %s", meta, duration, len(data), self.path(meta))
+
+        return StorageResponse(
+            data=data,
+            cache_info=file_cache_info,
+            index=index,
+            fetched_at=time.time(),
+        )
+
+    def get_index(self, meta, cache_info, deadline=None):
+        # the data is mapped rather than read, so it comes for free.
+        return self.get(meta, cache_info)
+
+    def read_member(self, meta, member, member_name, etag, deadline=None):
+        data, file_cache_info = self.open(meta)
+        if file_cache_info.etag != etag:
+            raise MetatileChangedException("Metatile changed at %s" % self.path(meta))
+        return raw_member(data, member)
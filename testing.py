@@ -0,0 +1,89 @@
+"""
+Fixtures shared by the tests and the benchmarks: synthetic metatiles, and
+apps set up like the one from create_app but reading from a fake S3.
+"""
+import math
+import random
+import zipfile
+from io import BytesIO
+
+from flask import Flask
+from flask_compress import Compress
+from flask_cors import CORS
+
+from fake_s3 import FakeS3Client
+from server import (
+    KeyFormatType,
+    compute_key,
+    init_cache,
+    init_caches,
+    init_hot_set,
+    init_metrics,
+    init_prefetch,
+    init_profiling,
+    init_storage,
+    tile_bp,
+)
+
+
+def make_metatile(metatile_size=4, max_zoom_delta=None, tile_bytes=20000,
+                  fmt='mvt', seed=0):
+    """
+    Make a synthetic metatile zip with all the tiles from zoom offset 0 to
+    `max_zoom_delta`, which defaults to the deepest for the metatile size.
+    The tile contents are partially random so that they compress about as
+    well as real tiles.
+    """
+
+    if max_zoom_delta is None:
+        max_zoom_delta = int(math.log(metatile_size, 2))
+
+    rng = random.Random(seed)
+    buf = BytesIO()
+
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        for dz in range(0, max_zoom_delta + 1):
+            dim = 2 ** dz
+            for x in range(0, dim):
+                for y in range(0, dim):
+                    words = [b'%d' % rng.randint(0, 4096) for _ in range(tile_bytes // 5)]
+                    z.writestr('{}/{}/{}.{}'.format(dz, x, y, fmt), b' '.join(words)[:tile_bytes])
+
+    return buf.getvalue()
+
+
+def make_app(boto_s3=None, **config):
+    """
+    Make an app set up like the one from create_app, but reading from a fake
+    S3 client, which is available as the app's boto_s3 attribute. An
+    existing client can be passed in to share its objects between apps.
+    """
+
+    app = Flask('server')
+    app.config.from_object('config')
+    app.config.update(
+        CACHE_TYPE='null',
+        S3_BUCKET='bucket',
+        S3_PREFIX='prefix',
+        KEY_FORMAT_TYPE='NO_HASH',
+    )
+    app.config.update(config)
+
+    CORS(app)
+    Compress(app)
+    init_cache(app)
+    init_caches(app)
+    init_storage(app, boto_s3 or FakeS3Client())
+    init_prefetch(app)
+    init_hot_set(app)
+    init_metrics(app)
+    init_profiling(app)
+    app.register_blueprint(tile_bp)
+
+    return app
+
+
+def put_metatile(app, meta, data):
+    key = compute_key(app.config['S3_PREFIX'], app.config['S3_LAYER'], meta,
+                      KeyFormatType[app.config['KEY_FORMAT_TYPE']])
+    app.boto_s3.put_object(Bucket=app.config['S3_BUCKET'], Key=key, Body=data)
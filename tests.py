@@ -1,7 +1,21 @@
 import unittest
+import zlib
+from testing import put_metatile
 from server import TileRequest
 
 
+def make_test_app(**config):
+    """
+    Make an app serving tiles from a fake S3 client, which is available as
+    the app's boto_s3 attribute.
+    """
+    from testing import make_app
+
+    test_config = dict(METATILE_SIZE=4, METATILE_MAX_DETAIL_ZOOM=None)
+    test_config.update(config)
+    return make_app(**test_config)
+
+
 class MetatileTestCase(unittest.TestCase):
     def assertTileEquals(self, expected, actual):
         self.assertEqual(expected.z, actual.z)
@@ -175,9 +189,2060 @@ class MetatileTestCase(unittest.TestCase):
             compute_key('180723', '', t2, KeyFormatType.HASH_PREFIX))
 
 
+class ExtractTileTestCase(unittest.TestCase):
+    def make_zip(self, members, prefix=b''):
+        import zipfile
+        from io import BytesIO
+
+        buf = BytesIO()
+        buf.write(prefix)
+        with zipfile.ZipFile(buf, 'w') as z:
+            for name, data, compress_type in members:
+                z.writestr(name, data, compress_type)
+        return buf.getvalue()
+
+    def test_build_index(self):
+        import zipfile
+        from metatile import build_index, read_member
+
+        data = self.make_zip([
+            ('0/0/0.mvt', b'stored tile', zipfile.ZIP_STORED),
+            ('1/1/0.mvt', b'deflated tile' * 100, zipfile.ZIP_DEFLATED),
+        ])
+        index = build_index(data)
+
+        self.assertEqual(['0/0/0.mvt', '1/1/0.mvt'], sorted(index.keys()))
+        self.assertEqual(b'stored tile', read_member(data, index['0/0/0.mvt']))
+        self.assertEqual(b'deflated tile' * 100, read_member(data, index['1/1/0.mvt']))
+
+    def test_build_index_prepended_data(self):
+        import zipfile
+        from metatile import build_index, read_member
+
+        # the index offsets should still be correct when the zip doesn't start
+        # at the beginning of the buffer.
+        data = self.make_zip([
+            ('0/0/0.json', b'{"tile": true}', zipfile.ZIP_DEFLATED),
+        ], prefix=b'x' * 100)
+        index = build_index(data)
+
+        self.assertEqual(b'{"tile": true}', read_member(data, index['0/0/0.json']))
+
+    def test_build_index_not_a_zip(self):
+        from metatile import BadMetatileException, build_index
+
+        with self.assertRaises(BadMetatileException):
+            build_index(b'this is not a zip file')
+
+    def test_extract_tile(self):
+        import zipfile
+        from server import TileNotFoundInMetatile, extract_tile, t2_extract_tile
+        from metatile import build_index
+
+        data = self.make_zip([
+            ('1/0/1.mvt', b'vector tile', zipfile.ZIP_DEFLATED),
+            ('7/10/20@2x.mvt', b'landcover tile', zipfile.ZIP_DEFLATED),
+        ])
+
+        self.assertEqual(b'vector tile', extract_tile(data, TileRequest(1, 0, 1, 1, 'mvt')))
+        self.assertEqual(b'vector tile', extract_tile(
+            data, TileRequest(1, 0, 1, 1, 'mvt'), build_index(data)))
+        self.assertEqual(b'landcover tile', t2_extract_tile(data, TileRequest(7, 10, 20, 2, 'mvt')))
+
+        with self.assertRaises(TileNotFoundInMetatile):
+            extract_tile(data, TileRequest(1, 1, 1, 1, 'mvt'))
+        with self.assertRaises(TileNotFoundInMetatile):
+            t2_extract_tile(data, TileRequest(7, 10, 20, 1, 'mvt'))
+
+
 class HandleTileTestCase(unittest.TestCase):
     def test_handle_tile_storage_hit(self):
-        pass
+        from testing import make_metatile
+        from server import extract_tile
+
+        app = make_test_app()
+        metatile = make_metatile(fmt='mvt')
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), metatile)
+
+        resp = app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('application/x-protobuf', resp.content_type)
+        self.assertEqual(extract_tile(metatile, TileRequest(2, 1, 2, 1, 'mvt')), resp.data)
+
+    def test_handle_tile_storage_miss(self):
+        app = make_test_app()
+
+        resp = app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+
+        self.assertEqual(404, resp.status_code)
+
+
+class BatchTestCase(unittest.TestCase):
+    metas = [TileRequest(10, 100, 200, 1, 'zip'), TileRequest(10, 101, 200, 1, 'zip')]
+
+    def setUp(self):
+        from testing import make_metatile
+
+        self.app = make_test_app()
+        self.metatiles = [make_metatile(fmt='mvt', seed=seed) for seed in range(2)]
+        for meta, metatile in zip(self.metas, self.metatiles):
+            put_metatile(self.app, meta, metatile)
+
+    def parts(self, resp):
+        """
+        The parts of a multipart response as (headers, body), keyed by their
+        Content-Location.
+        """
+
+        boundary = resp.mimetype_params['boundary'].encode('ascii')
+        parts = {}
+        for part in resp.data.split(b'--' + boundary)[1:-1]:
+            head, body = part[2:-2].split(b'\r\n\r\n', 1)
+            headers = dict(line.split(': ', 1) for line in head.decode('utf8').split('\r\n'))
+            parts[headers['Content-Location']] = (headers, body)
+        self.assertTrue(resp.data.endswith(b'--' + boundary + b'--\r\n'))
+        return parts
+
+    def test_range(self):
+        from server import extract_tile
+
+        resp = self.app.test_client().get('/tilezen/vector/v1/256/all/batch.mvt?z=12&x=403-404&y=802-803')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('multipart/mixed', resp.mimetype)
+
+        parts = self.parts(resp)
+        self.assertEqual(4, len(parts))
+        headers, body = parts['/tilezen/vector/v1/256/all/12/404/803.mvt']
+        self.assertEqual('200', headers['Status'])
+        self.assertEqual('application/x-protobuf', headers['Content-Type'])
+        self.assertEqual(extract_tile(self.metatiles[1], TileRequest(2, 0, 3, 1, 'mvt')), body)
+        # one GET for each metatile, rather than for each tile.
+        self.assertEqual(2, self.app.boto_s3.get_count)
+
+    def test_list_with_missing(self):
+        import gzip
+        from server import extract_tile
+
+        resp = self.app.test_client().get(
+            '/tilezen/vector/v1/256/all/batch.mvt?tiles=12/401/802,12/401/802,12/399/802',
+            headers={'Accept-Encoding': 'gzip'})
+        parts = self.parts(resp)
+        self.assertEqual(2, len(parts))
+        headers, body = parts['/tilezen/vector/v1/256/all/12/401/802.mvt']
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        self.assertEqual(extract_tile(self.metatiles[0], TileRequest(2, 1, 2, 1, 'mvt')), gzip.decompress(body))
+        headers, body = parts['/tilezen/vector/v1/256/all/12/399/802.mvt']
+        self.assertEqual('404', headers['Status'])
+
+    def test_range_requests(self):
+        from server import extract_tile
+
+        app = make_test_app(S3_RANGE_REQUESTS=True, boto_s3=self.app.boto_s3)
+        resp = app.test_client().get('/tilezen/vector/v1/256/all/batch.mvt?z=12&x=400-401&y=800-801')
+        parts = self.parts(resp)
+        _, body = parts['/tilezen/vector/v1/256/all/12/401/801.mvt']
+        self.assertEqual(extract_tile(self.metatiles[0], TileRequest(2, 1, 1, 1, 'mvt')), body)
+        # one GET for the index, and one for each tile.
+        self.assertEqual(5, app.boto_s3.get_count)
+
+    def test_range_requests_deadline(self):
+        from fake_s3 import FakeS3Client
+
+        boto_s3 = FakeS3Client(latency=0.1)
+        boto_s3.objects = self.app.boto_s3.objects
+        app = make_test_app(S3_RANGE_REQUESTS=True, S3_DEADLINE_MS=250, boto_s3=boto_s3)
+        resp = app.test_client().get('/tilezen/vector/v1/256/all/batch.mvt?z=12&x=400-401&y=800-801')
+        parts = self.parts(resp)
+        # the index and the first tiles are read within the metatile's
+        # deadline, but the rest have to share it, rather than each having
+        # one of their own.
+        statuses = [headers['Status'] for headers, _ in parts.values()]
+        self.assertIn('200', statuses)
+        self.assertIn('500', statuses)
+        self.assertEqual(statuses.count('500'), app.storage.deadline_expirations)
+
+    def test_shared_cache_read_at_once(self):
+        from cache_codec import make_shared_cache
+        from fake_redis import FakeRedisClient
+        from flask_caching.backends import RedisCache
+
+        client = FakeRedisClient()
+        self.app.shared_cache = make_shared_cache(RedisCache(host=client))
+        url = '/tilezen/vector/v1/256/all/batch.mvt?z=12&x=403-404&y=802-803'
+        self.parts(self.app.test_client().get(url))
+        self.assertEqual(2, self.app.boto_s3.get_count)
+
+        round_trips = client.round_trips
+        parts = self.parts(self.app.test_client().get(url))
+        self.assertEqual(4, len(parts))
+        self.assertTrue(all(headers['Status'] == '200' for headers, _ in parts.values()))
+        # both metatiles in one round trip, and none from S3.
+        self.assertEqual(round_trips + 1, client.round_trips)
+        self.assertEqual(2, self.app.boto_s3.get_count)
+
+    def test_invalid(self):
+        client = self.app.test_client()
+        for query in ('', 'tiles=12/401', 'z=12&x=0-20&y=0-20', 'tiles=12/5000/1'):
+            resp = client.get('/tilezen/vector/v1/256/all/batch.mvt?' + query)
+            self.assertEqual(400, resp.status_code, query)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        from caches import LRUCache
+
+        c = LRUCache(10)
+        c.set('a', b'1234')
+        c.set('b', b'1234')
+        self.assertEqual(b'1234', c.get('a'))
+
+        # 'b' is the least recently used, so it's the one to go
+        c.set('c', b'1234')
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(b'1234', c.get('a'))
+        self.assertEqual(b'1234', c.get('c'))
+
+        self.assertEqual(8, c.current_bytes)
+        self.assertEqual(dict(hits=3, misses=1, evictions=1, entries=2,
+                              bytes=8, max_bytes=10), c.stats())
+
+    def test_replace_and_delete(self):
+        from caches import LRUCache
+
+        c = LRUCache(10)
+        c.set('a', b'1234')
+        c.set('a', b'12')
+        self.assertEqual(2, c.current_bytes)
+        c.delete('a')
+        self.assertEqual(0, c.current_bytes)
+        self.assertIsNone(c.get('a'))
+
+    def test_too_big(self):
+        from caches import LRUCache
+
+        c = LRUCache(10)
+        c.set('a', b'1234')
+        self.assertFalse(c.set('b', b'12345678901'))
+        self.assertEqual(b'1234', c.get('a'))
+        self.assertIsNone(c.get('b'))
+
+    def test_frequency_sketch(self):
+        from caches import FrequencySketch
+
+        sketch = FrequencySketch(64, sample_size=1000)
+        for _ in range(0, 5):
+            sketch.increment('a')
+        sketch.increment('b')
+
+        self.assertGreaterEqual(sketch.estimate('a'), 5)
+        self.assertGreaterEqual(sketch.estimate('b'), 1)
+        self.assertLess(sketch.estimate('b'), 5)
+
+        sketch.reset()
+        self.assertGreaterEqual(sketch.estimate('a'), 2)
+        self.assertLess(sketch.estimate('a'), 5)
+
+    def test_tinylfu_resists_scans(self):
+        from caches import TinyLFUCache
+
+        c = TinyLFUCache(100, window_fraction=0.1, expected_entries=100)
+        for _ in range(0, 5):
+            for i in range(0, 8):
+                key = ('hot', i)
+                if c.get(key) is None:
+                    c.set(key, b'x' * 10)
+
+        # a sweep through lots of keys, each used once, doesn't displace the
+        # popular ones.
+        for i in range(0, 100):
+            key = ('sweep', i)
+            if c.get(key) is None:
+                c.set(key, b'x' * 10)
+
+        for i in range(0, 8):
+            self.assertIn(('hot', i), c)
+        self.assertGreater(c.rejections, 0)
+        self.assertLessEqual(c.stats()['bytes'], 100)
+
+    def test_metatile_cache(self):
+        from testing import make_metatile
+
+        app = make_test_app(METATILE_CACHE_MAX_BYTES=10 * 1024 * 1024)
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile())
+        client = app.test_client()
+
+        for y in (800, 801, 802):
+            resp = client.get('/tilezen/vector/v1/256/all/12/400/%d.mvt' % y)
+            self.assertEqual(200, resp.status_code)
+
+        self.assertEqual(1, app.boto_s3.get_count)
+        self.assertEqual(2, app.metatile_cache.hits)
+
+    def test_promote_from_shared_cache(self):
+        from server import CacheInfo, StorageResponse, cache_get, cache_set
+
+        app = make_test_app(CACHE_TYPE='simple', METATILE_CACHE_MAX_BYTES=1024)
+        key = TileRequest(10, 100, 200, 1, 'zip')
+        value = StorageResponse(b'data', CacheInfo(None, 'etag'))
+        with app.app_context():
+            cache_set(key, value)
+            app.metatile_cache.clear()
+
+            self.assertEqual(value, cache_get(key))
+            self.assertIn(key, app.metatile_cache)
+
+
+class NegativeCacheTestCase(unittest.TestCase):
+    def test_expiry_and_eviction(self):
+        from caches import NegativeCache
+
+        now = [1000.0]
+        c = NegativeCache(2, 10, clock=lambda: now[0])
+        c.add('a')
+        self.assertIn('a', c)
+        self.assertNotIn('b', c)
+
+        now[0] += 11
+        self.assertNotIn('a', c)
+
+        c.add('a')
+        c.add('b')
+        c.add('c')
+        self.assertNotIn('a', c)
+        self.assertIn('c', c)
+        self.assertEqual(1, c.evictions)
+
+    def test_find(self):
+        from caches import NegativeCache
+
+        c = NegativeCache(10, 10)
+        c.add('b')
+        self.assertEqual('b', c.find('a', 'b'))
+        self.assertIsNone(c.find('a', 'c'))
+        # one lookup of several keys is one hit or miss.
+        self.assertEqual(1, c.hits)
+        self.assertEqual(1, c.misses)
+
+    def test_missing_metatile(self):
+        app = make_test_app(NEGATIVE_CACHE_TTL=60)
+        client = app.test_client()
+
+        for _ in range(0, 3):
+            resp = client.get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+            self.assertEqual(404, resp.status_code)
+
+        self.assertEqual(1, app.boto_s3.get_count)
+        self.assertEqual(2, app.negative_cache.hits)
+        self.assertEqual(1, app.negative_cache.misses)
+
+    def test_missing_tile(self):
+        import zipfile
+        from io import BytesIO
+
+        app = make_test_app(NEGATIVE_CACHE_TTL=60)
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as z:
+            z.writestr('0/0/0.mvt', b'tile')
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), buf.getvalue())
+        client = app.test_client()
+
+        for _ in range(0, 3):
+            resp = client.get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+            self.assertEqual(404, resp.status_code)
+
+        # the tile that is there can still be fetched
+        resp = client.get('/tilezen/vector/v1/1024/all/10/100/200.mvt')
+        self.assertEqual(b'tile', resp.data)
+
+        self.assertEqual(2, app.boto_s3.get_count)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def fetch_concurrently(self, app, meta, count=8):
+        import threading
+        from server import CacheInfo, metatile_fetch
+
+        results = []
+        errors = []
+
+        def fetch():
+            with app.app_context():
+                try:
+                    results.append(metatile_fetch(meta, CacheInfo(None, None)))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=fetch) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return results, errors
+
+    def test_concurrent_fetches_share_get(self):
+        from testing import make_metatile
+        from server import metatile_flights
+
+        app = make_test_app()
+        app.boto_s3.latency = 0.2
+        meta = TileRequest(10, 100, 200, 1, 'zip')
+        put_metatile(app, meta, make_metatile(max_zoom_delta=1))
+        deduplicated = metatile_flights.deduplicated
+
+        results, errors = self.fetch_concurrently(app, meta)
+
+        self.assertEqual([], errors)
+        self.assertEqual(8, len(results))
+        self.assertEqual(1, app.boto_s3.get_count)
+        self.assertEqual(7, metatile_flights.deduplicated - deduplicated)
+
+    def test_concurrent_fetches_share_error(self):
+        from server import MetatileNotFoundException
+
+        app = make_test_app()
+        app.boto_s3.latency = 0.2
+
+        results, errors = self.fetch_concurrently(app, TileRequest(10, 100, 200, 1, 'zip'))
+
+        self.assertEqual([], results)
+        self.assertEqual(8, len(errors))
+        self.assertTrue(all(isinstance(e, MetatileNotFoundException) for e in errors))
+        self.assertEqual(1, app.boto_s3.get_count)
+
+
+class GzipPassthroughTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+
+    def setUp(self):
+        from testing import make_metatile
+        from server import extract_tile
+
+        self.metatile = make_metatile(fmt='mvt')
+        self.tile = extract_tile(self.metatile, TileRequest(2, 1, 2, 1, 'mvt'))
+
+    def get(self, headers, **config):
+        config.setdefault('GZIP_PASSTHROUGH', True)
+        app = make_test_app(**config)
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), self.metatile)
+        return app.test_client().get(self.url, headers=headers)
+
+    def test_gzip_member(self):
+        import gzip
+        from metatile import build_index, gzip_member, raw_member
+
+        index = build_index(self.metatile)
+        member = index['2/1/2.mvt']
+        data = gzip_member(raw_member(self.metatile, member), member)
+        self.assertEqual(self.tile, gzip.decompress(data))
+
+    def test_passthrough(self):
+        import gzip
+
+        resp = self.get({'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(self.tile, gzip.decompress(resp.data))
+
+    def test_gzip_not_accepted(self):
+        for headers in ({}, {'Accept-Encoding': 'identity'}):
+            resp = self.get(headers)
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(self.tile, resp.data)
+
+    def test_passthrough_disabled(self):
+        import gzip
+
+        # the tile is decompressed, and then compressed again by Flask-Compress
+        resp = self.get({'Accept-Encoding': 'gzip'}, GZIP_PASSTHROUGH=False)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertEqual(self.tile, gzip.decompress(resp.data))
+
+    def test_etag_per_encoding(self):
+        identity = self.get({})
+        gzipped = self.get({'Accept-Encoding': 'gzip'})
+        self.assertNotEqual(identity.headers['ETag'], gzipped.headers['ETag'])
+        self.assertEqual(identity.headers['ETag'][:-1] + ':gzip"', gzipped.headers['ETag'])
+
+        # either ETag is the same metatile.
+        for etag in (identity.headers['ETag'], gzipped.headers['ETag']):
+            resp = self.get({'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            self.assertEqual(304, resp.status_code)
+
+    def test_range_request_passthrough(self):
+        import gzip
+
+        resp = self.get({'Accept-Encoding': 'gzip'}, S3_RANGE_REQUESTS=True)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertEqual(self.tile, gzip.decompress(resp.data))
+
+
+class TileContentETagTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+    meta = TileRequest(10, 100, 200, 1, 'zip')
+
+    def make_metatile(self, tiles):
+        import zipfile
+        from io import BytesIO
+
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, data in tiles.items():
+                z.writestr(name, data)
+        return buf.getvalue()
+
+    def check_rebuild(self, app):
+        put_metatile(app, self.meta, self.make_metatile({'2/1/2.mvt': b'same', '2/0/0.mvt': b'old'}))
+        client = app.test_client()
+        etag = client.get(self.url).headers['ETag']
+        other_etag = client.get('/tilezen/vector/v1/256/all/12/400/800.mvt').headers['ETag']
+        self.assertNotEqual(etag, other_etag)
+
+        put_metatile(app, self.meta, self.make_metatile({'2/1/2.mvt': b'same', '2/0/0.mvt': b'new'}))
+        resp = client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(304, resp.status_code)
+        resp = client.get('/tilezen/vector/v1/256/all/12/400/800.mvt', headers={'If-None-Match': other_etag})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(b'new', resp.data)
+
+    def test_rebuilt_metatile(self):
+        self.check_rebuild(make_test_app(TILE_CONTENT_ETAGS=True))
+
+    def test_range_requests(self):
+        self.check_rebuild(make_test_app(TILE_CONTENT_ETAGS=True, S3_RANGE_REQUESTS=True))
+
+    def test_metatile_etags(self):
+        app = make_test_app()
+        put_metatile(app, self.meta, self.make_metatile({'2/1/2.mvt': b'same', '2/0/0.mvt': b'old'}))
+        client = app.test_client()
+        etag = client.get(self.url).headers['ETag']
+
+        put_metatile(app, self.meta, self.make_metatile({'2/1/2.mvt': b'same', '2/0/0.mvt': b'new'}))
+        resp = client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(200, resp.status_code)
+
+
+class TileCacheTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+    meta = TileRequest(10, 100, 200, 1, 'zip')
+
+    def setUp(self):
+        from testing import make_metatile
+        from server import extract_tile
+
+        self.app = make_test_app(TILE_CACHE_MAX_BYTES=1024 * 1024)
+        self.metatile = make_metatile(fmt='mvt')
+        self.tile = extract_tile(self.metatile, TileRequest(2, 1, 2, 1, 'mvt'))
+        put_metatile(self.app, self.meta, self.metatile)
+
+    def test_cached_per_encoding(self):
+        import gzip
+
+        client = self.app.test_client()
+        for _ in range(0, 2):
+            resp = client.get(self.url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual('gzip', resp.headers['Content-Encoding'])
+            self.assertEqual(self.tile, gzip.decompress(resp.data))
+            gzip_etag = resp.headers['ETag']
+
+            resp = client.get(self.url)
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(self.tile, resp.data)
+            self.assertEqual(resp.headers['ETag'][:-1] + ':gzip"', gzip_etag)
+
+        stats = self.app.tile_cache.stats()
+        self.assertEqual(2, stats['entries'])
+        self.assertEqual(2, stats['hits'])
+
+    def test_brotli(self):
+        from metatile import brotli
+
+        if brotli is None:
+            self.skipTest("brotli is not installed")
+
+        resp = self.app.test_client().get(self.url, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual('br', resp.headers['Content-Encoding'])
+        self.assertEqual(self.tile, brotli.decompress(resp.data))
+        self.assertTrue(resp.headers['ETag'].endswith(':br"'))
+
+    def test_metatile_changed(self):
+        from testing import make_metatile
+        from server import extract_tile
+
+        client = self.app.test_client()
+        client.get(self.url)
+
+        metatile = make_metatile(fmt='mvt', seed=1)
+        put_metatile(self.app, self.meta, metatile)
+
+        resp = client.get(self.url)
+        self.assertEqual(extract_tile(metatile, TileRequest(2, 1, 2, 1, 'mvt')), resp.data)
+
+
+class CacheCodecTestCase(unittest.TestCase):
+    def make_response(self, **kwargs):
+        import datetime
+        from testing import make_metatile
+        from metatile import build_index
+        from server import CacheInfo, StorageResponse
+
+        metatile = make_metatile(tile_bytes=100)
+        last_modified = datetime.datetime(2018, 7, 23, 12, 30, 1, tzinfo=datetime.timezone.utc)
+        response = StorageResponse(
+            data=metatile,
+            cache_info=CacheInfo(last_modified, '"etag"'),
+            index=build_index(metatile),
+            fetched_at=1532349001.5,
+        )
+        return response._replace(**kwargs)
+
+    def test_round_trip(self):
+        from cache_codec import decode_response, encode_response
+        from metatile import ZipMember
+        from server import CacheInfo
+
+        for response in (self.make_response(),
+                         self.make_response(data=None),
+                         self.make_response(index={u'0/0/0.mv\xe9': ZipMember(1, 2, 3, 8, 4)}),
+                         self.make_response(index=None, fetched_at=None, content_encoding='gzip'),
+                         self.make_response(cache_info=CacheInfo(None, '"etag"'))):
+            self.assertEqual(response, decode_response(encode_response(response)))
+
+    def test_bad_entries_miss(self):
+        from cache_codec import SharedCache, encode_response
+
+        self.assertIsNone(SharedCache.decode(b'not a cache entry'))
+        self.assertIsNone(SharedCache.decode(encode_response(self.make_response())[:30]))
+
+    def test_redis_pipelined(self):
+        from cache_codec import make_shared_cache, RedisSharedCache
+        from fake_redis import FakeRedisClient
+        from flask_caching.backends import RedisCache
+
+        client = FakeRedisClient()
+        shared_cache = make_shared_cache(RedisCache(host=client, key_prefix='t:'))
+        self.assertIsInstance(shared_cache, RedisSharedCache)
+
+        response = self.make_response()
+        for i in range(0, 10):
+            shared_cache.set('key%d' % i, response)
+        self.assertEqual(10, client.round_trips)
+        self.assertEqual([response] * 10 + [None],
+                         shared_cache.get_many(['key%d' % i for i in range(0, 11)]))
+        self.assertEqual(11, client.round_trips)
+        self.assertIn('t:key0', client.values)
+        self.assertIn('key0', shared_cache)
+
+        shared_cache.delete('key0')
+        self.assertIsNone(shared_cache.get('key0'))
+        self.assertNotIn('key0', shared_cache)
+
+    def test_keyed_by_location(self):
+        from testing import make_metatile
+
+        app = make_test_app(CACHE_TYPE='simple')
+        meta = TileRequest(10, 100, 200, 1, 'zip')
+        put_metatile(app, meta, make_metatile(fmt='mvt'))
+        client = app.test_client()
+        self.assertEqual(200, client.get('/tilezen/vector/v1/256/all/12/401/802.mvt').status_code)
+        self.assertEqual(200, client.get('/tilezen/vector/v1/256/all/12/400/802.mvt').status_code)
+        self.assertEqual(1, app.boto_s3.get_count)
+
+        with app.app_context():
+            entry = app.shared_cache.backend.get(app.storage.location(meta))
+            self.assertIn(app.storage.location(meta), app.shared_cache)
+        self.assertIsInstance(entry, bytes)
+
+
+class SharedMemoryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'metatiles')
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.tmpdir.cleanup()
+
+    def open_cache(self, max_bytes=64 * 1024, buckets=256):
+        from shm_cache import SharedMemoryCache
+
+        cache = SharedMemoryCache(self.path, max_bytes, buckets)
+        self.caches.append(cache)
+        return cache
+
+    def response(self, i):
+        from server import CacheInfo, StorageResponse
+        return StorageResponse(b'x' * 1000 + b'%d' % i, CacheInfo(None, 'etag%d' % i), fetched_at=1.0)
+
+    def test_shared_between_processes(self):
+        import multiprocessing
+
+        cache = self.open_cache()
+        process = multiprocessing.get_context('fork').Process(
+            target=lambda: self.open_cache().set('key', self.response(1)))
+        process.start()
+        process.join()
+
+        self.assertIn('key', cache)
+        self.assertEqual(self.response(1), cache.get('key'))
+        self.assertIsNone(cache.get('other'))
+        cache.delete('key')
+        self.assertIsNone(cache.get('key'))
+        self.assertNotIn('key', cache)
+
+    def test_eviction(self):
+        writer = self.open_cache()
+        reader = self.open_cache()
+        for i in range(0, 200):
+            writer.set('old%d' % i, self.response(i))
+            # hits on entries about to be overwritten write them again.
+            self.assertEqual(self.response(0), reader.get('old0'))
+
+        self.assertIsNone(reader.get('old1'))
+        self.assertEqual(self.response(199), reader.get('old199'))
+        self.assertGreater(reader.reinsertions, 0)
+
+    def test_torn_read(self):
+        import datetime
+        import struct
+        from shm_cache import ENTRY
+
+        cache = self.open_cache()
+        last_modified = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        cache.set('key', self.response(1)._replace(
+            cache_info=self.response(1).cache_info._replace(last_modified=last_modified)))
+
+        # as if a writer had overwritten the entry's timestamp mid-read.
+        start, _ = cache.lookup(cache.key_hash('key'))
+        pos = cache.ring_start + start + ENTRY.size + len('key') + 4
+        struct.pack_into('<d', cache.mm, pos, 1e300)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(1, cache.misses)
+
+    def test_counts_from_threads(self):
+        import threading
+
+        cache = self.open_cache()
+        cache.set('key', self.response(1))
+
+        def get():
+            for _ in range(0, 500):
+                cache.get('key')
+                cache.get('other')
+
+        threads = [threading.Thread(target=get) for _ in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(4000, cache.hits)
+        self.assertEqual(4000, cache.misses)
+
+    def test_layout_changed(self):
+        old = self.open_cache()
+        old.set('key', self.response(1))
+        self.assertIsNone(self.open_cache(buckets=512).get('key'))
+        # the old file is replaced rather than resized under the old cache.
+        self.assertEqual(self.response(1), old.get('key'))
+
+    def test_app(self):
+        from testing import make_metatile
+
+        config = dict(SHARED_MEMORY_CACHE_MAX_BYTES=1024 * 1024, SHARED_MEMORY_CACHE_PATH=self.path)
+        app = make_test_app(**config)
+        other_app = make_test_app(boto_s3=app.boto_s3, **config)
+        self.caches.extend([app.shared_cache, other_app.shared_cache])
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile(fmt='mvt'))
+
+        url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+        self.assertEqual(200, app.test_client().get(url).status_code)
+        self.assertEqual(200, other_app.test_client().get(url).status_code)
+        self.assertEqual(1, app.boto_s3.get_count)
+        self.assertEqual(1, other_app.shared_cache.hits)
+
+
+class RevalidationTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+    meta = TileRequest(10, 100, 200, 1, 'zip')
+
+    def make_app(self, **config):
+        from testing import make_metatile
+
+        app = make_test_app(METATILE_CACHE_MAX_BYTES=10 * 1024 * 1024, **config)
+        put_metatile(app, self.meta, make_metatile(fmt='mvt'))
+        return app
+
+    def wait_for_revalidations(self):
+        import time
+        from server import revalidations
+
+        for _ in range(0, 100):
+            if not revalidations:
+                return
+            time.sleep(0.01)
+        self.fail("Revalidation didn't finish")
+
+    def test_etag_matches(self):
+        from storage import etag_matches
+
+        self.assertTrue(etag_matches('"abc"', 'abc'))
+        self.assertTrue(etag_matches('W/"abc"', 'abc'))
+        self.assertTrue(etag_matches('"def", "abc"', 'abc'))
+        self.assertTrue(etag_matches('*', 'abc'))
+        self.assertFalse(etag_matches('"def"', 'abc'))
+
+    def test_not_modified_from_cache(self):
+        app = self.make_app()
+        client = app.test_client()
+        resp = client.get(self.url)
+        etag, last_modified = resp.headers['ETag'], resp.headers['Last-Modified']
+        self.assertEqual(1, app.boto_s3.get_count)
+
+        resp = client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(304, resp.status_code)
+
+        resp = client.get(self.url, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(304, resp.status_code)
+
+        resp = client.get(self.url, headers={'If-None-Match': '"something-else"'})
+        self.assertEqual(200, resp.status_code)
+
+        # all of those came from the cache
+        self.assertEqual(1, app.boto_s3.get_count)
+
+    def test_stale_while_revalidate(self):
+        from server import cached_metatile, cache_set
+
+        app = self.make_app(METATILE_FRESHNESS=60)
+        client = app.test_client()
+        client.get(self.url)
+
+        with app.app_context():
+            cached = cached_metatile(self.meta)
+            cache_set(self.meta, cached._replace(fetched_at=cached.fetched_at - 120))
+
+        # the stale metatile is used, and revalidated in the background.
+        resp = client.get(self.url)
+        self.assertEqual(200, resp.status_code)
+        self.wait_for_revalidations()
+
+        self.assertEqual(2, app.boto_s3.get_count)
+        with app.app_context():
+            self.assertGreater(cached_metatile(self.meta).fetched_at, cached.fetched_at - 60)
+
+        # and now it's fresh, so isn't revalidated again.
+        client.get(self.url)
+        self.wait_for_revalidations()
+        self.assertEqual(2, app.boto_s3.get_count)
+
+    def test_stale_metatile_changed(self):
+        from testing import make_metatile
+        from server import cached_metatile, cache_set
+
+        app = self.make_app(METATILE_FRESHNESS=60)
+        client = app.test_client()
+        old_etag = client.get(self.url).headers['ETag']
+
+        with app.app_context():
+            cached = cached_metatile(self.meta)
+            cache_set(self.meta, cached._replace(fetched_at=cached.fetched_at - 120))
+        put_metatile(app, self.meta, make_metatile(fmt='mvt', seed=1))
+
+        # the first request gets the stale one, but later ones the new one.
+        self.assertEqual(old_etag, client.get(self.url).headers['ETag'])
+        self.wait_for_revalidations()
+        self.assertNotEqual(old_etag, client.get(self.url).headers['ETag'])
+
+
+class RangeRequestTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+    meta = TileRequest(10, 100, 200, 1, 'zip')
+
+    def setUp(self):
+        from testing import make_metatile
+        from server import extract_tile
+
+        self.app = make_test_app(S3_RANGE_REQUESTS=True, CACHE_TYPE='simple')
+        self.metatile = make_metatile(fmt='mvt')
+        self.tile = extract_tile(self.metatile, TileRequest(2, 1, 2, 1, 'mvt'))
+        put_metatile(self.app, self.meta, self.metatile)
+
+    def test_fetches_only_index_and_member(self):
+        client = self.app.test_client()
+
+        resp = client.get(self.url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(self.tile, resp.data)
+        # one GET for the index, one for the member
+        self.assertEqual(2, self.app.boto_s3.get_count)
+        self.assertLess(self.app.boto_s3.bytes_sent, len(self.metatile) // 4)
+
+        # the index is cached, so the next tile is a single GET.
+        resp = client.get('/tilezen/vector/v1/256/all/12/400/800.mvt')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(3, self.app.boto_s3.get_count)
+
+    def test_small_metatile_is_fetched_once(self):
+        import zipfile
+        from io import BytesIO
+
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('2/1/2.mvt', b'small tile')
+        put_metatile(self.app, self.meta, buf.getvalue())
+
+        resp = self.app.test_client().get(self.url)
+        self.assertEqual(b'small tile', resp.data)
+        self.assertEqual(1, self.app.boto_s3.get_count)
+
+    def test_metatile_changed_after_index_cached(self):
+        from testing import make_metatile
+        from server import extract_tile
+
+        client = self.app.test_client()
+        client.get(self.url)
+
+        metatile = make_metatile(fmt='mvt', seed=1)
+        put_metatile(self.app, self.meta, metatile)
+
+        resp = client.get(self.url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(extract_tile(metatile, TileRequest(2, 1, 2, 1, 'mvt')), resp.data)
+
+    def test_conditional_request(self):
+        client = self.app.test_client()
+        etag = client.get(self.url).headers['ETag']
+
+        # a fresh app, so that the index isn't cached
+        app = make_test_app(S3_RANGE_REQUESTS=True, boto_s3=self.app.boto_s3)
+        resp = app.test_client().get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(304, resp.status_code)
+
+    def test_missing_metatile(self):
+        resp = self.app.test_client().get('/tilezen/vector/v1/256/all/13/801/1604.mvt')
+        self.assertEqual(404, resp.status_code)
+
+
+class HedgingTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+
+    def make_app(self, latencies, **config):
+        import itertools
+        from testing import make_metatile
+        from fake_s3 import FakeS3Client
+
+        # each GET takes the next of the latencies, and then no time at all.
+        latencies = itertools.chain(latencies, itertools.repeat(0))
+        app = make_test_app(boto_s3=FakeS3Client(latency=lambda: next(latencies)), **config)
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile(fmt='mvt'))
+        return app
+
+    def test_latency_tracker(self):
+        from storage import LatencyTracker
+
+        tracker = LatencyTracker(size=100, min_samples=10, refresh=10)
+        for i in range(0, 9):
+            tracker.add(i)
+        self.assertIsNone(tracker.percentile(50))
+        tracker.add(9)
+        self.assertEqual(5, tracker.percentile(50))
+        self.assertEqual(9, tracker.percentile(99))
+
+    def test_hedge_wins(self):
+        import time
+
+        app = self.make_app([1.0], S3_HEDGE_PERCENTILE=95, S3_HEDGE_MIN_DELAY_MS=20, METRICS=True)
+
+        a = time.time()
+        resp = app.test_client().get(self.url)
+        self.assertEqual(200, resp.status_code)
+        self.assertLess(time.time() - a, 0.5)
+        self.assertEqual(dict(gets=2, hedges=1, hedge_wins=1, deadline_expirations=0),
+                         app.storage.stats())
+
+        metrics = app.test_client().get('/metrics').get_data(as_text=True)
+        self.assertIn('tapalcatl_storage_hedge_wins_total 1.0', metrics)
+
+        # the losing GET's body is closed once it responds, without being read.
+        app.storage.executor.shutdown(wait=True)
+        self.assertEqual(2, len(app.boto_s3.bodies))
+        self.assertTrue(all(body.closed for body in app.boto_s3.bodies))
+
+    def test_no_hedge_when_fast(self):
+        app = self.make_app([], S3_HEDGE_PERCENTILE=95, S3_HEDGE_MIN_DELAY_MS=200)
+        self.assertEqual(200, app.test_client().get(self.url).status_code)
+        self.assertEqual(0, app.storage.hedges)
+
+    def test_deadline(self):
+        app = self.make_app([1.0, 1.0], S3_HEDGE_PERCENTILE=95, S3_HEDGE_MIN_DELAY_MS=20,
+                            S3_DEADLINE_MS=100)
+
+        resp = app.test_client().get(self.url)
+        self.assertEqual(500, resp.status_code)
+        self.assertEqual(1, app.storage.hedges)
+        self.assertEqual(0, app.storage.hedge_wins)
+        self.assertEqual(1, app.storage.deadline_expirations)
+
+    def test_deadline_covers_body(self):
+        import time
+        from testing import make_metatile
+        from fake_s3 import FakeS3Client
+
+        app = make_test_app(boto_s3=FakeS3Client(body_latency=1.0), S3_DEADLINE_MS=100)
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile(fmt='mvt'))
+
+        a = time.time()
+        resp = app.test_client().get(self.url)
+        self.assertEqual(500, resp.status_code)
+        self.assertLess(time.time() - a, 0.5)
+        self.assertEqual(1, app.storage.deadline_expirations)
+
+    def test_one_deadline_for_index_and_member(self):
+        from storage import MetatileDeadlineExceededException
+
+        meta = TileRequest(10, 100, 200, 1, 'zip')
+        app = self.make_app([0.07, 0.07], S3_DEADLINE_MS=100)
+        with app.app_context():
+            deadline = app.storage.start_deadline()
+            index = app.storage.get_index(meta, None, deadline)
+            member = index.index['0/0/0.mvt']
+            with self.assertRaises(MetatileDeadlineExceededException):
+                app.storage.read_member(
+                    meta, member, '0/0/0.mvt', index.cache_info.etag, deadline)
+
+            # without the shared deadline, the member read has its own.
+            self.assertIsNotNone(app.storage.read_member(
+                meta, member, '0/0/0.mvt', index.cache_info.etag))
+
+    def test_error_is_not_hedged(self):
+        app = self.make_app([], S3_HEDGE_PERCENTILE=95, S3_HEDGE_MIN_DELAY_MS=200)
+        resp = app.test_client().get('/tilezen/vector/v1/256/all/13/801/1604.mvt')
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual(dict(gets=1, hedges=0, hedge_wins=0, deadline_expirations=0),
+                         app.storage.stats())
+
+
+class AsyncServerTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+    meta = TileRequest(10, 100, 200, 1, 'zip')
+
+    def make_server(self, latency=0, **config):
+        from async_server import create_async_app
+        from testing import make_metatile
+        from fake_s3 import AsyncFakeS3Client
+
+        app = make_test_app(boto_s3=AsyncFakeS3Client(latency=latency), **config)
+        self.metatile = make_metatile(fmt='mvt')
+        put_metatile(app, self.meta, self.metatile)
+        return create_async_app(app, s3_client=app.boto_s3)
+
+    async def call(self, server, path, headers=None):
+        """
+        Returns the status, headers and body of the server's response to a
+        GET.
+        """
+
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        path, _, query = path.partition('?')
+        await server(dict(
+            type='http', method='GET', path=path, query_string=query.encode('utf8'),
+            headers=[(k.lower().encode('latin1'), v.encode('latin1'))
+                     for k, v in (headers or {}).items()],
+        ), receive, send)
+
+        start, body = messages
+        headers = dict((k.decode('latin1'), v.decode('latin1')) for k, v in start['headers'])
+        return start['status'], headers, body['body']
+
+    def request(self, server, path, headers=None):
+        import asyncio
+        return asyncio.run(self.call(server, path, headers))
+
+    def test_same_responses_as_wsgi(self):
+        import gzip
+
+        server = self.make_server(NEGATIVE_CACHE_TTL=60)
+        # the async server replaces the app's storage, so compare it with a
+        # separate WSGI app.
+        wsgi_app = make_test_app(NEGATIVE_CACHE_TTL=60)
+        put_metatile(wsgi_app, self.meta, self.metatile)
+        client = wsgi_app.test_client()
+        headers = {'Accept-Encoding': 'gzip'}
+
+        for path in (self.url,
+                     '/tilezen/vector/v1/512/all/11/200/401.mvt',
+                     '/tilezen/vector/v1/256/all/13/801/1604.mvt',
+                     '/tilezen/vector/v1/256/all/20/0/0.mvt',
+                     '/tilezen/vector/v1/300/all/12/401/802.mvt',
+                     '/tilezen/landcover/v1/256/all/7/1/1.png',
+                     '/tilezen/vector/v1/all/tilejson.mvt.json',
+                     '/not/a/route'):
+            expected = client.get(path, headers=headers)
+            status, resp_headers, body = self.request(server, path, headers)
+
+            self.assertEqual(expected.status_code, status, path)
+            if status == 200:
+                expected_body = expected.get_data()
+                if expected.headers.get('Content-Encoding') == 'gzip':
+                    expected_body = gzip.decompress(expected_body)
+                if resp_headers.get('content-encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                self.assertEqual(expected_body, body, path)
+                self.assertEqual(expected.headers['Content-Type'], resp_headers['content-type'])
+            if status == 200 and path.endswith('.mvt'):
+                self.assertEqual(expected.headers['ETag'], resp_headers['etag'])
+                self.assertEqual(expected.headers['Cache-Control'], resp_headers['cache-control'])
+
+    def test_conditional_request(self):
+        server = self.make_server()
+        _, headers, _ = self.request(server, self.url)
+
+        status, _, body = self.request(server, self.url, {'If-None-Match': headers['etag']})
+        self.assertEqual(304, status)
+        self.assertEqual(b'', body)
+
+    def test_concurrent_fetches(self):
+        import asyncio
+        import time
+        from testing import make_metatile
+
+        server = self.make_server(latency=0.2)
+        for x in range(0, 100):
+            put_metatile(server.app, TileRequest(10, x, 0, 1, 'zip'), make_metatile(fmt='mvt', tile_bytes=100))
+
+        # a hundred metatiles fetched at once, each wanted by two requests.
+        paths = ['/tilezen/vector/v1/256/all/12/%d/%d.mvt' % (x * 4 + i, i)
+                 for x in range(0, 100) for i in (0, 1)]
+
+        async def fetch_all():
+            return await asyncio.gather(*[self.call(server, path) for path in paths])
+
+        a = time.time()
+        responses = asyncio.run(fetch_all())
+        self.assertLess(time.time() - a, 2.0)
+        self.assertEqual([200] * len(paths), [status for status, _, _ in responses])
+        self.assertEqual(100, server.app.boto_s3.get_count)
+        self.assertEqual(100, server.flights.deduplicated)
+
+    def test_deadline(self):
+        server = self.make_server(latency=1.0, S3_DEADLINE_MS=50)
+
+        status, _, _ = self.request(server, self.url)
+        self.assertEqual(500, status)
+        self.assertEqual(1, server.storage.deadline_expirations)
+
+    def test_server_timing(self):
+        server = self.make_server(SERVER_TIMING=True, METATILE_CACHE_MAX_BYTES=1024 * 1024)
+
+        _, headers, _ = self.request(server, self.url)
+        self.assertIn('s3_ttfb;dur=', headers['server-timing'])
+        self.assertIn('extract;dur=', headers['server-timing'])
+
+        _, headers, _ = self.request(server, self.url)
+        self.assertNotIn('s3_ttfb', headers['server-timing'])
+        self.assertEqual(1, server.app.boto_s3.get_count)
+
+    def test_range_requests(self):
+        from testing import make_metatile
+        from server import extract_tile
+
+        server = self.make_server(S3_RANGE_REQUESTS=True, CACHE_TYPE='simple')
+
+        status, _, body = self.request(server, self.url)
+        self.assertEqual(200, status)
+        self.assertEqual(extract_tile(self.metatile, TileRequest(2, 1, 2, 1, 'mvt')), body)
+        # one GET for the index, one for the member
+        self.assertEqual(2, server.app.boto_s3.get_count)
+        self.assertTrue(all(call['Range'] for call in server.app.boto_s3.calls))
+
+        # the index is cached, so the next tile is a single GET.
+        status, _, _ = self.request(server, '/tilezen/vector/v1/256/all/12/400/800.mvt')
+        self.assertEqual(200, status)
+        self.assertEqual(3, server.app.boto_s3.get_count)
+
+        # and when the metatile changes, the index is fetched again.
+        metatile = make_metatile(fmt='mvt', seed=1)
+        put_metatile(server.app, self.meta, metatile)
+        status, _, body = self.request(server, self.url)
+        self.assertEqual(200, status)
+        self.assertEqual(extract_tile(metatile, TileRequest(2, 1, 2, 1, 'mvt')), body)
+
+    def test_pack(self):
+        import os
+        import tempfile
+        from async_server import PooledStorage, create_async_app
+        from testing import make_metatile
+        from pack import build_pack
+        from server import extract_tile
+        from storage import KeyFormatType, LocalStorage
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tree = os.path.join(tmp, 'tree')
+            path = LocalStorage(tree, 'prefix', 'all', KeyFormatType.NO_HASH).path(self.meta)
+            os.makedirs(os.path.dirname(path))
+            metatile = make_metatile(fmt='mvt')
+            with open(path, 'wb') as f:
+                f.write(metatile)
+            pack_path = os.path.join(tmp, 'tiles.pack')
+            build_pack(tree, pack_path, 'prefix', 'all', KeyFormatType.NO_HASH)
+
+            server = create_async_app(make_test_app(STORAGE_BACKEND='pack', PACK_PATH=pack_path))
+            self.assertIsInstance(server.storage, PooledStorage)
+
+            status, _, body = self.request(server, self.url)
+            self.assertEqual(200, status)
+            self.assertEqual(extract_tile(metatile, TileRequest(2, 1, 2, 1, 'mvt')), body)
+
+            status, _, _ = self.request(server, '/tilezen/vector/v1/256/all/13/801/1604.mvt')
+            self.assertEqual(404, status)
+
+    def test_stale_while_revalidate(self):
+        import asyncio
+        from server import cache_set, cached_metatile, revalidations
+
+        server = self.make_server(METATILE_FRESHNESS=60, METATILE_CACHE_MAX_BYTES=1024 * 1024)
+        self.request(server, self.url)
+
+        with server.app.app_context():
+            cached = cached_metatile(self.meta)
+            cache_set(self.meta, cached._replace(fetched_at=cached.fetched_at - 120))
+
+        async def revalidate():
+            # the conditional GET runs on the event loop, so keep it running
+            # until the revalidation is done.
+            status, _, _ = await self.call(server, self.url)
+            for _ in range(0, 100):
+                if not revalidations:
+                    break
+                await asyncio.sleep(0.01)
+            return status
+
+        self.assertEqual(200, asyncio.run(revalidate()))
+        self.assertFalse(revalidations)
+        self.assertEqual(2, server.app.boto_s3.get_count)
+        with server.app.app_context():
+            self.assertGreater(cached_metatile(self.meta).fetched_at, cached.fetched_at - 60)
+
+
+class LambdaHandlerTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+
+    def setUp(self):
+        from testing import make_metatile
+        from server import extract_tile
+
+        self.app = make_test_app()
+        metatile = make_metatile(fmt='mvt')
+        self.tile = extract_tile(metatile, TileRequest(2, 1, 2, 1, 'mvt'))
+        put_metatile(self.app, TileRequest(10, 100, 200, 1, 'zip'), metatile)
+
+    def invoke(self, path, headers=None, http_api=False):
+        import base64
+        from benchmark import api_gateway_event
+        from lambda_handler import handle_event
+
+        event = api_gateway_event(dict(path=path, headers=headers or {}), http_api)
+        response = handle_event(self.app, event)
+        return response, base64.b64decode(response['body'])
+
+    def test_rest_api(self):
+        import gzip
+
+        response, body = self.invoke(self.url, {'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, response['statusCode'])
+        self.assertTrue(response['isBase64Encoded'])
+        headers = response['multiValueHeaders']
+        self.assertEqual(['application/x-protobuf'], headers['Content-Type'])
+        self.assertEqual(['gzip'], headers['Content-Encoding'])
+        self.assertEqual(['public, max-age=1200, s-maxage=600'], headers['Cache-Control'])
+        self.assertEqual(self.tile, gzip.decompress(body))
+
+        etag = headers['ETag'][0]
+        response, body = self.invoke(self.url, {'If-None-Match': etag})
+        self.assertEqual(304, response['statusCode'])
+        self.assertEqual(b'', body)
+
+    def test_http_api(self):
+        from lambda_handler import handle_event, parse_event
+
+        response, body = self.invoke(self.url, http_api=True)
+        self.assertEqual(200, response['statusCode'])
+        self.assertEqual('application/x-protobuf', response['headers']['Content-Type'])
+        self.assertEqual(self.tile, body)
+
+        response, _ = self.invoke('/tilezen/vector/v1/256/all/13/801/1604.mvt', http_api=True)
+        self.assertEqual(404, response['statusCode'])
+
+        # the path of a named stage starts with the stage's name.
+        event = {
+            'version': '2.0',
+            'rawPath': '/dev' + self.url,
+            'rawQueryString': 'api_key=abc',
+            'headers': {},
+            'requestContext': {'http': {'method': 'GET'}, 'stage': 'dev'},
+        }
+        self.assertEqual(('GET', self.url, 'api_key=abc', {}, b''), parse_event(event))
+        self.assertEqual(200, handle_event(self.app, event)['statusCode'])
+
+    def test_same_responses_as_wsgi(self):
+        import base64
+        from benchmark import api_gateway_event, wsgi_lambda_handler
+        from lambda_handler import handle_event
+
+        wsgi_handler = wsgi_lambda_handler(self.app)
+        for path in (self.url,
+                     '/tilezen/vector/v1/256/all/13/801/1604.mvt',
+                     '/tilezen/vector/v1/256/all/20/0/0.mvt',
+                     '/tilezen/landcover/v1/256/all/7/1/1.png',
+                     '/tilezen/vector/v1/all/tilejson.mvt.json'):
+            event = api_gateway_event(dict(path=path, headers={'Origin': 'https://example.com'}))
+            expected = wsgi_handler(event)
+            response = handle_event(self.app, event)
+            self.assertEqual(expected['statusCode'], response['statusCode'], path)
+            self.assertEqual(base64.b64decode(expected['body']),
+                             base64.b64decode(response['body']), path)
+            # errors need the CORS headers too, or browsers only see a CORS
+            # failure.
+            self.assertEqual(['*'], response['multiValueHeaders'].get('Access-Control-Allow-Origin'), path)
+            self.assertEqual(expected['multiValueHeaders'].get('Access-Control-Allow-Origin'),
+                             response['multiValueHeaders'].get('Access-Control-Allow-Origin'), path)
+
+
+class ColdStartTestCase(unittest.TestCase):
+    # the most that importing wsgi_server, and so making the app, may take.
+    # it took about 240ms when this was written, down from about 430ms when
+    # boto3 and dateutil were imported with the server.
+    IMPORT_TIME_BUDGET_MS = 400
+
+    def import_wsgi_server(self):
+        """
+        Import wsgi_server in a new interpreter, returning the time it took in
+        milliseconds and the modules it imported.
+        """
+
+        import os
+        import subprocess
+        import sys
+
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import sys, wsgi_server; print("\\n".join(sys.modules))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True)
+
+        cumulative = None
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[2].rstrip() == ' wsgi_server':
+                cumulative = int(parts[1]) / 1000.0
+        self.assertIsNotNone(cumulative, result.stderr)
+        return cumulative, set(result.stdout.split())
+
+    def test_import_time(self):
+        # the best of a few, so that a busy machine doesn't fail it.
+        best = min(self.import_wsgi_server()[0] for _ in range(3))
+        self.assertLess(best, self.IMPORT_TIME_BUDGET_MS)
+
+    def test_lazy_imports(self):
+        _, modules = self.import_wsgi_server()
+        for module in ('boto3', 'botocore', 'dateutil', 'asyncio', 'cProfile', 'pack'):
+            self.assertNotIn(module, modules)
+
+    def test_parse_http_date(self):
+        import datetime
+        from server import parse_http_date
+
+        expected = datetime.datetime(1994, 11, 6, 8, 49, 37, tzinfo=datetime.timezone.utc)
+        self.assertEqual(expected, parse_http_date('Sun, 06 Nov 1994 08:49:37 GMT'))
+        self.assertEqual(expected, parse_http_date('Sunday, 06-Nov-94 08:49:37 GMT'))
+        self.assertEqual(expected, parse_http_date('Sun Nov  6 08:49:37 1994'))
+        self.assertIsNone(parse_http_date('Sun, 06 Foo 1994 08:49:37 GMT'))
+        self.assertIsNone(parse_http_date('yesterday'))
+
+
+class PrefetchTestCase(unittest.TestCase):
+    def test_targets(self):
+        from prefetch import Prefetcher
+
+        prefetcher = Prefetcher(8, 1, 10)
+        meta = TileRequest(1, 0, 1, 1, 'zip')
+        self.assertEqual(
+            [meta._replace(y=0), meta._replace(x=1, y=0), meta._replace(x=1)] +
+            [TileRequest(2, x, y, 1, 'zip') for x in (0, 1) for y in (2, 3)],
+            prefetcher.targets(meta))
+        self.assertEqual(4, len(prefetcher.targets(TileRequest(0, 0, 0, 1, 'zip'))))
+        self.assertEqual(8, len(prefetcher.targets(TileRequest(10, 5, 5, 1, 'zip'))))
+
+    def test_budget(self):
+        import threading
+        from prefetch import Prefetcher
+
+        prefetcher = Prefetcher(2, 0, 10, threads=1)
+        release = threading.Event()
+        prefetcher.prefetch_around(TileRequest(5, 5, 5, 1, 'zip'), lambda meta: release.wait() and 'fetched')
+        # the same ones again are already pending, so aren't counted twice.
+        prefetcher.prefetch_around(TileRequest(5, 5, 5, 1, 'zip'), lambda meta: 'fetched')
+        release.set()
+        prefetcher.pool.shutdown(wait=True)
+
+        self.assertEqual(2, prefetcher.outcomes.value(zoom=5, outcome='fetched'))
+        self.assertEqual(6 * 2, prefetcher.outcomes.value(zoom=5, outcome='dropped'))
+        self.assertEqual(4 * 2, prefetcher.outcomes.value(zoom=6, outcome='dropped'))
+
+    def test_prefetch(self):
+        from testing import make_metatile
+
+        app = make_test_app(PREFETCH=True, METATILE_CACHE_MAX_BYTES=16 * 1024 * 1024)
+        for meta in (TileRequest(10, 100, 200, 1, 'zip'), TileRequest(10, 101, 200, 1, 'zip')):
+            put_metatile(app, meta, make_metatile(fmt='mvt'))
+        client = app.test_client()
+
+        self.assertEqual(200, client.get('/tilezen/vector/v1/256/all/12/401/802.mvt').status_code)
+        app.prefetcher.pool.shutdown(wait=True)
+        self.assertEqual(1 + 12, app.boto_s3.get_count)
+
+        # the neighbour was prefetched, so is in the cache.
+        self.assertEqual(200, client.get('/tilezen/vector/v1/256/all/12/405/802.mvt').status_code)
+        self.assertEqual(1 + 12, app.boto_s3.get_count)
+
+        # prefetching doesn't count as looking the metatiles up.
+        self.assertEqual(3, app.metatile_cache.hits + app.metatile_cache.misses)
+
+        outcomes = app.prefetcher.outcomes
+        self.assertEqual(1, outcomes.value(zoom=10, outcome='fetched'))
+        self.assertEqual(1, outcomes.value(zoom=10, outcome='hit'))
+        self.assertEqual(7, outcomes.value(zoom=10, outcome='missing'))
+        self.assertEqual(4, outcomes.value(zoom=11, outcome='missing'))
+
+    def test_no_prefetch_without_cache(self):
+        from testing import make_metatile
+
+        app = make_test_app(PREFETCH=True)
+        self.assertIsNone(app.prefetcher)
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile(fmt='mvt'))
+
+        self.assertEqual(200, app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt').status_code)
+        self.assertEqual(1, app.boto_s3.get_count)
+
+    def test_no_prefetch_for_landcover(self):
+        import zipfile
+        from io import BytesIO
+
+        app = make_test_app(PREFETCH=True, METATILE_CACHE_MAX_BYTES=16 * 1024 * 1024)
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w') as z:
+            z.writestr('12/401/802@2x.png', b'landcover tile')
+        # the materialized zoom 7 metatile holding the tile.
+        put_metatile(app, TileRequest(7, 12, 25, 1, 'zip'), buf.getvalue())
+
+        resp = app.test_client().get('/tilezen/landcover/v1/512/all/12/401/802.png')
+        self.assertEqual(b'landcover tile', resp.data)
+        app.prefetcher.pool.shutdown(wait=True)
+        self.assertEqual(1, app.boto_s3.get_count)
+        self.assertEqual(0, app.prefetcher.outcomes.value(zoom=7, outcome='missing'))
+
+
+class HotSetTestCase(unittest.TestCase):
+    metas = [TileRequest(10, 100, 200, 1, 'zip'), TileRequest(10, 101, 200, 1, 'zip')]
+
+    def setUp(self):
+        import os
+        import tempfile
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'hot-set.json')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def make_app(self, **config):
+        import atexit
+
+        app = make_test_app(HOT_SET_SNAPSHOT=self.path, **config)
+        # it would be saved again when the tests exit, after the directory's gone.
+        self.addCleanup(atexit.unregister, app.hot_set.save)
+        return app
+
+    def test_snapshot(self):
+        from hotset import FileSnapshots, HotSet
+
+        hot_set = HotSet(FileSnapshots(self.path), save_interval=60)
+        for meta in [self.metas[1]] * 4 + [self.metas[0]]:
+            hot_set.record(meta)
+        hot_set.save()
+
+        hot_set = HotSet(FileSnapshots(self.path), save_interval=60)
+        self.assertEqual(self.metas[::-1], hot_set.load())
+        # the counts are carried over halved, and the ones rounded down to
+        # nothing are dropped.
+        self.assertEqual([(self.metas[1], 2)], hot_set.top(10))
+
+    def test_max_entries(self):
+        from hotset import FileSnapshots, HotSet
+
+        hot_set = HotSet(FileSnapshots(self.path), save_interval=60, max_entries=4)
+        for x in range(5):
+            for _ in range(x + 1):
+                hot_set.record(TileRequest(10, x, 0, 1, 'zip'))
+        # the less requested half were dropped when the fifth was recorded.
+        self.assertEqual([2, 3, 4], sorted(meta.x for meta, _ in hot_set.top(10)))
+
+    def test_warm_up(self):
+        from testing import make_metatile
+
+        app = self.make_app()
+        put_metatile(app, self.metas[0], make_metatile(fmt='mvt'))
+        app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+        app.test_client().get('/tilezen/vector/v1/256/all/12/405/802.mvt')
+        app.hot_set.save()
+
+        app = self.make_app(boto_s3=app.boto_s3, METATILE_CACHE_MAX_BYTES=10 * 1024 * 1024,
+                            HOT_SET_WARM_BLOCKING=True)
+        stats = app.hot_set.stats()
+        self.assertEqual(1, stats['warmed'])
+        self.assertEqual(len(make_metatile(fmt='mvt')), stats['warmed_bytes'])
+        gets = app.boto_s3.get_count
+
+        resp = app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(gets, app.boto_s3.get_count)
+        self.assertEqual(1, app.hot_set.stats()['requests_for_warmed_after_start'])
+
+    def test_time_budget(self):
+        from testing import make_metatile
+
+        app = self.make_app()
+        put_metatile(app, self.metas[0], make_metatile(fmt='mvt'))
+        app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+        app.hot_set.save()
+
+        app = self.make_app(boto_s3=app.boto_s3, METATILE_CACHE_MAX_BYTES=10 * 1024 * 1024,
+                            HOT_SET_WARM_SECONDS=0, HOT_SET_WARM_BLOCKING=True)
+        self.assertEqual(0, app.hot_set.stats()['warmed'])
+
+    def test_warm_up_from_shared_cache(self):
+        from cache_codec import make_shared_cache
+        from fake_redis import FakeRedisClient
+        from flask_caching.backends import RedisCache
+        from testing import make_metatile
+
+        app = self.make_app(METATILE_CACHE_MAX_BYTES=10 * 1024 * 1024)
+        client = FakeRedisClient()
+        app.shared_cache = make_shared_cache(RedisCache(host=client))
+        for meta in self.metas:
+            put_metatile(app, meta, make_metatile(fmt='mvt'))
+        app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+        app.test_client().get('/tilezen/vector/v1/256/all/12/405/802.mvt')
+        app.metatile_cache.clear()
+
+        gets, round_trips = app.boto_s3.get_count, client.round_trips
+        app.hot_set.warm_up(app, self.metas, 0, 10)
+        self.assertEqual(2, app.hot_set.stats()['warmed'])
+        self.assertEqual(gets, app.boto_s3.get_count)
+        self.assertEqual(round_trips + 1, client.round_trips)
+        self.assertTrue(all(meta in app.metatile_cache for meta in self.metas))
+
+    def test_no_prefetch_while_warming(self):
+        from testing import make_metatile
+
+        app = self.make_app()
+        for meta in self.metas:
+            put_metatile(app, meta, make_metatile(fmt='mvt'))
+        app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+        app.hot_set.save()
+
+        gets = app.boto_s3.get_count
+        app = self.make_app(boto_s3=app.boto_s3, METATILE_CACHE_MAX_BYTES=10 * 1024 * 1024,
+                            PREFETCH=True, HOT_SET_WARM_MAX_BYTES=1, HOT_SET_WARM_BLOCKING=True)
+        app.prefetcher.pool.shutdown(wait=True)
+        self.assertEqual(1, app.hot_set.stats()['warmed'])
+        self.assertEqual(gets + 1, app.boto_s3.get_count)
+
+    def test_no_warm_up_without_cache(self):
+        from testing import make_metatile
+
+        app = self.make_app()
+        put_metatile(app, self.metas[0], make_metatile(fmt='mvt'))
+        for _ in range(2):
+            app.test_client().get('/tilezen/vector/v1/256/all/12/401/802.mvt')
+        app.hot_set.save()
+
+        gets = app.boto_s3.get_count
+        app = self.make_app(boto_s3=app.boto_s3, HOT_SET_WARM_BLOCKING=True)
+        self.assertEqual(0, app.hot_set.stats()['warmed'])
+        self.assertEqual(gets, app.boto_s3.get_count)
+        # the counts are still carried over.
+        self.assertEqual([(self.metas[0], 1)], app.hot_set.top(10))
+
+
+class WarmTestCase(unittest.TestCase):
+    def test_bbox_metatiles(self):
+        from warm import bbox_metatiles
+
+        app = make_test_app()
+        # a bbox around tile 12/655/1583, which is in metatile 10/163/395.
+        bbox = (-122.43, 37.77, -122.41, 37.78)
+        metatiles = bbox_metatiles(app.config, [bbox], range(12, 13), [256, 512], ['vector'])
+        self.assertEqual([TileRequest(10, 163, 395, 1, 'zip'), TileRequest(11, 327, 791, 1, 'zip')],
+                         metatiles)
+
+    def test_bbox_metatiles_max_zoom(self):
+        from warm import bbox_metatiles
+
+        app = make_test_app()
+        bbox = (-122.43, 37.77, -122.41, 37.78)
+        max_zoom = app.config.get('LANDCOVER_MAX_ZOOM')
+        # the server doesn't serve landcover at its max zoom, so nothing there
+        # needs warming.
+        self.assertEqual([], bbox_metatiles(app.config, [bbox], [max_zoom], [512], ['landcover']))
+        self.assertNotEqual([], bbox_metatiles(app.config, [bbox], [max_zoom - 1], [512], ['landcover']))
+        self.assertEqual([], bbox_metatiles(app.config, [bbox], [17], [256], ['vector']))
+
+    def test_log_metatiles(self):
+        import io
+        from warm import log_metatiles, read_log_paths
+
+        app = make_test_app()
+        log = io.StringIO(
+            '/tilezen/vector/v1/256/all/12/401/802.mvt\n'
+            '{"path": "/tilezen/vector/v1/256/all/12/1/2.mvt?api_key=x"}\n'
+            '/tilezen/vector/v1/256/all/12/1/3.mvt\n'
+            '/tilezen/vector/v1/256/all/99/1/2.mvt\n'
+            '/not/a/tile\n')
+        self.assertEqual([TileRequest(10, 0, 0, 1, 'zip'), TileRequest(10, 100, 200, 1, 'zip')],
+                         log_metatiles(app, read_log_paths(log)))
+
+    def test_warm(self):
+        import io
+        import os
+        import tempfile
+        from testing import make_metatile
+        from warm import Progress, warm
+
+        app = make_test_app(CACHE_TYPE='simple')
+        metatiles = [TileRequest(10, 100, y, 1, 'zip') for y in range(200, 204)]
+        for meta in metatiles[:3]:
+            put_metatile(app, meta, make_metatile(tile_bytes=100))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            progress_path = os.path.join(tmpdir, 'progress')
+            progress = Progress(len(metatiles), progress_path, out=io.StringIO())
+            warm(app, metatiles[:2], concurrency=2, progress=progress)
+            progress.close()
+            self.assertEqual(dict(fetched=2), progress.outcomes)
+
+            # resuming skips the ones done, and the rest are fetched or
+            # found to be missing.
+            progress = Progress(len(metatiles), progress_path, out=io.StringIO())
+            warm(app, metatiles, concurrency=2, progress=progress)
+            progress.close()
+            self.assertEqual({'done before': 2, 'fetched': 1, 'missing': 1}, progress.outcomes)
+            self.assertEqual(4, app.boto_s3.get_count)
+
+            # and without the record of progress, they're already cached.
+            progress = Progress(len(metatiles), out=io.StringIO())
+            warm(app, metatiles[:3], progress=progress)
+            self.assertEqual(dict(cached=3), progress.outcomes)
+            self.assertEqual(4, app.boto_s3.get_count)
+            progress.report()
+            self.assertIn('3/4 metatiles (3 cached)', progress.out.getvalue())
+
+
+class LocalStorageTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+    meta = TileRequest(10, 100, 200, 1, 'zip')
+
+    def setUp(self):
+        import tempfile
+        from testing import make_metatile
+        from server import extract_tile
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = make_test_app(STORAGE_BACKEND='local', LOCAL_STORAGE_DIR=self.dir.name)
+        self.metatile = make_metatile(fmt='mvt')
+        self.tile = extract_tile(self.metatile, TileRequest(2, 1, 2, 1, 'mvt'))
+        self.write_metatile(self.metatile)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write_metatile(self, data):
+        import os
+        path = self.app.storage.path(self.meta)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # replace the file, like rsync does, rather than writing over it.
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def test_path(self):
+        import os
+        self.assertEqual(
+            os.path.join(self.dir.name, 'prefix/all/10/100/200.zip'),
+            self.app.storage.path(self.meta))
+
+    def test_serves_tile(self):
+        resp = self.app.test_client().get(self.url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(self.tile, resp.data)
+        self.assertIsNotNone(resp.last_modified)
+
+    def test_conditional_request(self):
+        client = self.app.test_client()
+        resp = client.get(self.url)
+
+        resp = client.get(self.url, headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(304, resp.status_code)
+
+    def test_metatile_replaced(self):
+        from testing import make_metatile
+        from server import extract_tile
+
+        client = self.app.test_client()
+        old_etag = client.get(self.url).headers['ETag']
+
+        metatile = make_metatile(fmt='mvt', seed=1)
+        self.write_metatile(metatile)
+
+        resp = client.get(self.url, headers={'If-None-Match': old_etag})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(extract_tile(metatile, TileRequest(2, 1, 2, 1, 'mvt')), resp.data)
+
+    def test_mapping_reused_until_replaced(self):
+        from testing import make_metatile
+
+        storage = self.app.storage
+        data, _ = storage.open(self.meta)
+        self.assertIs(data, storage.open(self.meta)[0])
+
+        self.write_metatile(make_metatile(fmt='mvt', seed=1))
+        new_data, _ = storage.open(self.meta)
+        self.assertIsNot(data, new_data)
+        self.assertEqual(1, len(storage.mappings))
+
+    def test_bad_metatile_not_kept_mapped(self):
+        from storage import UnknownMetatileException
+
+        self.write_metatile(b'not a zip file')
+        with self.app.app_context():
+            with self.assertRaises(UnknownMetatileException):
+                self.app.storage.get(self.meta, None)
+        self.assertEqual(0, len(self.app.storage.mappings))
+
+    def test_range_requests(self):
+        app = make_test_app(STORAGE_BACKEND='local', LOCAL_STORAGE_DIR=self.dir.name,
+                            S3_RANGE_REQUESTS=True)
+        resp = app.test_client().get(self.url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(self.tile, resp.data)
+
+    def test_missing_metatile(self):
+        resp = self.app.test_client().get('/tilezen/vector/v1/256/all/13/801/1604.mvt')
+        self.assertEqual(404, resp.status_code)
+
+
+class PackTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+    metas = [TileRequest(10, 100, 200, 1, 'zip'), TileRequest(10, 101, 200, 1, 'zip')]
+
+    def setUp(self):
+        import os
+        import tempfile
+        from testing import make_metatile
+        from pack import build_pack
+        from storage import KeyFormatType, LocalStorage
+
+        self.dir = tempfile.TemporaryDirectory()
+        tree = os.path.join(self.dir.name, 'tree')
+        layout = LocalStorage(tree, 'prefix', 'all', KeyFormatType.NO_HASH)
+        self.metatiles = {}
+        for i, meta in enumerate(self.metas):
+            self.metatiles[meta] = make_metatile(fmt='mvt', seed=i)
+            path = layout.path(meta)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(self.metatiles[meta])
+
+        self.pack_path = os.path.join(self.dir.name, 'tiles.pack')
+        self.count = build_pack(tree, self.pack_path, 'prefix', 'all', KeyFormatType.NO_HASH)
+        self.app = make_test_app(STORAGE_BACKEND='pack', PACK_PATH=self.pack_path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_find(self):
+        from pack import PackFile
+        from server import extract_tile
+
+        pack = PackFile(self.pack_path)
+        self.assertEqual(2 * 21, self.count)
+        self.assertEqual(self.count, len(pack))
+
+        for meta in self.metas:
+            self.assertTrue(pack.has_metatile(meta))
+        self.assertFalse(pack.has_metatile(TileRequest(10, 100, 201, 1, 'zip')))
+
+        member = pack.find(self.metas[1], '1/0/1.mvt')
+        expected = extract_tile(self.metatiles[self.metas[1]], TileRequest(1, 0, 1, 1, 'mvt'))
+        self.assertEqual(expected, zlib.decompress(pack.read(member), -zlib.MAX_WBITS))
+        self.assertIsNone(pack.find(self.metas[1], '3/0/0.mvt'))
+
+    def test_serves_tiles(self):
+        import gzip
+        from server import extract_tile
+
+        client = self.app.test_client()
+        resp = client.get(self.url)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(extract_tile(self.metatiles[self.metas[0]], TileRequest(2, 1, 2, 1, 'mvt')), resp.data)
+
+        # deflated tiles are still sent as they are.
+        resp = client.get('/tilezen/vector/v1/256/all/12/404/800.mvt', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', resp.content_encoding)
+        self.assertEqual(
+            extract_tile(self.metatiles[self.metas[1]], TileRequest(2, 0, 0, 1, 'mvt')),
+            gzip.decompress(resp.data))
+
+    def test_conditional_request(self):
+        client = self.app.test_client()
+        etag = client.get(self.url).headers['ETag']
+        resp = client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(304, resp.status_code)
+
+    def test_missing(self):
+        client = self.app.test_client()
+        # no such metatile
+        self.assertEqual(404, client.get('/tilezen/vector/v1/256/all/12/401/806.mvt').status_code)
+        # no such tile in the metatile
+        self.assertEqual(404, client.get('/tilezen/vector/v1/256/all/13/802/1604.mvt').status_code)
+
+    def test_warm(self):
+        from pack import PackStorage
+        from warm import warm_metatile
+
+        # there's no whole metatile to get, so only the index is read.
+        self.assertFalse(hasattr(PackStorage, 'get'))
+        self.assertEqual(('fetched', 0), warm_metatile(self.app, self.metas[0]))
+        self.assertEqual('missing', warm_metatile(self.app, TileRequest(10, 100, 201, 1, 'zip'))[0])
+
+
+class MetricsTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+
+    def make_app(self, **config):
+        from testing import make_metatile
+
+        app = make_test_app(**config)
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile(fmt='mvt'))
+        return app
+
+    def test_histogram(self):
+        from metrics import Histogram
+
+        h = Histogram('latency', 'Latency.', ('layer',), buckets=(0.1, 1.0))
+        h.observe(0.05, layer='vector')
+        h.observe(0.5, layer='vector')
+        h.observe(5, layer='vector')
+
+        self.assertEqual([
+            '# HELP latency Latency.',
+            '# TYPE latency histogram',
+            'latency_bucket{layer="vector",le="0.1"} 1',
+            'latency_bucket{layer="vector",le="1.0"} 2',
+            'latency_bucket{layer="vector",le="+Inf"} 3',
+            'latency_sum{layer="vector"} 5.55',
+            'latency_count{layer="vector"} 3',
+        ], h.render())
+
+    def test_server_timing(self):
+        app = self.make_app(SERVER_TIMING=True)
+        resp = app.test_client().get(self.url)
+
+        stages = dict(part.split(';dur=') for part in resp.headers['Server-Timing'].split(', '))
+        for name in ('parse', 'meta', 'cache', 'fetch', 's3_ttfb', 's3_body', 'zip_index',
+                     'extract', 'encode', 'response', 'total'):
+            self.assertIn(name, stages)
+            self.assertGreaterEqual(float(stages[name]), 0)
+
+    def test_disabled(self):
+        app = self.make_app()
+        client = app.test_client()
+        self.assertNotIn('Server-Timing', client.get(self.url).headers)
+        self.assertEqual(404, client.get('/metrics').status_code)
+
+    def test_metrics(self):
+        app = self.make_app(METRICS=True, METATILE_CACHE_MAX_BYTES=1024 * 1024)
+        client = app.test_client()
+        client.get(self.url)
+        client.get(self.url)
+        client.get('/tilezen/landcover/v1/512/all/12/401/802.mvt')
+
+        request_duration = app.metrics.request_duration
+        self.assertEqual(1, request_duration.count(layer='vector', zoom=12, cache='miss'))
+        self.assertEqual(1, request_duration.count(layer='vector', zoom=12, cache='hit'))
+        self.assertEqual(1, request_duration.count(layer='landcover', zoom=12, cache='miss'))
+        self.assertEqual(1, app.metrics.stage_duration.count(
+            layer='vector', zoom=12, cache='miss', stage='s3_ttfb'))
+        self.assertEqual(0, app.metrics.stage_duration.count(
+            layer='vector', zoom=12, cache='hit', stage='s3_ttfb'))
+
+        resp = client.get('/metrics')
+        self.assertEqual(200, resp.status_code)
+        self.assertIn(
+            'tapalcatl_tile_request_duration_seconds_count{layer="vector",zoom="12",cache="hit"} 1',
+            resp.get_data(as_text=True))
+        self.assertIn('tapalcatl_metatile_flights_leaders_total', resp.get_data(as_text=True))
+        self.assertIn('tapalcatl_metatile_flights_deduplicated_total', resp.get_data(as_text=True))
+
+    def test_cache_stats(self):
+        app = self.make_app(METRICS=True, METATILE_CACHE_MAX_BYTES=1024 * 1024,
+                            TILE_CACHE_MAX_BYTES=1024 * 1024)
+        client = app.test_client()
+        client.get(self.url)
+        client.get(self.url)
+
+        metrics = client.get('/metrics').get_data(as_text=True)
+        # the metatile is looked for again before fetching it from storage.
+        self.assertIn('tapalcatl_metatile_cache_misses_total 2.0', metrics)
+        self.assertIn('tapalcatl_metatile_cache_hits_total 1.0', metrics)
+        self.assertIn('tapalcatl_tile_cache_hits_total 1.0', metrics)
+        self.assertIn('tapalcatl_tile_cache_evictions_total 0.0', metrics)
+        # sizes are gauges rather than counters.
+        self.assertIn('# TYPE tapalcatl_tile_cache_bytes gauge', metrics)
+        self.assertIn('tapalcatl_tile_cache_entries 1.0', metrics)
+        self.assertNotIn('tapalcatl_tile_cache_entries_total', metrics)
+
+    def test_negative_cache_stats(self):
+        app = self.make_app(METRICS=True, NEGATIVE_CACHE_TTL=60, NEGATIVE_CACHE_MAX_ENTRIES=1)
+        client = app.test_client()
+        client.get('/tilezen/vector/v1/256/all/13/801/1604.mvt')
+        client.get('/tilezen/vector/v1/256/all/13/801/1604.mvt')
+        client.get('/tilezen/vector/v1/256/all/13/809/1604.mvt')
+
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('tapalcatl_negative_cache_hits_total 1.0', metrics)
+        self.assertIn('tapalcatl_negative_cache_evictions_total 1.0', metrics)
+        self.assertIn('# TYPE tapalcatl_negative_cache_entries gauge', metrics)
+        self.assertIn('tapalcatl_negative_cache_entries 1.0', metrics)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    url = '/tilezen/vector/v1/256/all/12/401/802.mvt'
+
+    def make_app(self, **config):
+        from testing import make_metatile
+
+        app = make_test_app(**config)
+        put_metatile(app, TileRequest(10, 100, 200, 1, 'zip'), make_metatile(fmt='mvt'))
+        return app
+
+    def test_disabled(self):
+        from server import start_profile
+
+        app = self.make_app()
+        self.assertIsNone(app.profiler)
+        self.assertNotIn(start_profile, app.before_request_funcs.get(None, []))
+        self.assertEqual(404, app.test_client().get('/debug/profile').status_code)
+
+    def test_authorized(self):
+        from profiling import RequestProfiler
+
+        profiler = RequestProfiler(token='secret')
+        self.assertTrue(profiler.authorized('secret'))
+        self.assertFalse(profiler.authorized('secre'))
+        self.assertFalse(profiler.authorized('s\xe9cret'))
+        self.assertFalse(profiler.authorized(None))
+        self.assertFalse(RequestProfiler().authorized(None))
+
+    def test_profile_with_token(self):
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as profile_dir:
+            app = self.make_app(PROFILE_TOKEN='secret', PROFILE_DIR=profile_dir)
+            client = app.test_client()
+            headers = {'X-Tapalcatl-Profile': 'secret'}
+
+            client.get(self.url)
+            self.assertEqual([], os.listdir(profile_dir))
+            self.assertEqual(200, client.get(self.url, headers=headers).status_code)
+            self.assertEqual(1, len(os.listdir(profile_dir)))
+
+            self.assertEqual(403, client.get('/debug/profile').status_code)
+            resp = client.get('/debug/profile', headers=headers)
+            self.assertEqual(200, resp.status_code)
+            self.assertIn('1 profiles', resp.get_data(as_text=True))
+            self.assertIn('handle_tile', resp.get_data(as_text=True))
+
+            resp = client.get('/debug/profile?sort=time', headers=headers)
+            self.assertEqual(200, resp.status_code)
+            resp = client.get('/debug/profile?sort=bogus', headers=headers)
+            self.assertEqual(400, resp.status_code)
+
+            resp = client.get('/debug/profile?format=pstats', headers=headers)
+            self.assertEqual('application/octet-stream', resp.content_type)
+
+    def test_sample_rate(self):
+        app = self.make_app(PROFILE_SAMPLE_RATE=2)
+        client = app.test_client()
+        for _ in range(0, 4):
+            client.get(self.url)
+        self.assertEqual(2, len(app.profiler.recent()))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_fake_s3_errors(self):
+        from fake_s3 import FakeS3Client
+
+        calls = []
+        client = FakeS3Client(latency=lambda: calls.append(1) or 0, error_rate=1, error_code='SlowDown')
+        client.put_object(Bucket='b', Key='k', Body=b'data')
+
+        with self.assertRaises(Exception) as e:
+            client.get_object(Bucket='b', Key='k')
+        self.assertEqual('SlowDown', e.exception.response['Error']['Code'])
+        self.assertEqual(1, client.error_count)
+        self.assertEqual([1], calls)
+
+    def test_percentile(self):
+        from benchmark import percentile
+
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 0.5))
+        self.assertEqual(99, percentile(values, 0.99))
+        self.assertEqual(0.0, percentile([], 0.5))
+
+    def test_load_test(self):
+        import io
+        import json
+        from benchmark import load_test, read_request_log, stock_metatiles, zipf_requests
+
+        app = make_test_app(METATILE_CACHE_MAX_BYTES=16 * 1024 * 1024)
+        requests = zipf_requests(50, extent=8)
+        log = io.StringIO(''.join(json.dumps(r) + '\n' for r in requests))
+        requests = read_request_log(log) + [dict(path='/not/a/tile')]
+        self.assertGreater(stock_metatiles(app, requests, tile_bytes=100), 0)
+
+        results = dict((r['name'], r['value']) for r in load_test(app, requests, concurrency=4))
+        self.assertEqual(51, results['load requests'])
+        self.assertEqual(50, results['load status 200'])
+        self.assertEqual(1, results['load status 404'])
+        self.assertLess(results['load S3 GETs per request'], 1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,378 @@
+"""
+Fill the shared metatile cache (see CACHE_TYPE and
+SHARED_MEMORY_CACHE_MAX_BYTES) before users ask for the tiles in it, for
+example after changing S3_PREFIX. It's configured from the environment
+like the server, and warms the metatiles holding the tiles in bounding
+boxes:
+
+    python warm.py --bbox=-122.52,37.70,-122.35,37.83 --zooms 10-16 \
+        --sizes 256,512 --layers vector,landcover
+
+or the metatiles requested in a log, most requested first:
+
+    python warm.py --log requests.jsonl
+
+The log has a request per line, either as a path, or as a JSON object with
+a "path", or as an API Gateway event, as for benchmark.py.
+
+Metatiles are fetched by a pool of --concurrency threads, and anything
+already in the cache is left alone. With --progress FILE, the metatiles
+that have been warmed are recorded in FILE, and skipped if the same
+command is run again.
+"""
+import argparse
+import json
+import math
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+from werkzeug.exceptions import HTTPException
+
+from metrics import RequestTimer, request_timer
+from server import (
+    MAX_ZOOM,
+    CacheInfo,
+    MetatileNotFoundException,
+    TileRequest,
+    create_app,
+    fetches_members,
+    is_valid_tile_request,
+    match_tile_route,
+    meta_and_offset,
+    metatile_fetch,
+    metatile_index_fetch,
+    parse_routed_tile_request,
+    shared_cache_get_many,
+    source_cache_key,
+    t2_meta_and_offset,
+)
+
+# The furthest north and south that web mercator tiles go.
+MAX_LATITUDE = 85.0511287798
+
+# How often to report progress, in seconds.
+REPORT_INTERVAL = 10
+
+
+def parse_bbox(value):
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4:
+        raise argparse.ArgumentTypeError("Expected min_lon,min_lat,max_lon,max_lat, not %r" % value)
+    return tuple(parts)
+
+
+def parse_zooms(value):
+    start, _, end = value.partition('-')
+    return range(int(start), int(end or start) + 1)
+
+
+def parse_list(value):
+    return [part for part in value.split(',') if part]
+
+
+def lonlat_to_tile(lon, lat, z):
+    n = 2 ** z
+    lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def bbox_tiles(bbox, z):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    x0, y0 = lonlat_to_tile(min_lon, max_lat, z)
+    x1, y1 = lonlat_to_tile(max_lon, min_lat, z)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+
+def bbox_metatiles(config, bboxes, zooms, sizes, layers):
+    """
+    The metatiles, in order, holding the tiles of each size in each layer
+    at each zoom in the bounding boxes, found as the server would find
+    them.
+    """
+
+    metatiles = set()
+    for layer in layers:
+        for size in sizes:
+            scale = size // 256
+            if layer == 'landcover' and scale != 2:
+                # landcover only has 512px tiles.
+                continue
+
+            if layer == 'landcover':
+                max_zoom = config.get('LANDCOVER_MAX_ZOOM')
+            else:
+                max_zoom = MAX_ZOOM
+
+            for z in zooms:
+                for bbox in bboxes:
+                    for x, y in bbox_tiles(bbox, z):
+                        if not is_valid_tile_request(z, x, y, max_zoom=max_zoom):
+                            continue
+                        if layer == 'landcover':
+                            meta, _ = t2_meta_and_offset(
+                                TileRequest(z, x, y, scale, 'png'),
+                                config.get('LANDCOVER_MATERIALIZED_ZOOMS'),
+                                config.get('LANDCOVER_METATILE_SIZE'),
+                            )
+                        else:
+                            meta, _ = meta_and_offset(
+                                TileRequest(z, x, y, scale, 'mvt'),
+                                config.get('METATILE_SIZE'),
+                                metatile_max_detail_zoom=config.get('METATILE_MAX_DETAIL_ZOOM'),
+                            )
+                        metatiles.add(meta)
+
+    return sorted(metatiles)
+
+
+def read_log_paths(f):
+    """
+    The paths of the requests in a log with a path, a JSON object with a
+    "path", or an API Gateway event on each line.
+    """
+
+    from lambda_handler import parse_event
+
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            entry = json.loads(line)
+            if 'httpMethod' in entry or 'rawPath' in entry:
+                yield parse_event(entry)[1]
+            else:
+                yield urlsplit(entry['path']).path
+        else:
+            yield urlsplit(line).path
+
+
+def log_metatiles(app, paths):
+    """
+    The metatiles for the tile requests among `paths`, most requested first.
+    Other requests, and invalid ones, are skipped.
+    """
+
+    counts = Counter()
+    with app.app_context():
+        for path in paths:
+            route = match_tile_route(path)
+            if route is None:
+                continue
+            try:
+                meta, _, _ = parse_routed_tile_request(*route, headers={})
+            except HTTPException:
+                continue
+            counts[meta] += 1
+
+    return [meta for meta, _ in counts.most_common()]
+
+
+class Progress(object):
+    """
+    Counts of the metatiles warmed so far, and the record of them kept in
+    `path`, if there is one, to resume from.
+    """
+
+    def __init__(self, total, path=None, out=sys.stderr):
+        self.total = total
+        self.out = out
+        self.start = time.time()
+        self.last_report = self.start
+        self.outcomes = Counter()
+        self.bytes = 0
+        self.done = set()
+        self.file = None
+        self._lock = threading.Lock()
+
+        if path:
+            try:
+                with open(path) as f:
+                    self.done = set(line.strip() for line in f)
+            except FileNotFoundError:
+                pass
+            self.file = open(path, 'a')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def is_done(self, location):
+        return location in self.done
+
+    def skipped(self):
+        with self._lock:
+            self.outcomes['done before'] += 1
+
+    def finished(self, location, outcome, size=0):
+        with self._lock:
+            self.outcomes[outcome] += 1
+            self.bytes += size
+            if self.file is not None and outcome != 'error':
+                self.file.write(location + '\n')
+                self.file.flush()
+
+            now = time.time()
+            if now - self.last_report >= REPORT_INTERVAL:
+                self.last_report = now
+                self.report()
+
+    def report(self):
+        count = sum(self.outcomes.values())
+        elapsed = max(time.time() - self.start, 1e-6)
+        rate = count / elapsed
+        eta = (self.total - count) / rate if rate else float('inf')
+        self.out.write(
+            "%d/%d metatiles (%s), %.1f/s, %.1f MB/s, ETA %s\n" % (
+                count, self.total,
+                ', '.join('%d %s' % (n, outcome) for outcome, n in sorted(self.outcomes.items())),
+                rate, self.bytes / elapsed / 1e6, format_duration(eta)))
+        self.out.flush()
+
+
+def format_duration(seconds):
+    if math.isinf(seconds):
+        return '?'
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def warm_metatile(app, meta):
+    """
+    Fetch the metatile, or its index when using range requests, into the
+    cache. Returns whether it was already 'cached', was 'fetched' or is
+    'missing', and the number of bytes fetched.
+    """
+
+    timer = RequestTimer()
+    token = request_timer.set(timer)
+    try:
+        with app.app_context():
+            conditions = CacheInfo(last_modified=None, etag=None)
+            if fetches_members():
+                result = metatile_index_fetch(meta, conditions)
+            else:
+                # prefetching around it would fetch outside the budgets.
+                result = metatile_fetch(meta, conditions, prefetch=False)
+    except MetatileNotFoundException:
+        return 'missing', 0
+    finally:
+        request_timer.reset(token)
+
+    if timer.cache_outcome == 'hit':
+        return 'cached', 0
+    return 'fetched', len(result.data) if result.data is not None else 0
+
+
+def preload_metatiles(app, metatiles):
+    """
+    Copy the metatiles, or their indexes when using range requests, which
+    are in the shared cache but not the in-process one into the in-process
+    one, looking them all up at once. Returns the number of bytes copied
+    for each metatile copied.
+    """
+
+    local_cache = app.metatile_cache
+    if local_cache is None or app.shared_cache is None:
+        return {}
+
+    with app.app_context():
+        keys = dict((source_cache_key(meta), meta) for meta in metatiles)
+        found = shared_cache_get_many([key for key in keys if key not in local_cache])
+
+    sizes = {}
+    for key, value in found.items():
+        local_cache.set(key, value)
+        sizes[keys[key]] = len(value.data) if value.data is not None else 0
+    return sizes
+
+
+def warm(app, metatiles, concurrency=8, progress=None):
+    """
+    Warm the metatiles with `concurrency` threads, with at most twice that
+    many queued at a time. Returns the Progress.
+    """
+
+    if progress is None:
+        progress = Progress(len(metatiles))
+
+    def run(meta, location):
+        try:
+            outcome, size = warm_metatile(app, meta)
+        except Exception:
+            app.logger.exception("%s: Error warming metatile", meta)
+            outcome, size = 'error', 0
+        progress.finished(location, outcome, size)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        pending = set()
+        for meta in metatiles:
+            location = app.storage.location(meta)
+            if progress.is_done(location):
+                progress.skipped()
+                continue
+
+            if len(pending) >= concurrency * 2:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.add(executor.submit(run, meta, location))
+
+        for future in pending:
+            future.result()
+
+    return progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill the shared metatile cache.")
+    parser.add_argument('--bbox', type=parse_bbox, action='append', default=[],
+                        metavar='MIN_LON,MIN_LAT,MAX_LON,MAX_LAT',
+                        help="Warm the tiles in this bounding box. Can be given more than once.")
+    parser.add_argument('--zooms', type=parse_zooms, default=parse_zooms('0-16'),
+                        help="Zoom, or range of zooms like 10-14, of the tiles in the bounding boxes.")
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in parse_list(value)],
+                        default=[256, 512], help="Tile sizes in pixels, like 256,512.")
+    parser.add_argument('--layers', type=parse_list, default=['vector'],
+                        help="vector and/or landcover.")
+    parser.add_argument('--log', type=argparse.FileType('r'),
+                        help="Warm the metatiles requested in this log instead.")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--progress', help="File to record progress in, and resume from.")
+    args = parser.parse_args(argv)
+
+    if not args.bbox and not args.log:
+        parser.error("Give one or more --bbox or a --log")
+
+    # this process shouldn't save its own hot set over the server's, or
+    # prefetch more than it was asked to warm.
+    app = create_app(PREFETCH=False, HOT_SET_SNAPSHOT=None)
+    if app.shared_cache is None or not app.storage.cacheable:
+        sys.stderr.write("There's no shared cache configured for this storage to warm.\n")
+        return 1
+    # the in-process caches would only fill up this process.
+    app.metatile_cache = None
+    app.tile_cache = None
+
+    if args.log:
+        metatiles = log_metatiles(app, read_log_paths(args.log))
+    else:
+        metatiles = bbox_metatiles(app.config, args.bbox, args.zooms, args.sizes, args.layers)
+
+    progress = Progress(len(metatiles), args.progress)
+    try:
+        warm(app, metatiles, args.concurrency, progress)
+    finally:
+        progress.close()
+    progress.report()
+    return 1 if progress.outcomes['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())